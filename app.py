@@ -1,13 +1,117 @@
-import streamlit as st
-from scripts import prompt_matching
-import pandas as pd
+import os
 import sys
-sys.path.append("../")
+# the modules in scripts import each other by name, so they are imported by name here too and load once
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+import streamlit as st
+import prompt_matching
+import catalog_store
+import search_service
+import query_cache
 
 # Set page config
 st.set_page_config(page_title="Book Search", page_icon=":books:", layout="wide")
 
-books = pd.read_csv('data/books_with_summaries.csv')
+BOOKS_PATH = os.path.join('data', 'books_with_summaries.csv')
+INDEX_DIR = os.path.join('data', 'indexes')
+SUMMARY_COLUMNS = catalog_store.SUMMARY_COLUMNS
+# when set, searches are sent to a running search_service instead of running inside the app
+SEARCH_SERVICE_URL = os.environ.get('BOOK_SEARCH_URL')
+
+# Load the data and the search indexes once per process and share them across sessions.
+# The modification time of the catalog file is part of the cache key, so editing the data
+# replaces the cached entries on the next run of the script.
+@st.cache_resource(max_entries=1)
+def load_books(path, mtime):
+    """Loads the columns of the book data used by the app
+
+    Args:
+        path (str): the path to the parquet file containing the book data
+        mtime (float): the modification time of the file, only used to invalidate the cache
+
+    Returns:
+        pd.DataFrame: A dataframe containing the book data
+    """
+    return catalog_store.read_catalog(path, columns=catalog_store.APP_COLUMNS)
+
+@st.cache_resource(max_entries=1)
+def load_prompt_matching(path, mtime):
+    """Creates the prompt matcher and loads (or builds) every lexical search index up front
+
+    Args:
+        path (str): the path to the parquet file containing the book data
+        mtime (float): the modification time of the file, only used to invalidate the cache
+
+    Returns:
+        prompt_matching.PromptMatching: the prompt matcher with its indexes loaded
+    """
+    books = load_books(path, mtime)
+    pm = prompt_matching.PromptMatching(index_dir=INDEX_DIR, query_cache=get_query_cache())
+    pm.get_keyword_index(books)
+    pm.get_bm25_index(books)
+    for col in SUMMARY_COLUMNS:
+        pm.get_tfidf_index(books, col)
+    return pm
+
+@st.cache_resource(max_entries=1)
+def load_dense_indexes(path, mtime):
+    """Loads the embedding index and the BERT model of the hybrid search on the first hybrid search, so
+    the other searches never load them. They are never built inside the app, build them with
+    PromptMatching.build_indexes first
+
+    Args:
+        path (str): the path to the parquet file containing the book data
+        mtime (float): the modification time of the file, only used to invalidate the cache
+
+    Returns:
+        str: why the hybrid search is unavailable, None if it can run
+    """
+    try:
+        load_prompt_matching(path, mtime).load_dense_indexes(load_books(path, mtime))
+    except OSError as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+@st.cache_resource
+def get_query_cache():
+    """Creates the cache of search results once per process. It outlives the prompt matcher, results
+    computed from an index that was rebuilt from different data are dropped when they are looked up.
+
+    Returns:
+        query_cache.QueryCache: the cache shared by every session
+    """
+    return query_cache.QueryCache()
+
+@st.cache_resource
+def get_search_client(url):
+    """Creates the client of the search service once per process
+
+    Args:
+        url (str): the url of the search service
+
+    Returns:
+        search_service.SearchClient: the client
+    """
+    return search_service.SearchClient(url)
+
+def get_resources():
+    """Returns the shared book data and prompt matcher, reloading them if the data file changed
+
+    Returns:
+        books (pd.DataFrame): A dataframe containing the book data
+        pm (prompt_matching.PromptMatching): the prompt matcher
+    """
+    path = catalog_store.ensure_catalog(BOOKS_PATH)
+    mtime = os.path.getmtime(path)
+    return load_books(path, mtime), load_prompt_matching(path, mtime)
+
+def get_hybrid_error():
+    """Returns why the hybrid search cannot run inside the app, e.g. the embedding index was not built
+
+    Returns:
+        str: the error, None if the hybrid search can run
+    """
+    path = catalog_store.ensure_catalog(BOOKS_PATH)
+    return load_dense_indexes(path, os.path.getmtime(path))
 
 # Define function to search for relevant book summaries using keyword matching
 def search_books_by_keyword(prompt):
@@ -19,10 +123,11 @@ def search_books_by_keyword(prompt):
     Returns:
         matched (pd.DataFrame): A dataframe containing the books that have the necessary keywords
     """
-    pm = prompt_matching.PromptMatching()
-    pm.keyword_matching(prompt, books)
-    matched = books[books['keywords_match']]
-    return matched
+    if SEARCH_SERVICE_URL:
+        return get_search_client(SEARCH_SERVICE_URL).search(prompt, 'keyword', k=None).drop(columns=['score'])
+    books, pm = get_resources()
+    result = pm.search(prompt, books, 'keyword', num_books=None)
+    return result.rows(books)
 
 # Define function to search for relevant book summaries using cosine similarity
 def search_books_by_cosine_similarity(prompt,col, num_books=3):
@@ -36,11 +141,34 @@ def search_books_by_cosine_similarity(prompt,col, num_books=3):
     Returns:
         pd.DataFrame: A dataframe containing the books that have the highest cosine similarity scores
     """
-    pm = prompt_matching.PromptMatching()
-    pm.cosine_similarity(prompt, books,col)
-    matched = books
-    matched = matched.sort_values(by='cosine_similarity', ascending=False)
-    return matched.head(num_books)
+    if SEARCH_SERVICE_URL:
+        results = get_search_client(SEARCH_SERVICE_URL).search(prompt, 'cosine', col, num_books)
+        return results.rename(columns={'score': 'cosine_similarity'})
+    books, pm = get_resources()
+    result = pm.search(prompt, books, 'cosine', col, num_books)
+    return result.rows(books, 'cosine_similarity')
+
+# Define function to search for relevant book summaries using BM25 and BERT embeddings together
+def search_books_hybrid(prompt, num_books=3):
+    """Searches for the most relevant books by fusing a BM25 search over every summary column with a BERT embedding search
+
+    Args:
+        prompt (str): any prompt to search for books
+        num_books (int, optional): The number of books to return. Defaults to 3.
+
+    Returns:
+        pd.DataFrame: A dataframe containing the books with the highest fused scores, a RuntimeError is raised
+            if the embedding index or the BERT model is missing
+    """
+    if SEARCH_SERVICE_URL:
+        results = get_search_client(SEARCH_SERVICE_URL).search(prompt, 'hybrid', k=num_books)
+        return results.rename(columns={'score': 'hybrid_score'})
+    books, pm = get_resources()
+    error = get_hybrid_error()
+    if error:
+        raise RuntimeError(error)
+    result = pm.search(prompt, books, 'hybrid', num_books=num_books)
+    return result.rows(books, 'hybrid_score')
 
 def display_results(results):
     """Displays the results of the search in the streamlit app
@@ -52,7 +180,10 @@ def display_results(results):
     count = 0
     for index, row in top_3_books.iterrows():
         count+=1
-        st.markdown(f"<h4 style='color: green'>Cosine Similarity: {row['cosine_similarity']}</h4>", unsafe_allow_html=True)
+        if 'cosine_similarity' in row:
+            st.markdown(f"<h4 style='color: green'>Cosine Similarity: {row['cosine_similarity']}</h4>", unsafe_allow_html=True)
+        if 'hybrid_score' in row:
+            st.markdown(f"<h4 style='color: green'>Hybrid Score: {row['hybrid_score']}</h4>", unsafe_allow_html=True)
         st.markdown(f"### {count}: **{row['Title']}**")
         st.write(f"**Library Location:** {row['Location']} **Authors:** {row['Authors']}")
         with st.expander("Click to view summaries"):
@@ -67,8 +198,8 @@ def app():
 
     prompt = st.text_area("Enter a prompt:", height=100)
 
-    # Create two columns for the buttons
-    col1, col2, col3, col4 = st.columns(4)
+    # Create a column for each button
+    col1, col2, col3, col4, col5 = st.columns(5)
 
     # Create a section for recommendations
     st.write("## Recommendations")
@@ -96,6 +227,15 @@ def app():
         if st.button("Abbreviated Summary Matching", key="search_by_abbreviated_summary"):
             if prompt:
                 results = search_books_by_cosine_similarity(prompt,'abbreviated_summary')
+
+    with col5:
+        if st.button("Hybrid Matching", key="search_hybrid"):
+            if prompt:
+                try:
+                    results = search_books_hybrid(prompt)
+                except RuntimeError as e:
+                    st.error(f"Hybrid search is unavailable. {e}. Build the indexes with "
+                             "PromptMatching().build_indexes() from the scripts folder and restart the app.")
     
     # Display results under Recommendations
     if 'results' in locals():
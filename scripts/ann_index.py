@@ -0,0 +1,335 @@
+# Imports
+import os
+import time
+import numpy as np
+import pandas as pd
+from index_utils import top_k, save_meta, load_meta, index_writer
+
+# create a class for the approximate nearest neighbour index
+class IVFIndex:
+
+    def __init__(self, centroids, offsets, ids, vectors=None, codebooks=None, codes=None, nprobe=16, version=None):
+        """Constructor for the IVFIndex class. Use build or load to create one.
+
+        The vectors are split into lists by a k-means coarse quantizer. A query only scans the nprobe lists
+        whose centroids are closest to it. The vectors in each list are either stored as they are or
+        compressed with product quantization (PQ).
+
+        Args:
+            centroids (np.ndarray): the centroid of each list (num_lists x dim)
+            offsets (np.ndarray): list i holds the rows offsets[i] to offsets[i+1]
+            ids (np.ndarray): the original id of every row, grouped by list
+            vectors (np.ndarray, optional): the normalized vectors grouped by list. Defaults to None.
+            codebooks (np.ndarray, optional): the PQ codebooks of the residuals to the list centroids
+                (num_subvectors x 256 x sub_dim). Defaults to None.
+            codes (np.ndarray, optional): the PQ code of every row (num_rows x num_subvectors). Defaults to None.
+            nprobe (int, optional): number of lists scanned per query. Defaults to 16.
+            version (str, optional): fingerprint of the data the index was built from. Defaults to None.
+        """
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.codebooks = codebooks
+        self.codes = codes
+        self.nprobe = nprobe
+        self.version = version
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, vectors, ids=None, num_lists=None, num_subvectors=None, num_iter=20, sample_size=100_000,
+              dtype='float32', nprobe=16, version=None, seed=0):
+        """Trains the coarse quantizer (and the PQ codebooks) and assigns every vector to a list.
+
+        Args:
+            vectors (np.ndarray): the vectors to index (num_vectors x dim)
+            ids (np.ndarray, optional): the id returned for each vector. Defaults to the row number.
+            num_lists (int, optional): number of k-means lists. Defaults to 4 * sqrt(num_vectors).
+            num_subvectors (int, optional): use PQ with this many 8 bit subquantizers. Defaults to None (no PQ).
+            num_iter (int, optional): number of k-means iterations. Defaults to 20.
+            sample_size (int, optional): number of vectors used for training. Defaults to 100_000.
+            dtype (str, optional): storage type of the vectors when PQ is not used. Defaults to 'float32'.
+            nprobe (int, optional): number of lists scanned per query. Defaults to 16.
+            version (str, optional): fingerprint of the data the index was built from. Defaults to None.
+            seed (int, optional): random seed for training. Defaults to 0.
+
+        Returns:
+            IVFIndex: the trained index
+        """
+        rng = np.random.default_rng(seed)
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        if ids is None:
+            ids = np.arange(len(vectors))
+        if num_lists is None:
+            num_lists = max(1, int(4 * np.sqrt(len(vectors))))
+        num_lists = min(num_lists, len(vectors))
+
+        # Train the coarse quantizer on a sample, then assign every vector
+        sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+        centroids = _spherical_kmeans(sample, num_lists, num_iter, rng)
+        assignments = _assign(vectors, centroids)
+
+        # Group the rows by list
+        order = np.argsort(assignments, kind='stable')
+        offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=num_lists))
+        ids = np.asarray(ids)[order]
+
+        if num_subvectors is None:
+            return cls(centroids, offsets, ids, vectors=vectors[order].astype(dtype), nprobe=nprobe, version=version)
+
+        # PQ encodes the residual of each vector to its list centroid
+        residuals = vectors[order] - np.repeat(centroids, np.diff(offsets), axis=0)
+        sample_residuals = residuals[rng.choice(len(residuals), min(sample_size, len(residuals)), replace=False)]
+        codebooks = _train_pq(sample_residuals, num_subvectors, num_iter, rng)
+        codes = _pq_encode(residuals, codebooks)
+        return cls(centroids, offsets, ids, codebooks=codebooks, codes=codes, nprobe=nprobe, version=version)
+
+    def save(self, index_dir):
+        """Saves the index to a folder as .npy files. A saved index is replaced whole, see index_writer,
+        so no files of a previous PQ or uncompressed index are left behind.
+
+        Args:
+            index_dir (str): the folder to save the index to
+        """
+        arrays = {'centroids': self.centroids, 'offsets': self.offsets, 'ids': self.ids,
+                  'vectors': self.vectors, 'codebooks': self.codebooks, 'codes': self.codes}
+        with index_writer(index_dir) as version_dir:
+            for name, array in arrays.items():
+                if array is not None:
+                    np.save(os.path.join(version_dir, f"{name}.npy"), array)
+            save_meta(version_dir, {'num_lists': int(self.num_lists), 'num_vectors': int(len(self.ids)),
+                                    'pq': self.codes is not None, 'nprobe': self.nprobe, 'version': self.version})
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """Loads an index saved with save.
+
+        Args:
+            index_dir (str): the folder containing the index
+            mmap (bool, optional): memory-map the vectors and codes instead of reading them. Defaults to True.
+
+        Returns:
+            IVFIndex: the loaded index
+        """
+        # every file is read from the same version even if a new one is swapped in meanwhile
+        index_dir = os.path.realpath(index_dir)
+        meta = load_meta(index_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No index found in {index_dir}")
+        mmap_mode = 'r' if mmap else None
+        load = lambda name: np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        if meta['pq']:
+            return cls(load('centroids'), load('offsets'), load('ids'), codebooks=load('codebooks'),
+                       codes=load('codes'), nprobe=meta['nprobe'], version=meta['version'])
+        return cls(load('centroids'), load('offsets'), load('ids'), vectors=load('vectors'),
+                   nprobe=meta['nprobe'], version=meta['version'])
+
+    def search(self, query, k=10, nprobe=None):
+        """Finds the approximate k nearest neighbours of the query by inner product.
+
+        Args:
+            query (np.ndarray): the query vector
+            k (int, optional): the number of neighbours to return. Defaults to 10.
+            nprobe (int, optional): number of lists to scan, more is slower but more accurate.
+                Defaults to the nprobe of the index.
+
+        Returns:
+            ids (np.ndarray): the ids of the neighbours, best first
+            scores (np.ndarray): the cosine similarity of each neighbour
+        """
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        query = _normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+        probed, centroid_scores = top_k(self.centroids @ query, nprobe)
+
+        # With PQ the score of the residual is looked up from one table per query and
+        # added to the score of the list centroid
+        if self.codes is not None:
+            num_subvectors = len(self.codebooks)
+            table = np.einsum('mcd,md->mc', self.codebooks, query.reshape(num_subvectors, -1))
+            subvector_idx = np.arange(num_subvectors)
+            score_fn = lambda i: centroid_scores[i] + table[subvector_idx, self.codes[self.offsets[probed[i]]:self.offsets[probed[i] + 1]]].sum(axis=1)
+        else:
+            query = query.astype(self.vectors.dtype)
+            score_fn = lambda i: self.vectors[self.offsets[probed[i]]:self.offsets[probed[i] + 1]] @ query
+
+        # Score each probed list in place, only the scores are concatenated
+        rows = [np.arange(self.offsets[i], self.offsets[i + 1]) for i in probed]
+        scores = [score_fn(i) for i in range(len(probed))]
+        rows = np.concatenate(rows)
+        scores = np.concatenate(scores).astype(np.float32)
+
+        best, best_scores = top_k(scores, k)
+        return np.asarray(self.ids[rows[best]]), best_scores
+
+##### Functions #####
+def exact_search(vectors, query, k=10):
+    """Finds the exact k nearest neighbours of the query by brute force cosine similarity.
+
+    Args:
+        vectors (np.ndarray): the normalized vectors to search
+        query (np.ndarray): the query vector
+        k (int, optional): the number of neighbours to return. Defaults to 10.
+
+    Returns:
+        ids (np.ndarray): the rows of the neighbours, best first
+        scores (np.ndarray): the cosine similarity of each neighbour
+    """
+    query = _normalize(np.asarray(query, dtype=np.float32).reshape(1, -1))[0]
+    return top_k((vectors @ query.astype(vectors.dtype)).astype(np.float32), k)
+
+def recall_report(index, vectors, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32, 64), ids=None):
+    """Measures recall@k and latency of the index against exact search for different nprobe values.
+
+    Args:
+        index (IVFIndex): the index to evaluate
+        vectors (np.ndarray): the normalized vectors the index was built from, in id order
+        queries (np.ndarray): the query vectors
+        k (int, optional): the number of neighbours. Defaults to 10.
+        nprobes (tuple, optional): the nprobe values to test. Defaults to (1, 2, 4, 8, 16, 32, 64).
+        ids (np.ndarray, optional): the id of each vector, as passed to build. Defaults to the row number.
+
+    Returns:
+        pd.DataFrame: recall@k and latency percentiles for each nprobe, plus the exact search baseline
+    """
+    exact_results = []
+    exact_times = []
+    for query in queries:
+        start = time.perf_counter()
+        rows, _ = exact_search(vectors, query, k)
+        exact_results.append(set(rows if ids is None else ids[rows]))
+        exact_times.append(time.perf_counter() - start)
+
+    rows = [{'nprobe': 'exact', f'recall@{k}': 1.0, 'mean_ms': 1000 * np.mean(exact_times),
+             'p99_ms': 1000 * np.percentile(exact_times, 99)}]
+    for nprobe in nprobes:
+        recalls = []
+        times = []
+        for query, exact in zip(queries, exact_results):
+            start = time.perf_counter()
+            ids, _ = index.search(query, k, nprobe)
+            times.append(time.perf_counter() - start)
+            recalls.append(len(exact.intersection(ids)) / max(len(exact), 1))
+        rows.append({'nprobe': nprobe, f'recall@{k}': np.mean(recalls), 'mean_ms': 1000 * np.mean(times),
+                     'p99_ms': 1000 * np.percentile(times, 99)})
+
+    return pd.DataFrame(rows)
+
+##### Helper Functions #####
+def _normalize(vectors):
+    """L2 normalizes each row of a matrix.
+
+    Args:
+        vectors (np.ndarray): a 2D array
+
+    Returns:
+        np.ndarray: the normalized rows
+    """
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def _assign(vectors, centroids, chunk_size=65536):
+    """Assigns every vector to the centroid with the highest inner product.
+
+    Args:
+        vectors (np.ndarray): the vectors to assign
+        centroids (np.ndarray): the centroids
+        chunk_size (int, optional): number of vectors scored at once. Defaults to 65536.
+
+    Returns:
+        np.ndarray: the centroid of each vector
+    """
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        assignments[start:start + chunk_size] = np.argmax(vectors[start:start + chunk_size] @ centroids.T, axis=1)
+    return assignments
+
+def _spherical_kmeans(vectors, num_clusters, num_iter, rng):
+    """Clusters normalized vectors with k-means using the inner product.
+
+    Args:
+        vectors (np.ndarray): the normalized training vectors
+        num_clusters (int): the number of clusters
+        num_iter (int): the number of iterations
+        rng (np.random.Generator): random generator used for initialization
+
+    Returns:
+        np.ndarray: the normalized centroids
+    """
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(num_iter):
+        assignments = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+
+        # Restart empty clusters from random training vectors
+        empty = np.bincount(assignments, minlength=num_clusters) == 0
+        sums[empty] = vectors[rng.choice(len(vectors), empty.sum())]
+        centroids = _normalize(sums)
+    return centroids
+
+def _train_pq(vectors, num_subvectors, num_iter, rng, num_codes=256):
+    """Trains one k-means codebook per sub-vector for product quantization.
+
+    Args:
+        vectors (np.ndarray): the training vectors, the dimension must be divisible by num_subvectors
+        num_subvectors (int): the number of sub-vectors
+        num_iter (int): the number of k-means iterations
+        rng (np.random.Generator): random generator used for initialization
+        num_codes (int, optional): the number of codes per sub-vector. Defaults to 256.
+
+    Returns:
+        np.ndarray: the codebooks (num_subvectors x num_codes x sub_dim)
+    """
+    if vectors.shape[1] % num_subvectors != 0:
+        raise ValueError(f"Dimension {vectors.shape[1]} is not divisible by {num_subvectors} sub-vectors")
+    num_codes = min(num_codes, len(vectors))
+    sub_vectors = vectors.reshape(len(vectors), num_subvectors, -1)
+
+    codebooks = []
+    for m in range(num_subvectors):
+        data = sub_vectors[:, m, :]
+        codebook = data[rng.choice(len(data), num_codes, replace=False)].copy()
+        for _ in range(num_iter):
+            assignments = _nearest_code(data, codebook)
+            sums = np.zeros_like(codebook)
+            np.add.at(sums, assignments, data)
+            counts = np.bincount(assignments, minlength=num_codes)
+            codebook[counts > 0] = sums[counts > 0] / counts[counts > 0, None]
+        codebooks.append(codebook)
+    return np.stack(codebooks).astype(np.float32)
+
+def _nearest_code(data, codebook):
+    """Finds the closest code (by euclidean distance) of each sub-vector.
+
+    Args:
+        data (np.ndarray): the sub-vectors
+        codebook (np.ndarray): the codes
+
+    Returns:
+        np.ndarray: the closest code of each sub-vector
+    """
+    distances = (codebook ** 2).sum(axis=1)[None, :] - 2 * data @ codebook.T
+    return np.argmin(distances, axis=1)
+
+def _pq_encode(vectors, codebooks, chunk_size=65536):
+    """Encodes vectors with the PQ codebooks.
+
+    Args:
+        vectors (np.ndarray): the vectors to encode
+        codebooks (np.ndarray): the PQ codebooks
+        chunk_size (int, optional): number of vectors encoded at once. Defaults to 65536.
+
+    Returns:
+        np.ndarray: one uint8 code per sub-vector for every vector
+    """
+    num_subvectors = len(codebooks)
+    codes = np.empty((len(vectors), num_subvectors), dtype=np.uint8)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = vectors[start:start + chunk_size].reshape(-1, num_subvectors, codebooks.shape[2])
+        for m in range(num_subvectors):
+            codes[start:start + chunk_size, m] = _nearest_code(chunk[:, m, :], codebooks[m])
+    return codes
@@ -0,0 +1,282 @@
+# Imports
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, quote
+import aiohttp
+from lxml import etree, html
+from yarl import URL
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# create a class for limiting the request rate to each host
+class RateLimiter:
+
+    def __init__(self, requests_per_second):
+        """Constructor for the RateLimiter class. Requests to the same host are spaced at least
+        1 / requests_per_second seconds apart.
+
+        Args:
+            requests_per_second (float): the maximum number of requests per second to one host
+        """
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_time = {}
+        self.locks = {}
+
+    async def wait(self, host):
+        """Waits until the next request to the host is allowed.
+
+        Args:
+            host (str): the host of the request
+        """
+        if self.interval == 0:
+            return
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            next_time = self.next_time.get(host, now)
+            self.next_time[host] = max(now, next_time) + self.interval
+        if next_time > now:
+            await asyncio.sleep(next_time - now)
+
+
+# create a class for fetching many pages concurrently
+class AsyncFetcher:
+
+    def __init__(self, max_concurrency=32, per_host_limit=8, requests_per_second=10.0, max_retries=5,
+                 backoff_base=0.5, timeout=30, headers=None):
+        """Constructor for the AsyncFetcher class. All requests share one pooled HTTP session, so
+        connections are reused instead of paying a new TCP and TLS handshake per page.
+
+        Args:
+            max_concurrency (int, optional): the maximum number of requests in flight. Defaults to 32.
+            per_host_limit (int, optional): politeness cap on open connections to one host. Defaults to 8.
+            requests_per_second (float, optional): the maximum request rate to one host. Defaults to 10.0.
+            max_retries (int, optional): the number of retries after a failed request. Defaults to 5.
+            backoff_base (float, optional): the first retry waits this many seconds, doubling every retry. Defaults to 0.5.
+            timeout (int, optional): the timeout of one request in seconds. Defaults to 30.
+            headers (dict, optional): headers sent with every request. Defaults to None.
+        """
+        self.max_concurrency = max_concurrency
+        self.per_host_limit = per_host_limit
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.timeout = timeout
+        self.headers = headers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.per_host_limit)
+        self.session = aiohttp.ClientSession(connector=connector, headers=self.headers,
+                                             timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def fetch(self, url):
+        """Fetches one page, retrying with exponential backoff on connection errors and on
+        429 and 5xx responses.
+
+        Args:
+            url (str): the url of the page
+
+        Returns:
+            bytes: the content of the page, or None if every attempt failed
+        """
+        host = urlsplit(url).netloc
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            async with self.semaphore:
+                await self.rate_limiter.wait(host)
+                try:
+                    # send the url exactly as given, without requoting it
+                    async with self.session.get(URL(url, encoded=True)) as response:
+                        if response.status == 200:
+                            return await response.read()
+                        if response.status not in RETRY_STATUSES:
+                            return None
+                        retry_after = response.headers.get('Retry-After')
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+
+            if attempt < self.max_retries:
+                delay = self.backoff_base * 2 ** attempt * (1 + random.random())
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                await asyncio.sleep(delay)
+        return None
+
+    async def fetch_and_parse(self, urls, parse_page, on_result, num_parse_workers=None):
+        """Fetches every url and parses each page in a pool of worker processes. Only a bounded
+        number of urls are in flight at once, so the list of urls can be very long.
+
+        Args:
+            urls (iterable): the urls to fetch
+            parse_page (function): a picklable function that takes the page content and returns the parsed result
+            on_result (function): called with (index, url, parsed result) as pages finish, the parsed
+                result is None if the page could not be fetched
+            num_parse_workers (int, optional): the number of parsing processes. Defaults to the number of CPUs.
+
+        Returns:
+            int: the number of pages fetched successfully
+        """
+        loop = asyncio.get_running_loop()
+        num_fetched = 0
+
+        async def process(index, url, pool):
+            content = await self.fetch(url)
+            if content is None:
+                return index, url, None
+            return index, url, await loop.run_in_executor(pool, parse_page, content)
+
+        with ProcessPoolExecutor(max_workers=num_parse_workers) as pool:
+            pending = set()
+            for index, url in enumerate(urls):
+                pending.add(asyncio.ensure_future(process(index, url, pool)))
+                if len(pending) >= 2 * self.max_concurrency:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    num_fetched += _handle_done(done, on_result)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                num_fetched += _handle_done(done, on_result)
+
+        return num_fetched
+
+
+# create a class for serving saved pages to the scrapers offline
+class FixtureServer:
+
+    def __init__(self, fixture_dir, port=0):
+        """Constructor for the FixtureServer class. A local HTTP server that stands in for a website by
+        serving the pages saved with save_fixture. Requests for pages that were not saved get a 404.
+
+        Args:
+            fixture_dir (str): the folder containing the saved pages
+            port (int, optional): the port to listen on. Defaults to 0 (any free port).
+        """
+        self.fixture_dir = fixture_dir
+        fixture_dir_ = fixture_dir
+
+        class FixtureHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = os.path.join(fixture_dir_, fixture_filename(self.path))
+                if not os.path.exists(path):
+                    self.send_error(404)
+                    return
+                with open(path, "rb") as f:
+                    content = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), FixtureHandler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+##### Functions #####
+def fixture_filename(url):
+    """Returns the file name a page is saved under. Only the path and query of the url are used,
+    so the same fixture is found whatever host serves it.
+
+    Args:
+        url (str): the url of the page, or only its path and query
+
+    Returns:
+        str: the file name of the saved page
+    """
+    parts = urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    return quote(path, safe='') + '.html'
+
+def save_fixture(fixture_dir, url, content):
+    """Saves a page so the FixtureServer can serve it.
+
+    Args:
+        fixture_dir (str): the folder containing the saved pages
+        url (str): the url of the page
+        content (bytes): the content of the page
+    """
+    os.makedirs(fixture_dir, exist_ok=True)
+    with open(os.path.join(fixture_dir, fixture_filename(url)), "wb") as f:
+        f.write(content)
+
+def crawl(urls, parse_page, on_result, num_parse_workers=None, **fetcher_kwargs):
+    """Fetches and parses the urls with one AsyncFetcher, returning once every page is done.
+
+    Args:
+        urls (iterable): the urls to fetch
+        parse_page (function): a picklable function that parses the content of one page
+        on_result (function): called with (index, url, parsed result) as pages finish
+        num_parse_workers (int, optional): the number of parsing processes. Defaults to the number of CPUs.
+        fetcher_kwargs: arguments for AsyncFetcher, e.g. max_concurrency or requests_per_second
+
+    Returns:
+        int: the number of pages fetched successfully
+    """
+    async def run():
+        async with AsyncFetcher(**fetcher_kwargs) as fetcher:
+            return await fetcher.fetch_and_parse(urls, parse_page, on_result, num_parse_workers=num_parse_workers)
+    return asyncio.run(run())
+
+def parse_html(content):
+    """Parses a page with lxml.
+
+    Args:
+        content (bytes): the html of the page
+
+    Returns:
+        the root element of the page, or None if the page is empty
+    """
+    # lxml assumes latin-1 when a page does not declare its encoding, the catalogs serve utf-8
+    if isinstance(content, bytes):
+        try:
+            content = content.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    try:
+        return html.document_fromstring(content)
+    except etree.ParserError:
+        return None
+
+##### Helper Functions #####
+def _handle_done(done, on_result):
+    """Passes finished tasks to the result callback.
+
+    Args:
+        done (set): the finished tasks
+        on_result (function): called with (index, url, parsed result)
+
+    Returns:
+        int: the number of tasks whose page was fetched and parsed
+    """
+    num_fetched = 0
+    for task in done:
+        index, url, parsed = task.result()
+        on_result(index, url, parsed)
+        num_fetched += parsed is not None
+    return num_fetched
@@ -0,0 +1,377 @@
+# Imports
+import json
+import os
+import numpy as np
+from sklearn.feature_extraction.text import CountVectorizer
+from index_utils import top_k, fingerprint, save_meta, load_meta, index_writer
+
+# the same tokenizer as the keyword and cosine searches
+ANALYZER = CountVectorizer().build_analyzer()
+# the number of postings per block, a block is the smallest unit that gets decoded
+BLOCK_SIZE = 128
+ARRAY_NAMES = ['doc_bytes', 'tf_bytes', 'block_first', 'block_postings', 'block_doc_offsets', 'block_tf_offsets',
+               'block_max', 'term_blocks', 'max_scores', 'idf', 'norms']
+
+# create a class for the bm25 index
+class BM25Index:
+
+    def __init__(self, cols, vocabulary, arrays, version, k1=1.2, b=0.75):
+        """Constructor for the BM25Index class. Use build or load to create one.
+
+        The posting list of every term is split into blocks of BLOCK_SIZE books. Within a block the book ids
+        are stored as varint encoded gaps from the first book of the block, and the term frequencies as
+        varints. Every block also stores the highest score any of its books can get from the term, and every
+        term the highest score in its whole list, so a top k query can skip books that cannot make the top k.
+
+        Args:
+            cols (list): the summary columns the index was built from, they are indexed as one text per book
+            vocabulary (dict): maps each term to its term id
+            arrays (dict): the arrays named in ARRAY_NAMES
+            version (str): fingerprint of the columns the index was built from
+            k1 (float, optional): the term frequency saturation of the scores. Defaults to 1.2.
+            b (float, optional): the length normalization of the scores. Defaults to 0.75.
+        """
+        self.cols = cols
+        self.vocabulary = vocabulary
+        self.version = version
+        self.k1 = k1
+        self.b = b
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+    @property
+    def num_books(self):
+        return len(self.norms)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ARRAY_NAMES)
+
+    @classmethod
+    def build(cls, books, cols, k1=1.2, b=0.75):
+        """Counts the terms of every book once and stores the compressed posting list of every term.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+            cols (list): the columns containing the summaries
+            k1 (float, optional): the term frequency saturation. Defaults to 1.2.
+            b (float, optional): the length normalization. Defaults to 0.75.
+
+        Returns:
+            BM25Index: the index of the columns
+        """
+        texts = [' '.join(text for text in row if isinstance(text, str)) for row in zip(*(books[col] for col in cols))]
+
+        vectorizer = CountVectorizer(dtype=np.int64)
+        counts = vectorizer.fit_transform(texts)
+        num_books = counts.shape[0]
+
+        # idf that stays positive for terms in more than half of the books
+        postings = counts.T.tocsr()
+        postings.sort_indices()
+        doc_freq = np.diff(postings.indptr)
+        idf = np.log1p((num_books - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+        lengths = np.asarray(counts.sum(axis=1)).ravel()
+        norms = (k1 * (1 - b + b * lengths / max(lengths.mean(), 1.0))).astype(np.float32)
+
+        doc_ids = postings.indices.astype(np.int64)
+        tfs = postings.data
+        terms = np.repeat(np.arange(len(doc_freq)), doc_freq)
+        scores = _bm25(idf[terms], tfs, norms[doc_ids], k1)
+
+        # every list starts a new block, and so does every BLOCK_SIZE-th posting of a list
+        blocks_per_term = -(-doc_freq // BLOCK_SIZE)
+        term_blocks = np.concatenate([[0], np.cumsum(blocks_per_term)])
+        block_term = np.repeat(np.arange(len(doc_freq)), blocks_per_term)
+        block_starts = postings.indptr[block_term] + BLOCK_SIZE * (np.arange(len(block_term)) - term_blocks[block_term])
+        block_postings = np.concatenate([block_starts, [len(doc_ids)]])
+
+        gaps = np.diff(doc_ids, prepend=0)
+        gaps[block_starts] = 0
+        doc_bytes, doc_lengths = encode_varints(gaps)
+        tf_bytes, tf_lengths = encode_varints(tfs)
+        doc_ends = np.concatenate([[0], np.cumsum(doc_lengths)])
+        tf_ends = np.concatenate([[0], np.cumsum(tf_lengths)])
+
+        arrays = {'doc_bytes': doc_bytes, 'tf_bytes': tf_bytes,
+                  'block_first': doc_ids[block_starts].astype(np.int32),
+                  'block_postings': block_postings.astype(np.int64),
+                  'block_doc_offsets': doc_ends[block_postings].astype(np.int64),
+                  'block_tf_offsets': tf_ends[block_postings].astype(np.int64),
+                  'block_max': np.maximum.reduceat(scores, block_starts) if len(scores) else np.empty(0, np.float32),
+                  'term_blocks': term_blocks.astype(np.int64),
+                  'max_scores': np.zeros(len(doc_freq), dtype=np.float32),
+                  'idf': idf, 'norms': norms}
+        has_postings = doc_freq > 0
+        arrays['max_scores'][has_postings] = np.maximum.reduceat(arrays['block_max'], term_blocks[:-1][has_postings])
+
+        vocabulary = {term: int(i) for term, i in vectorizer.vocabulary_.items()}
+        return cls(list(cols), vocabulary, arrays, fingerprint(books[cols]), k1, b)
+
+    def save(self, index_dir):
+        """Saves the index to a folder. The arrays are stored as .npy files so they can be memory-mapped.
+        A saved index is replaced whole, see index_writer.
+
+        Args:
+            index_dir (str): the folder to save the index to
+        """
+        with index_writer(index_dir) as version_dir:
+            with open(os.path.join(version_dir, "vocabulary.json"), "w") as f:
+                json.dump(self.vocabulary, f)
+            for name in ARRAY_NAMES:
+                np.save(os.path.join(version_dir, name + ".npy"), getattr(self, name))
+            save_meta(version_dir, {'columns': self.cols, 'num_books': int(self.num_books),
+                                    'num_terms': len(self.vocabulary), 'block_size': BLOCK_SIZE,
+                                    'k1': self.k1, 'b': self.b, 'version': self.version})
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """Loads an index saved with save.
+
+        Args:
+            index_dir (str): the folder containing the index
+            mmap (bool, optional): memory-map the arrays instead of reading them. Processes that map the
+                same index share its pages. Defaults to True.
+
+        Returns:
+            BM25Index: the loaded index
+        """
+        # every file is read from the same version even if a new one is swapped in meanwhile
+        index_dir = os.path.realpath(index_dir)
+        meta = load_meta(index_dir)
+        if meta is None or meta.get('block_size') != BLOCK_SIZE:
+            raise FileNotFoundError(f"No index found in {index_dir}")
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(index_dir, "vocabulary.json"), "r") as f:
+            vocabulary = json.load(f)
+        arrays = {name: np.load(os.path.join(index_dir, name + ".npy"), mmap_mode=mmap_mode) for name in ARRAY_NAMES}
+        return cls(meta['columns'], vocabulary, arrays, meta['version'], meta['k1'], meta['b'])
+
+    def query_terms(self, prompt):
+        """Finds the indexed terms of the prompt.
+
+        Args:
+            prompt (str): a prompt to match to books
+
+        Returns:
+            list: (term id, number of times the term is in the prompt) pairs
+        """
+        counts = {}
+        for term in ANALYZER(prompt):
+            if term in self.vocabulary:
+                counts[self.vocabulary[term]] = counts.get(self.vocabulary[term], 0) + 1
+        return list(counts.items())
+
+    def scores(self, prompt):
+        """Calculates the bm25 score of every book in the index by decoding every posting list of the prompt.
+
+        Args:
+            prompt (str): a prompt to match to books
+
+        Returns:
+            np.ndarray: one score per book, -inf for books without any term of the prompt
+        """
+        scores = np.zeros(self.num_books, dtype=np.float32)
+        matched = np.zeros(self.num_books, dtype=bool)
+        for term_id, count in self.query_terms(prompt):
+            doc_ids, term_scores = self._decode_term(term_id)
+            scores[doc_ids] += count * term_scores
+            matched[doc_ids] = True
+        scores[~matched] = -np.inf
+        return scores
+
+    def query(self, prompt, k):
+        """Finds the k books with the highest bm25 score. The terms are processed from the highest to the
+        lowest possible score (MaxScore). Once the k-th best score so far is above the most the remaining
+        terms can add, books that were not matched yet cannot make the top k. From then on only the blocks
+        containing the remaining candidates are decoded, and candidates that cannot reach the top k even
+        with the highest score of their block are dropped.
+
+        Args:
+            prompt (str): a prompt to match to books
+            k (int): the number of books to return
+
+        Returns:
+            indices (np.ndarray): the positions of the best books, best first
+            scores (np.ndarray): the bm25 score of each of those books
+        """
+        terms = sorted(self.query_terms(prompt), key=lambda term: -term[1] * self.max_scores[term[0]])
+        max_scores = np.array([count * self.max_scores[term_id] for term_id, count in terms], dtype=np.float32)
+        remaining = np.concatenate([np.cumsum(max_scores[::-1])[::-1], [0]])
+
+        # every book of the lists that can add the most is scored
+        scores = np.zeros(self.num_books, dtype=np.float32)
+        matched = np.zeros(self.num_books, dtype=bool)
+        threshold = -np.inf
+        i = 0
+        while i < len(terms) and remaining[i] >= threshold:
+            term_id, count = terms[i]
+            doc_ids, term_scores = self._decode_term(term_id)
+            scores[doc_ids] += count * term_scores
+            matched[doc_ids] = True
+            i += 1
+            # the k-th best score among the books of this list is a lower bound of the final k-th best
+            if len(doc_ids) >= k:
+                threshold = max(threshold, -np.partition(-scores[doc_ids], k - 1)[k - 1])
+
+        candidates = np.flatnonzero(matched)
+        candidate_scores = scores[candidates]
+        keep = candidate_scores + remaining[i] >= threshold
+        candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+
+        # only the candidates can still make the top k, so only their blocks are decoded
+        for term_id, count in terms[i:]:
+            i += 1
+            blocks = self._candidate_blocks(term_id, candidates)
+            keep = candidate_scores + count * self.block_max[blocks] + remaining[i] >= threshold
+            candidates, candidate_scores, blocks = candidates[keep], candidate_scores[keep], blocks[keep]
+            doc_ids, term_scores = self._decode_blocks(term_id, np.unique(blocks))
+            if len(doc_ids):
+                pos = np.minimum(np.searchsorted(doc_ids, candidates), len(doc_ids) - 1)
+                found = doc_ids[pos] == candidates
+                candidate_scores[found] += count * term_scores[pos[found]]
+            if len(candidates) >= k:
+                threshold = max(threshold, -np.partition(-candidate_scores, k - 1)[k - 1])
+                keep = candidate_scores + remaining[i] >= threshold
+                candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+
+        best, best_scores = top_k(candidate_scores, k)
+        return candidates[best], best_scores
+
+    def score_books(self, prompt, book_ids):
+        """Calculates the bm25 score of a few books, only the blocks containing them are decoded.
+
+        Args:
+            prompt (str): a prompt to match to books
+            book_ids (np.ndarray): the positions of the books
+
+        Returns:
+            np.ndarray: one score per book, -inf for books without any term of the prompt
+        """
+        book_ids = np.asarray(book_ids, dtype=np.int64)
+        scores = np.zeros(len(book_ids), dtype=np.float32)
+        matched = np.zeros(len(book_ids), dtype=bool)
+        for term_id, count in self.query_terms(prompt):
+            doc_ids, term_scores = self._decode_blocks(term_id, np.unique(self._candidate_blocks(term_id, book_ids)))
+            if len(doc_ids) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(doc_ids, book_ids), len(doc_ids) - 1)
+            found = doc_ids[pos] == book_ids
+            scores[found] += count * term_scores[pos[found]]
+            matched |= found
+        scores[~matched] = -np.inf
+        return scores
+
+    def _candidate_blocks(self, term_id, book_ids):
+        """Finds the block of a posting list each book would be in.
+
+        Args:
+            term_id (int): the term
+            book_ids (np.ndarray): the sorted positions of the books
+
+        Returns:
+            np.ndarray: the block id of every book
+        """
+        first, last = self.term_blocks[term_id], self.term_blocks[term_id + 1]
+        return first + np.maximum(np.searchsorted(self.block_first[first:last], book_ids, side='right') - 1, 0)
+
+    def _decode_term(self, term_id):
+        return self._decode_blocks(term_id, np.arange(self.term_blocks[term_id], self.term_blocks[term_id + 1]))
+
+    def _decode_blocks(self, term_id, blocks):
+        """Decodes the book ids of some blocks of a posting list and calculates their scores.
+
+        Args:
+            term_id (int): the term
+            blocks (np.ndarray): the sorted block ids, all from the posting list of the term
+
+        Returns:
+            doc_ids (np.ndarray): the sorted positions of the books in the blocks
+            scores (np.ndarray): the bm25 score of the term in each of those books
+        """
+        if len(blocks) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        gaps = decode_varints(self.doc_bytes[_byte_ranges(self.block_doc_offsets, blocks)])
+        tfs = decode_varints(self.tf_bytes[_byte_ranges(self.block_tf_offsets, blocks)])
+
+        # the gaps restart at the first book of every block
+        sizes = self.block_postings[blocks + 1] - self.block_postings[blocks]
+        totals = np.cumsum(gaps)
+        block_offsets = np.repeat(totals[np.cumsum(sizes) - sizes] - self.block_first[blocks], sizes)
+        doc_ids = totals - block_offsets
+        return doc_ids, _bm25(self.idf[term_id], tfs, self.norms[doc_ids], self.k1)
+
+##### Functions #####
+def encode_varints(values):
+    """Encodes non negative integers as varints, 7 bits per byte with the high bit set on every byte
+    except the last byte of a value.
+
+    Args:
+        values (np.ndarray): the integers
+
+    Returns:
+        data (np.ndarray): the encoded bytes as uint8
+        lengths (np.ndarray): the number of bytes of every value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= (np.uint64(1) << np.uint64(shift))
+
+    starts = np.cumsum(lengths) - lengths
+    data = np.empty(int(lengths.sum()), dtype=np.uint8)
+    for i in range(int(lengths.max()) if len(values) else 0):
+        has_byte = lengths > i
+        byte = (values[has_byte] >> np.uint64(7 * i)) & np.uint64(0x7F)
+        more = (lengths[has_byte] > i + 1).astype(np.uint64) << np.uint64(7)
+        data[starts[has_byte] + i] = (byte | more).astype(np.uint8)
+    return data, lengths
+
+def decode_varints(data):
+    """Decodes varints written by encode_varints, all at once with numpy.
+
+    Args:
+        data (np.ndarray): the encoded bytes
+
+    Returns:
+        np.ndarray: the integers as int64
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.empty(0, dtype=np.int64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    value_of_byte = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = 7 * (np.arange(len(data)) - starts[value_of_byte])
+    parts = (data & 0x7F).astype(np.int64) << shifts
+    return np.add.reduceat(parts, starts)
+
+##### Helper Functions #####
+def _bm25(idf, tfs, norms, k1):
+    """Calculates the bm25 score of terms in books.
+
+    Args:
+        idf (np.ndarray): the idf of the term of every posting, or of the one term of all of them
+        tfs (np.ndarray): the number of times the term is in the book
+        norms (np.ndarray): k1 * (1 - b + b * length / average length) of the book
+        k1 (float): the term frequency saturation
+
+    Returns:
+        np.ndarray: the score of every posting as float32
+    """
+    tfs = tfs.astype(np.float32)
+    return (idf * tfs * np.float32(k1 + 1) / (tfs + norms)).astype(np.float32)
+
+def _byte_ranges(offsets, blocks):
+    """Returns the positions of the bytes of some blocks.
+
+    Args:
+        offsets (np.ndarray): the first byte of every block, followed by the end of the last block
+        blocks (np.ndarray): the block ids
+
+    Returns:
+        np.ndarray: the byte positions of the blocks, one block after the other
+    """
+    starts = offsets[blocks]
+    lengths = offsets[blocks + 1] - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
@@ -0,0 +1,197 @@
+# Imports
+import os
+import tempfile
+import time
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# the columns the app displays and searches, reading only these skips every other column on disk
+APP_COLUMNS = ['Title', 'Location', 'Authors', 'Summary', 'extractive_summary', 'abbreviated_summary']
+SUMMARY_COLUMNS = ['Summary', 'extractive_summary', 'abbreviated_summary']
+
+# the type of every known column, every other column is stored as a nullable string
+COLUMN_TYPES = {'rating': pa.float64(), 'num_ratings': pa.int64(),
+                # identifiers that look like numbers are strings, so they keep their exact digits and match in joins
+                'System ID': pa.string(), 'OCLC': pa.string(), 'doc_id': pa.string(), 'url': pa.string()}
+
+##### Functions #####
+def catalog_path(path):
+    """Returns the path of the parquet file that stores a csv or tsv file.
+
+    Args:
+        path (str): the path of the csv, tsv or parquet file
+
+    Returns:
+        str: the path with a .parquet extension
+    """
+    return os.path.splitext(path)[0] + '.parquet'
+
+def import_csv(path, chunksize=100_000):
+    """Converts a csv or tsv file to parquet once. The file is read in chunks and every column gets a
+    fixed type, so a column never changes type between chunks and nothing is guessed on later reads.
+
+    Args:
+        path (str): the path of the csv or tsv file
+        chunksize (int, optional): the number of rows converted at once. Defaults to 100_000.
+
+    Returns:
+        str: the path of the parquet file
+    """
+    parquet_path = catalog_path(path)
+    sep = '\t' if path.endswith('.tsv') else ','
+    columns = pd.read_csv(path, sep=sep, nrows=0).columns
+    schema = catalog_schema(columns)
+
+    tmp_path = _temp_path(parquet_path)
+    try:
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            for chunk in pd.read_csv(path, sep=sep, chunksize=chunksize,
+                                     dtype={col: str for col in columns if schema.field(col).type == pa.string()}):
+                writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        os.replace(tmp_path, parquet_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return parquet_path
+
+def ensure_catalog(path):
+    """Returns the parquet file of a catalog, importing the csv or tsv file first if the parquet file
+    is missing or older than it.
+
+    Args:
+        path (str): the path of the csv, tsv or parquet file
+
+    Returns:
+        str: the path of the up to date parquet file
+    """
+    parquet_path = catalog_path(path)
+    if path != parquet_path and os.path.exists(path):
+        if not os.path.exists(parquet_path) or os.path.getmtime(path) > os.path.getmtime(parquet_path):
+            import_csv(path)
+    if not os.path.exists(parquet_path):
+        raise FileNotFoundError(f"No catalog found at {path} or {parquet_path}")
+    return parquet_path
+
+def read_catalog(path, columns=None, memory_map=True):
+    """Reads a catalog from its parquet file, importing the csv or tsv file the first time.
+
+    Args:
+        path (str): the path of the csv, tsv or parquet file
+        columns (list, optional): the columns to read, the others are never loaded. Defaults to all columns.
+        memory_map (bool, optional): whether the file is memory-mapped instead of read into a buffer. Defaults to True.
+
+    Returns:
+        pd.DataFrame: the catalog
+    """
+    table = pq.read_table(ensure_catalog(path), columns=columns, memory_map=memory_map)
+    return table.to_pandas()
+
+def iter_catalog(path, columns=None, chunksize=100_000):
+    """Reads a catalog in chunks, so only one chunk is in memory at a time.
+
+    Args:
+        path (str): the path of the csv, tsv or parquet file
+        columns (list, optional): the columns to read. Defaults to all columns.
+        chunksize (int, optional): the number of rows per chunk. Defaults to 100_000.
+
+    Yields:
+        pd.DataFrame: the next chunk of the catalog
+    """
+    parquet_file = pq.ParquetFile(ensure_catalog(path), memory_map=True)
+    for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns):
+        yield batch.to_pandas()
+
+def write_catalog(df, path):
+    """Writes a dataframe to a parquet file. The file is written next to the output and renamed over it once complete.
+    String columns read as numbers, e.g. an OCLC column read from a csv without types, are written as strings.
+
+    Args:
+        df (pd.DataFrame): the catalog
+        path (str): the path of the parquet file (a csv or tsv path is changed to .parquet)
+
+    Returns:
+        str: the path of the parquet file
+    """
+    parquet_path = catalog_path(path)
+    schema = catalog_schema(df.columns)
+    df = df.assign(**{col: _as_strings(df[col]) for col in df.columns
+                      if schema.field(col).type == pa.string() and pd.api.types.is_numeric_dtype(df[col])})
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    tmp_path = _temp_path(parquet_path)
+    try:
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, parquet_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return parquet_path
+
+def catalog_schema(columns):
+    """Creates the arrow schema of a catalog.
+
+    Args:
+        columns (list): the column names
+
+    Returns:
+        pa.Schema: the type of every column, strings unless listed in COLUMN_TYPES
+    """
+    return pa.schema([(col, COLUMN_TYPES.get(col, pa.string())) for col in columns])
+
+def benchmark_read(path, columns=APP_COLUMNS, repeats=3):
+    """Compares reading a catalog from its csv file and from its parquet file.
+
+    Args:
+        path (str): the path of the csv or tsv file
+        columns (list, optional): the columns read from parquet. Defaults to APP_COLUMNS.
+        repeats (int, optional): the number of timed reads of each format. Defaults to 3.
+
+    Returns:
+        pd.DataFrame: the best read time of each format in seconds
+    """
+    sep = '\t' if path.endswith('.tsv') else ','
+    parquet_path = ensure_catalog(path)
+    readers = {'csv': lambda: pd.read_csv(path, sep=sep),
+               'parquet': lambda: read_catalog(parquet_path),
+               'parquet (columns)': lambda: read_catalog(parquet_path, columns=columns)}
+
+    results = []
+    for name, read in readers.items():
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            read()
+            times.append(time.perf_counter() - start)
+        results.append({'format': name, 'seconds': min(times)})
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results
+
+##### Helper Functions #####
+def _temp_path(path):
+    """Creates an empty temporary file next to a file. Every writer gets its own, so two processes
+    importing the same catalog never write to the same temporary file.
+
+    Args:
+        path (str): the path of the file that is written
+
+    Returns:
+        str: the path of the temporary file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+def _as_strings(values):
+    """Converts a column of numbers to strings. Whole numbers are written without the .0 that a missing
+    value makes pandas add to an integer column.
+
+    Args:
+        values (pd.Series): the column
+
+    Returns:
+        pd.Series: the column as strings, missing values stay missing
+    """
+    if pd.api.types.is_float_dtype(values) and (values.dropna() % 1 == 0).all():
+        values = values.astype('Int64')
+    return values.astype(str).where(values.notna(), None)
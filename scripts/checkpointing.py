@@ -0,0 +1,321 @@
+# Imports
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from summary_merge import book_keys, content_key, KEY_COLUMNS
+
+MANIFEST_FILENAME = "manifest.json"
+
+# create a class for running long batch jobs that can be restarted
+class ShardedJobRunner:
+
+    def __init__(self, shard_dir, batch_size=100):
+        """Constructor for the ShardedJobRunner class. The results of every batch are written to their own
+        shard file, next to a keys file naming the input rows of the batch. A manifest records each shard and
+        a hash of it, so a restarted job skips every row whose key is in an intact shard. Rows are keyed by
+        the book rather than by position, so adding or removing books does not redo the books after them.
+
+        Args:
+            shard_dir (str): the folder containing the shards and the manifest
+            batch_size (int, optional): the number of rows per batch. Defaults to 100.
+        """
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.row_keys = None
+        os.makedirs(shard_dir, exist_ok=True)
+
+        self.manifest = {'shards': {}}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        # Shards of a manifest that keyed batches by row range are redone
+        self.manifest['shards'] = {name: entry for name, entry in self.manifest['shards'].items() if 'keys' in entry}
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.shard_dir, MANIFEST_FILENAME)
+
+    def run(self, data, process_batch, keys=None):
+        """Processes the rows that are not done yet batch by batch.
+
+        Args:
+            data (pd.DataFrame): the rows to process
+            process_batch (function): takes a batch of rows and returns a dataframe of results, the results
+                keep the index of the rows they come from and may leave rows out
+            keys (pd.Series, optional): the key of every row. Defaults to the book key and content key of
+                every row, so a book whose title or summary changes is processed again.
+
+        Returns:
+            int: the number of batches processed by this run
+        """
+        if keys is None:
+            keys = book_keys(data) + '|' + content_key(data)
+        self.row_keys = keys.tolist()
+        todo = np.flatnonzero(~pd.Series(self.row_keys).isin(self.done_keys()).values)
+
+        num_processed = 0
+        for start in range(0, len(todo), self.batch_size):
+            positions = todo[start:start + self.batch_size]
+            batch = data.iloc[positions]
+            batch_keys = pd.Series([self.row_keys[i] for i in positions], index=batch.index)
+
+            results = process_batch(batch)
+            shard_id = self.manifest.get('next_shard', 0)
+            shard_name = f"shard_{shard_id:09d}.csv"
+            keys_name = f"shard_{shard_id:09d}.keys.json"
+            shard_path = os.path.join(self.shard_dir, shard_name)
+            _atomic_write(os.path.join(self.shard_dir, keys_name),
+                          json.dumps({'inputs': batch_keys.tolist(), 'outputs': batch_keys.loc[results.index].tolist()}))
+            _atomic_write(shard_path, results.to_csv())
+
+            self.manifest['shards'][shard_name] = {'shard': shard_name, 'keys': keys_name,
+                                                   'output_hash': _file_hash(shard_path), 'rows': len(results)}
+            self.manifest['next_shard'] = shard_id + 1
+            _atomic_write(self._manifest_path, json.dumps(self.manifest, indent=1))
+            num_processed += 1
+            print(f"Finished {min(start + self.batch_size, len(todo))} of {len(todo)} rows")
+
+        return num_processed
+
+    def done_keys(self):
+        """Collects the keys of the rows processed by intact shards.
+
+        Returns:
+            set: the key of every row that can be skipped
+        """
+        done = set()
+        for entry in self.manifest['shards'].values():
+            shard_keys = self._read_keys(entry)
+            if shard_keys is not None:
+                done.update(shard_keys['inputs'])
+        return done
+
+    def merge(self, output_path, keys=None):
+        """Merges the results of the given rows, in row order, into one csv file. A row processed by
+        several shards is written once. The merged file is written next to the output and renamed over it once complete.
+        The book identifiers are read back as strings, so they still match the catalog the rows came from.
+
+        Args:
+            output_path (str): the path of the merged csv file
+            keys (list, optional): the keys of the rows to merge. Defaults to the rows of the last run.
+        """
+        position = {}
+        for i, key in enumerate(keys if keys is not None else self.row_keys):
+            position.setdefault(key, i)
+
+        parts, positions = [], []
+        for entry in self.manifest['shards'].values():
+            shard_keys = self._read_keys(entry)
+            if shard_keys is None:
+                continue
+            keep = [i for i, key in enumerate(shard_keys['outputs']) if key in position]
+            if keep:
+                parts.append(pd.read_csv(os.path.join(self.shard_dir, entry['shard']), index_col=0,
+                                         dtype={col: str for col in KEY_COLUMNS}).iloc[keep])
+                positions.extend(position[shard_keys['outputs'][i]] for i in keep)
+
+        merged = pd.concat(parts) if parts else pd.DataFrame()
+        positions = pd.Series(positions)
+        # Keep the latest result of every row
+        merged = merged.iloc[positions[~positions.duplicated(keep='last')].sort_values(kind='stable').index]
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as out:
+                merged.to_csv(out)
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _read_keys(self, entry):
+        """Reads the keys file of a shard if the shard is intact.
+
+        Args:
+            entry (dict): the manifest entry of the shard
+
+        Returns:
+            dict: the keys of the input rows and of the result rows, None if the shard is missing or changed
+        """
+        shard_path = os.path.join(self.shard_dir, entry['shard'])
+        keys_path = os.path.join(self.shard_dir, entry['keys'])
+        if not (os.path.exists(shard_path) and os.path.exists(keys_path)) or _file_hash(shard_path) != entry['output_hash']:
+            return None
+        with open(keys_path, "r") as f:
+            return json.load(f)
+
+
+# create a class for appending rows to a text file in crash-safe batches
+class BufferedRowWriter:
+
+    def __init__(self, path, header=None, flush_every=100, mode='a', on_flush=None, max_row_bytes=1 << 20):
+        """Constructor for the BufferedRowWriter class. Rows are kept in memory and appended every
+        flush_every rows, followed by an fsync, so a crash loses at most the unflushed rows.
+        A partial last line left by an earlier crash is cut off when the file is reopened. A last line
+        longer than any row was not left by a crash, so the file is not opened rather than losing it.
+
+        Args:
+            path (str): the path of the file
+            header (str, optional): the first line of the file, written when the file is new. Defaults to None.
+            flush_every (int, optional): the number of rows written at once. Defaults to 100.
+            mode (str, optional): 'a' to append to an existing file or 'w' to start from scratch. Defaults to 'a'.
+            on_flush (function, optional): called after every flush, once the rows are on disk. Defaults to None.
+            max_row_bytes (int, optional): the longest partial line that is cut off. Defaults to 1 MiB.
+        """
+        self.path = path
+        self.flush_every = flush_every
+        self.on_flush = on_flush
+        self.rows = []
+
+        if mode == 'a' and os.path.exists(path):
+            _truncate_partial_line(path, max_row_bytes)
+        if mode == 'w' or not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "w") as f:
+                if header is not None:
+                    f.write(header.rstrip("\n") + "\n")
+        self.file = open(path, "a")
+
+    def write(self, row):
+        """Adds one row, flushing if enough rows are buffered.
+
+        Args:
+            row (str): the row, without the trailing newline
+        """
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Appends the buffered rows to the file and fsyncs it.
+        """
+        if self.rows:
+            self.file.write("".join(row + "\n" for row in self.rows))
+            self.rows = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# create a class for recording which items of a long job are done
+class ProgressBitmap:
+
+    def __init__(self, path):
+        """Constructor for the ProgressBitmap class. Bit i is set once item i is done. The bitmap is kept
+        in memory and saved atomically, one bit per item keeps the file small for any number of items.
+
+        Args:
+            path (str): the path of the bitmap file, it is loaded if it exists
+        """
+        self.path = path
+        self.bits = bytearray()
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.bits = bytearray(f.read())
+
+    def add(self, i):
+        """Marks item i as done.
+
+        Args:
+            i (int): the index of the item
+        """
+        byte = i >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        self.bits[byte] |= 1 << (i & 7)
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+    def __len__(self):
+        return sum(bin(byte).count("1") for byte in self.bits)
+
+    def save(self):
+        """Saves the bitmap, replacing the previous file only once the new one is complete.
+        """
+        _atomic_write(self.path, bytes(self.bits))
+
+    def clear(self):
+        """Marks every item as not done and deletes the saved bitmap.
+        """
+        self.bits = bytearray()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+##### Helper Functions #####
+def _atomic_write(path, text):
+    """Writes a file by writing a temporary file and renaming it, so the file is never half written.
+    Every write gets its own temporary file, so concurrent writers never share one.
+
+    Args:
+        path (str): the path of the file
+        text (str or bytes): the content of the file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb" if isinstance(text, bytes) else "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _file_hash(path):
+    """Calculates the sha1 of a file.
+
+    Args:
+        path (str): the path of the file
+
+    Returns:
+        str: the hex digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def _truncate_partial_line(path, max_bytes):
+    """Cuts off the last line of a file if it does not end with a newline, which happens when a
+    write was interrupted.
+
+    Args:
+        path (str): the path of the file
+        max_bytes (int): the longest partial line that is cut off, a longer one raises a ValueError
+    """
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        position = end
+        while position > 0 and end - position <= max_bytes:
+            step = min(1 << 16, position)
+            f.seek(position - step)
+            block = f.read(step)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = position - step + newline + 1
+                break
+            position -= step
+        if end - position > max_bytes:
+            raise ValueError(f"{path} ends with more than {max_bytes} bytes without a newline, "
+                             "which is more than one row, so it is not cut off")
+        if position != end:
+            f.truncate(position)
@@ -1,21 +1,33 @@
 # Imports
 import os
+import tempfile
 import time
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
+import unicodedata
+from lxml import etree
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.options import Options
-import time
-import unicodedata
+from async_fetcher import crawl, parse_html
+from checkpointing import BufferedRowWriter, ProgressBitmap
 
 # Constants
-DPL_SEARCH_RESULTS_URL = "https://durhamcounty.bibliocommons.com/v2/search?custom_edit=false&query=isolanguage%3A%22eng%22%20audience%3A%22adult%22%20formatcode%3A(BK%20)&searchType=bl&suppress=true"
 URL_PREFIX = "https://durhamcounty.bibliocommons.com"
+DPL_SEARCH_PATH = "/v2/search?custom_edit=false&query=isolanguage%3A%22eng%22%20audience%3A%22adult%22%20formatcode%3A(BK%20)&searchType=bl&suppress=true"
+DPL_SEARCH_RESULTS_URL = URL_PREFIX + DPL_SEARCH_PATH
 DATA_FOLDER = os.path.join('..', 'data')
 
 TITLE_JARGON = {'Read', 'an', 'excerpt', 'from', 'an', 'overlay', 'opens'}
+TSV_HEADER = "title\tauthor\trating\tnum_ratings\tdescription\turl\n"
+
+# the bib pages are rendered on the server, so the elements read through Selenium are already in the html
+SEARCH_RESULT_XPATH = etree.XPath("//h2[@class='cp-title']//a[1]/@href")
+BIB_XPATHS = {
+    'title': etree.XPath("(//div[@class='cp-bib-title']//span[@class='cp-screen-reader-message'])[1]"),
+    'author': etree.XPath("(//div[@class='cp-author-link']//span[@class='cp-screen-reader-message'])[1]"),
+    'rating': etree.XPath("(//span[@class='cp-rating-stars rating-stars']/span[@class='cp-screen-reader-message'])[1]"),
+    'description': etree.XPath("(//div[@class='cp-bib-description']//div[@class='expandable-html__text'])[1]"),
+}
+BLOCK_TAGS = {'br', 'p', 'div', 'li'}
 
 #############
 # FUNCTIONS #
@@ -62,79 +74,373 @@ def get_urls_to_scrape(start_page=0, end_page=10_000):
         if(current_page % 100 == 0):
             print(f"Extracted {current_page*10} urls")
 
-def scrape_from_urls(starting_idx = 0, save_file_path=os.path.join(DATA_FOLDER, 'dpl_book_data.tsv'), save_mode='w'):
-    """Scrapes the individual book data from the urls stored in book_urls.txt. 
+def scrape_from_urls(starting_idx = 0, save_file_path=os.path.join(DATA_FOLDER, 'dpl_book_data.tsv'), save_mode='a',
+                     urls_path=os.path.join(DATA_FOLDER, 'dpl_book_urls.txt'), flush_every=100):
+    """Scrapes the individual book data from the urls stored in dpl_book_urls.txt. 
     This includes information such as the title, author, rating, description, and subjects/genres.
+    The indices of the scraped urls are recorded in a progress file next to the tsv, so a restarted
+    run in append mode skips them, as well as any url already in the tsv.
 
     Args:
-        save_mode (str, optional): Either 'a' for append or 'w' for write from scratch. Defaults to 'w'.
         starting_idx (int, optional): Starting url index. Defaults to 0.
-        save_file_path (str, optional): Path to the tsv for storing data. Defaults to '../data/book_data.csv'.
+        save_file_path (str, optional): Path to the tsv for storing data. Defaults to '../data/dpl_book_data.tsv'.
+        save_mode (str, optional): Either 'a' to resume or 'w' for write from scratch. Defaults to 'a'.
+        urls_path (str, optional): the file with one book url per line. Defaults to ../data/dpl_book_urls.txt.
+        flush_every (int, optional): the number of rows written to the tsv at once. Defaults to 100.
     """
-    # Load the data from the txt file
-    with(open(os.path.join(DATA_FOLDER, 'dpl_book_urls.txt'), 'r')) as f:
-        urls = f.readlines()
-        
-    # Add headers to the tsv file
-    if(save_mode == 'w'):
-        with(open(save_file_path, 'w')) as f:
-            f.write("title\tauthor\trating\tnum_ratings\tdescription\turl\n")
+    writer, progress = _open_scrape_output(save_file_path, save_mode, flush_every, urls_path)
         
     # Initialize the webdriver
-    options = Options().add_argument("--headless")
-    driver = webdriver.Chrome(options=options)
+    driver = _make_driver()
         
     # Loop through the urls and scrape from each one
-    for i in range(starting_idx, len(urls)):
-        # Make request to the url and extract the html content
-        url = urls[i]
-        try:
-            driver.get(url)
-        except:
-            continue # Not worth the hassle if url has issues, just skip it and move on
-        
-        # Expand the description if possible
-        try:
-            read_more_element = driver.find_element(By.XPATH, "//a[@class='cp-link cp-expand-link expandable-html__expand-button']")
-            read_more_element.click()
-        except:
-            pass # Button may not exist and thats fine
-        
-        try:
-            # Extract Title
-            title = driver.find_element(By.XPATH, "//div[@class='cp-bib-title']//span[@class='cp-screen-reader-message']").text
-            title = ' '.join([word for word in title.split() if word not in TITLE_JARGON])
-            if(title[-1] == ','):
-                title = title[:-1]
-            
-            # Extract Author
-            author = driver.find_element(By.XPATH, "//div[@class='cp-author-link']//span[@class='cp-screen-reader-message']").text
+    with writer:
+        for i, url in _iter_urls_to_scrape(urls_path, save_file_path, progress, starting_idx):
+            record = _scrape_with_driver(driver, url)
+            if record is None:
+                continue
 
-            # Extract Rating
-            rating_text = driver.find_element(By.XPATH, "//span[@class='cp-rating-stars rating-stars']/span[@class='cp-screen-reader-message']").text
-            rating  = float(rating_text.split()[2])
-            num_ratings = int(rating_text.split()[-2].replace(',', ''))
-            
-            # Extract Description
-            description = driver.find_element(By.XPATH, "//div[@class='cp-bib-description']//div[@class='expandable-html__text']").text
-            description = description.replace('\n', ' ')
-            
             # Append the results to the tsv file
-            string_to_save = f"{title}\t{author}\t{rating}\t{num_ratings}\t{description}\t{url}"
-            string_to_save = _strip_accents_from_str(string_to_save)
+            writer.write(_format_row(record, url))
+            progress.add(i)
             
-            with(open(save_file_path, 'a')) as f:
-                f.write(string_to_save)
-        except:
-            continue
-            
-        # Print updates periodically
+            # Print updates periodically
+            if(i % 100 == 0):
+                print(f"Scraped {i} books")
+
+def get_urls_to_scrape_http(start_page=0, end_page=10_000, filename=os.path.join(DATA_FOLDER, 'dpl_book_urls.txt'),
+                            base_url=URL_PREFIX, **fetcher_kwargs):
+    """Obtains the urls to the books like get_urls_to_scrape, but fetches the search result pages directly
+    over HTTP instead of driving a browser. Pages are fetched concurrently and the urls are appended in page order.
+
+    Args:
+        start_page (int, optional): Starting page of the search results. Defaults to 0.
+        end_page (int, optional): Ending page of the search results. Defaults to 10_000.
+        filename (str, optional): the file the urls are appended to. Defaults to ../data/dpl_book_urls.txt.
+        base_url (str, optional): the url of the catalog, a FixtureServer url can be used offline. Defaults to URL_PREFIX.
+        fetcher_kwargs: arguments for AsyncFetcher, e.g. max_concurrency or requests_per_second
+
+    Returns:
+        failed_pages (list): the pages that could not be fetched
+    """
+    search_urls = [base_url + DPL_SEARCH_PATH + f"&page={page}" for page in range(start_page, end_page)]
+    pages = {}
+    failed_pages = []
+    next_index = 0
+
+    def on_result(index, url, urls):
+        nonlocal next_index
+        if urls is None:
+            failed_pages.append(start_page + index)
+        pages[index] = urls or []
+
+        # Write the finished pages that are next in order
+        urls_to_save = []
+        while next_index in pages:
+            urls_to_save.extend(pages.pop(next_index))
+            next_index += 1
+        if urls_to_save:
+            _append_to_csv_file(urls_to_save, filename=filename)
+
+    crawl(search_urls, _parse_search_page, on_result, **fetcher_kwargs)
+    return sorted(failed_pages)
+
+def scrape_from_urls_http(urls_path=os.path.join(DATA_FOLDER, 'dpl_book_urls.txt'),
+                          save_file_path=os.path.join(DATA_FOLDER, 'dpl_book_data.tsv'), save_mode='a',
+                          base_url=URL_PREFIX, use_selenium_fallback=True, flush_every=100, **fetcher_kwargs):
+    """Scrapes the individual book data like scrape_from_urls, but fetches the bib pages directly over HTTP
+    and parses them with lxml in worker processes. Pages that cannot be fetched or parsed are retried
+    with Selenium if use_selenium_fallback is set. Rows are written in the order pages finish, and
+    progress is recorded the same way as scrape_from_urls so either one can resume the other.
+
+    Args:
+        urls_path (str, optional): the file with one book url per line. Defaults to ../data/dpl_book_urls.txt.
+        save_file_path (str, optional): Path to the tsv for storing data. Defaults to ../data/dpl_book_data.tsv.
+        save_mode (str, optional): Either 'a' to resume or 'w' for write from scratch. Defaults to 'a'.
+        base_url (str, optional): replaces URL_PREFIX in the urls, a FixtureServer url can be used offline. Defaults to URL_PREFIX.
+        use_selenium_fallback (bool, optional): whether failed pages are retried with Selenium. Defaults to True.
+        flush_every (int, optional): the number of rows written to the tsv at once. Defaults to 100.
+        fetcher_kwargs: arguments for AsyncFetcher, e.g. max_concurrency or requests_per_second
+
+    Returns:
+        failed_urls (list): the urls that could not be scraped
+    """
+    writer, progress = _open_scrape_output(save_file_path, save_mode, flush_every, urls_path)
+    failed = []
+    in_flight = {}
+
+    def fetch_urls():
+        # Stream the urls, remembering the line of each one until its page is done
+        for fetch_index, (i, url) in enumerate(_iter_urls_to_scrape(urls_path, save_file_path, progress)):
+            in_flight[fetch_index] = (i, url)
+            yield base_url + url[len(URL_PREFIX):] if url.startswith(URL_PREFIX) else url
+
+    def on_result(fetch_index, fetch_url, record):
+        i, url = in_flight.pop(fetch_index)
+        if record is None:
+            failed.append((i, url))
+            return
+        writer.write(_format_row(record, url))
+        progress.add(i)
         if(i % 100 == 0):
             print(f"Scraped {i} books")
+
+    with writer:
+        crawl(fetch_urls(), _parse_bib_page, on_result, **fetcher_kwargs)
+
+        # Fall back to the browser for the pages the HTTP mode could not handle
+        if use_selenium_fallback and failed:
+            print(f"Retrying {len(failed)} books with Selenium")
+            driver = _make_driver()
+            try:
+                retry, failed = failed, []
+                for i, url in retry:
+                    record = _scrape_with_driver(driver, url)
+                    if record is None:
+                        failed.append((i, url))
+                    else:
+                        writer.write(_format_row(record, url))
+                        progress.add(i)
+            finally:
+                driver.quit()
+
+    return [url for i, url in failed]
             
 ####################
 # HELPER FUNCTIONS #
 ####################
+def _open_scrape_output(save_file_path, save_mode, flush_every, urls_path):
+    """Opens the tsv of scraped books and the progress bitmap of the urls scraped into it.
+    A tsv written by an earlier version without newlines between the rows is split into lines first.
+
+    Args:
+        save_file_path (str): Path to the tsv for storing data.
+        save_mode (str): Either 'a' to resume or 'w' for write from scratch.
+        flush_every (int): the number of rows written to the tsv at once.
+        urls_path (str): the file with one book url per line
+
+    Returns:
+        writer (BufferedRowWriter): appends rows to the tsv and saves the progress after every flush
+        progress (ProgressBitmap): the indices of the urls already scraped
+    """
+    progress = ProgressBitmap(save_file_path + '.progress')
+    if(save_mode == 'w'):
+        progress.clear()
+    elif os.path.exists(save_file_path):
+        _split_legacy_rows(save_file_path, urls_path)
+    writer = BufferedRowWriter(save_file_path, header=TSV_HEADER, flush_every=flush_every, mode=save_mode,
+                               on_flush=progress.save)
+    return writer, progress
+
+def _split_legacy_rows(save_file_path, urls_path):
+    """Rewrites a tsv with several rows on one line, as the first version of scrape_from_urls wrote
+    them whenever a url had no trailing newline, with one row per line. A row ends with its url, and
+    the title of the next row follows it directly, so the two are told apart with the urls file. An
+    unfinished last row is dropped. The tsv is replaced only once the rewritten file is complete.
+
+    Args:
+        save_file_path (str): Path to the tsv of scraped books
+        urls_path (str): the file with one book url per line
+    """
+    num_fields = TSV_HEADER.count('\t') + 1
+    with(open(save_file_path, 'r')) as f:
+        next(f, None)
+        if all(line.count('\t') < num_fields for line in f):
+            return
+
+    with(open(urls_path, 'r')) as f:
+        urls = {url.strip() for url in f if url.strip()}
+    url_lengths = sorted({len(url) for url in urls}, reverse=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(save_file_path)), suffix='.tmp')
+    try:
+        with(open(save_file_path, 'r')) as f, os.fdopen(fd, 'w') as out:
+            out.write(next(f, TSV_HEADER))
+            for line in f:
+                if line.count('\t') < num_fields:
+                    out.write(line)
+                    continue
+                row = []
+                for field in line.rstrip('\n').split('\t'):
+                    if len(row) < num_fields - 1:
+                        row.append(field)
+                        continue
+                    # the last field of a row is its url, followed by the title of the next row
+                    url = next((field[:length] for length in url_lengths if field[:length] in urls), None)
+                    if url is None:
+                        raise ValueError(f"Cannot find where the row of {field[:100]!r} ends in {save_file_path}, "
+                                         f"its url is not in {urls_path}")
+                    out.write('\t'.join(row + [url]) + '\n')
+                    row = [field[len(url):]] if field[len(url):] else []
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, save_file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _iter_urls_to_scrape(urls_path, save_file_path, progress, starting_idx=0):
+    """Streams the urls that still need to be scraped. Urls whose index is in the progress bitmap,
+    urls already in the tsv (e.g. rows flushed just before a crash) and repeated urls are skipped.
+
+    Args:
+        urls_path (str): the file with one book url per line
+        save_file_path (str): Path to the tsv of scraped books
+        progress (ProgressBitmap): the indices of the urls already scraped
+        starting_idx (int, optional): Starting url index. Defaults to 0.
+
+    Yields:
+        (int, str): the index of the url in the file and the url
+    """
+    seen_urls = set()
+    if os.path.exists(save_file_path):
+        with(open(save_file_path, 'r')) as f:
+            next(f, None)
+            for line in f:
+                seen_urls.add(line.rstrip('\n').rsplit('\t', 1)[-1])
+
+    with(open(urls_path, 'r')) as f:
+        for i, url in enumerate(f):
+            url = url.strip()
+            if i < starting_idx or not url or i in progress:
+                continue
+            if url in seen_urls:
+                progress.add(i)
+                continue
+            seen_urls.add(url)
+            yield i, url
+
+def _make_driver():
+    """Creates a headless Chrome webdriver.
+
+    Returns:
+        webdriver: Selenium webdriver object to handle the browser.
+    """
+    options = Options()
+    options.add_argument("--headless")
+    return webdriver.Chrome(options=options)
+
+def _scrape_with_driver(driver, url):
+    """Scrapes the data of one book with the browser.
+
+    Args:
+        driver (webdriver): Selenium webdriver object to handle the browser.
+        url (str): the url of the book
+
+    Returns:
+        record (dict): the title, author, rating, num_ratings and description, or None if the page could not be scraped
+    """
+    try:
+        driver.get(url)
+    except:
+        return None # Not worth the hassle if url has issues, just skip it and move on
+
+    # Expand the description if possible
+    try:
+        read_more_element = driver.find_element(By.XPATH, "//a[@class='cp-link cp-expand-link expandable-html__expand-button']")
+        read_more_element.click()
+    except:
+        pass # Button may not exist and thats fine
+
+    try:
+        return _make_record(
+            title=driver.find_element(By.XPATH, "//div[@class='cp-bib-title']//span[@class='cp-screen-reader-message']").text,
+            author=driver.find_element(By.XPATH, "//div[@class='cp-author-link']//span[@class='cp-screen-reader-message']").text,
+            rating_text=driver.find_element(By.XPATH, "//span[@class='cp-rating-stars rating-stars']/span[@class='cp-screen-reader-message']").text,
+            description=driver.find_element(By.XPATH, "//div[@class='cp-bib-description']//div[@class='expandable-html__text']").text)
+    except:
+        return None
+
+def _make_record(title, author, rating_text, description):
+    """Cleans the text scraped from a bib page into a record.
+
+    Args:
+        title (str): the screen reader text of the title
+        author (str): the screen reader text of the author
+        rating_text (str): the screen reader text of the rating stars
+        description (str): the text of the description
+
+    Returns:
+        record (dict): the title, author, rating, num_ratings and description
+    """
+    # Extract Title
+    title = ' '.join([word for word in title.split() if word not in TITLE_JARGON])
+    if(title[-1] == ','):
+        title = title[:-1]
+
+    # Extract Rating
+    rating = float(rating_text.split()[2])
+    num_ratings = int(rating_text.split()[-2].replace(',', ''))
+
+    # Extract Description
+    description = description.replace('\n', ' ')
+    return {'title': title, 'author': author, 'rating': rating, 'num_ratings': num_ratings, 'description': description}
+
+def _format_row(record, url):
+    """Formats a record as a line of the tsv file, without the trailing newline.
+
+    Args:
+        record (dict): the title, author, rating, num_ratings and description of the book
+        url (str): the url of the book
+
+    Returns:
+        string_to_save (str): the tab separated row
+    """
+    string_to_save = f"{record['title']}\t{record['author']}\t{record['rating']}\t{record['num_ratings']}\t{record['description']}\t{url.strip()}"
+    return _strip_accents_from_str(string_to_save)
+
+def _element_text(element):
+    """Returns the text of an element with line breaks between blocks, like the text Selenium reads.
+
+    Args:
+        element: an lxml element
+
+    Returns:
+        str: the text of the element
+    """
+    for child in element.iter():
+        if child is not element and child.tag in BLOCK_TAGS:
+            child.tail = "\n" + (child.tail or "")
+    lines = (' '.join(line.split()) for line in element.text_content().split("\n"))
+    return "\n".join(line for line in lines if line)
+
+def _parse_search_page(content):
+    """Parses the urls of the books on a search result page.
+
+    Args:
+        content (bytes): the html of the page
+
+    Returns:
+        urls (list): the absolute urls of the books on the page
+    """
+    root = parse_html(content)
+    if root is None:
+        return []
+    return [href if href.startswith('http') else URL_PREFIX + href for href in SEARCH_RESULT_XPATH(root)]
+
+def _parse_bib_page(content):
+    """Parses the data of one book from its bib page.
+
+    Args:
+        content (bytes): the html of the page
+
+    Returns:
+        record (dict): the title, author, rating, num_ratings and description, or None if the page could not be parsed
+    """
+    root = parse_html(content)
+    if root is None:
+        return None
+    elements = {field: xpath(root) for field, xpath in BIB_XPATHS.items()}
+    if not all(elements.values()):
+        return None
+    try:
+        return _make_record(title=_element_text(elements['title'][0]), author=_element_text(elements['author'][0]),
+                            rating_text=_element_text(elements['rating'][0]),
+                            description=_element_text(elements['description'][0]))
+    except (IndexError, ValueError):
+        return None
+
 def _scroll_down(driver, pause_time=0.5):
     """Scrolls from the top of the page to the bottom of the page. This is used to load all of the books on the page.
 
@@ -224,8 +530,6 @@ if __name__ == "__main__":
     #print(f"Scraping the urls starting from page {start_page} to page {end_page}. This may take a long time...")
     #get_urls_to_scrape(start_page=start_page, end_page=end_page)
     
-    # Scrape the individual book data from the urls
-    start_url_idx = 333
-    save_mode = 'a'
+    # Scrape the individual book data from the urls, a restarted run resumes where the last one stopped
     print("Scraping the individual book data from the urls. This may take a long time...")
-    scrape_from_urls(starting_idx=start_url_idx, save_mode=save_mode, save_file_path=os.path.join(DATA_FOLDER, 'dpl_book_data.tsv'))
\ No newline at end of file
+    scrape_from_urls_http(save_mode='a', save_file_path=os.path.join(DATA_FOLDER, 'dpl_book_data.tsv'))
\ No newline at end of file
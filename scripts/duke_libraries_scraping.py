@@ -1,13 +1,57 @@
+import glob
+import os
+import time
 import requests
 import pandas as pd
 from bs4 import BeautifulSoup
-import tensorflow as tf
-import numpy as np
-from tensorflow.keras import layers
+from lxml import etree
+from async_fetcher import crawl, parse_html
+
+DUKE_URL = 'https://find.library.duke.edu'
+SEARCH_PATH = '/?f%5Bresource_type_f%5D%5B%5D=Book&page={page}&per_page=100'
+CATALOG_PATH = '/catalog/{doc_id}'
+BOOK_COLUMNS = ['Title', 'Location', 'Authors','Summary','Published','Language','System Details',
+                'Notes','Description','Description Details','Genre','OCLC','Other Identifiers',
+                'System ID']
+
+
+def _has_class(css_class):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {css_class} ')"
+
+def _meta_field(css_class):
+    return f"string(((//dl[{_has_class('document-metadata')}])[1]//dd[{_has_class(css_class)}])[1])"
+
+# compiled xpath of every column, each one selects the same element the original BeautifulSoup lookups did
+BOOK_FIELDS = {
+    'Title': "string((//title)[1])",
+    'Location': f"string((//span[{_has_class('loc_b__DOCS')}])[1])",
+    'Authors': "string(((//div[@id='authors'])[1]//a)[1])",
+    'Summary': "string(((//section[@id='summary'])[1]//p)[1])",
+    'Published': _meta_field('blacklight-imprint_main_a'),
+    'Language': _meta_field('blacklight-language_a'),
+    'System Details': _meta_field('blacklight-note_system_details_a'),
+    'Notes': _meta_field('blacklight-note_general_a'),
+    'Description': _meta_field('blacklight-physical_description_a'),
+    'Description Details': _meta_field('blacklight-physical_description_details_a'),
+    'Genre': _meta_field('blacklight-genre_headings_a'),
+    'OCLC': _meta_field('blacklight-oclc_number'),
+    'Other Identifiers': _meta_field('blacklight-misc_id_a'),
+    'System ID': _meta_field('blacklight-local_id'),
+}
+BOOK_FIELD_XPATHS = {column: etree.XPath(path) for column, path in BOOK_FIELDS.items()}
+DOC_ID_XPATH = etree.XPath(f"//h3[{_has_class('index_title')}]/@id")
 
 # create class for scraping
 class DukeLibrariesScraper:
 
+    def __init__(self, base_url=DUKE_URL):
+        """Constructor for the DukeLibrariesScraper class
+
+        Args:
+            base_url (str, optional): the url of the catalog, a FixtureServer url can be used offline. Defaults to DUKE_URL.
+        """
+        self.base_url = base_url
+
     def save_doc_ids(self,pages,filename):
         """Saves the ids of the books in the Duke Libraries catalog to a csv file.
         The ids will be used to scrape the book details from the Duke Libraries catalog later
@@ -19,25 +63,18 @@ class DukeLibrariesScraper:
         Returns:
             doc_ids (list): a list of the ids of the books in the Duke Libraries catalog
         """
-        url = 'https://find.library.duke.edu/?f%5Bresource_type_f%5D%5B%5D=Book&page='
-        perPage = '&per_page=100'
-        
         doc_ids = []
-        for page in range(101,pages+1):
-            duke_url = url + str(page) + perPage
-            results = requests.get(duke_url)
-            soup = BeautifulSoup(results.content, "html.parser")
-            h3_tags = soup.find_all('h3', class_='index_title')
-            for h3_tag in h3_tags:
-                id_value = h3_tag.get('id').split('-')[0]
-                doc_ids.append(id_value)
-            if page % 1000 == 0:
-                df = pd.DataFrame({'doc_id': doc_ids})
-                df.to_csv(filename, mode='a', header=False, index=False)
-                df = []
-                
+        with requests.Session() as session:
+            for page in range(101,pages+1):
+                results = session.get(self.base_url + SEARCH_PATH.format(page=page))
+                doc_ids.extend(_parse_doc_ids(results.content))
+                if page % 1000 == 0:
+                    df = pd.DataFrame({'doc_id': doc_ids})
+                    df.to_csv(filename, mode='a', header=False, index=False)
+                    df = []
+
         return doc_ids
-    
+
     def save_book_details(self,doc_ids,filename):
         """Save the details of the books in the Duke Libraries catalog to a csv file.
         This includes the title, authors, summary, genre, and other metadata.
@@ -46,59 +83,197 @@ class DukeLibrariesScraper:
             doc_ids (list): a list of the ids of the books in the Duke Libraries catalog
             filename (str): the name of the file to save the book details to
         """
-        # create an empty book dataframe with column names
-        df = pd.DataFrame(columns=['Title', 'Location', 'Authors','Summary','Published','Language','System Details',
-                           'Notes','Description','Description Details','Genre','OCLC','Other Identifiers',
-                           'System ID'])
-
-        for id in doc_ids['doc_id']:
-            url = 'https://find.library.duke.edu/catalog/' + id
-            results = requests.get(url)
-            soup = BeautifulSoup(results.content, "html.parser")
-
-            title = soup.find('title').text.strip() if soup.find('title') else ''
-            location = soup.find('span', {'class': 'loc_b__DOCS'})
-            location_text = location.text.strip() if location else ''
-            authors_section = soup.find('div', {'id': 'authors'})
-            authors = authors_section.find('a').text.strip() if authors_section and authors_section.find('a') else ''
-            summary_section = soup.find('section', {'id': 'summary'})
-            summary = summary_section.find('p').text.strip() if summary_section and summary_section.find('p') else ''
-            meta_data = soup.find('dl', {'class': 'document-metadata'})
-            published = meta_data.find('dd', {'class':'blacklight-imprint_main_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-imprint_main_a'}) else ''
-            language = meta_data.find('dd', {'class':'blacklight-language_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-language_a'}) else ''
-            system_details = meta_data.find('dd', {'class':'blacklight-note_system_details_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-note_system_details_a'}) else ''
-            notes = meta_data.find('dd', {'class':'blacklight-note_general_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-note_general_a'}) else ''
-            description = meta_data.find('dd', {'class':'blacklight-physical_description_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-physical_description_a'}) else ''
-            description_details = meta_data.find('dd', {'class':'blacklight-physical_description_details_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-physical_description_details_a'}) else ''
-            genre = meta_data.find('dd', {'class':'blacklight-genre_headings_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-genre_headings_a'}) else ''
-            oclc = meta_data.find('dd', {'class':'blacklight-oclc_number'}).text.strip() if meta_data.find('dd', {'class':'blacklight-oclc_number'}) else ''
-            other_identifiers = meta_data.find('dd', {'class':'blacklight-misc_id_a'}).text.strip() if meta_data.find('dd', {'class':'blacklight-misc_id_a'}) else ''
-            system_id = meta_data.find('dd', {'class':'blacklight-local_id'}).text.strip() if meta_data.find('dd', {'class':'blacklight-local_id'}) else ''
-
-            df = df.append({'Title':title, 'Location':location_text, 'Authors':authors,'Summary':summary,'Published':published,
-                            'Language':language,'System Details':system_details,'Notes':notes,'Description':description,
-                            'Description Details':description_details,'Genre':genre,'OCLC':oclc,
-                            'Other Identifiers':other_identifiers,'System ID':system_id}, ignore_index=True)
-            if len(df) % 1000 == 0:
-              df.to_csv(filename, mode='a', header=False, index=False)
-              df = pd.DataFrame(columns=['Title', 'Location', 'Authors','Summary','Published','Language','System Details',
-                           'Notes','Description','Description Details','Genre','OCLC','Other Identifiers',
-                           'System ID'])
-    
-
-    
+        records = []
+        with requests.Session() as session:
+            for id in doc_ids['doc_id']:
+                results = session.get(self.base_url + CATALOG_PATH.format(doc_id=id))
+                records.append(_parse_book_details(results.content))
+                if len(records) % 1000 == 0:
+                    _write_records(records, filename)
+                    records = []
+        if records:
+            _write_records(records, filename)
+
+    def save_doc_ids_async(self, start_page, end_page, filename, num_parse_workers=None, **fetcher_kwargs):
+        """Saves the ids of the books on the search result pages start_page to end_page to a csv file.
+        Pages are fetched concurrently over pooled connections and parsed in worker processes.
+        Ids are appended to the file in page order.
+
+        Args:
+            start_page (int): the first page to scrape
+            end_page (int): the last page to scrape
+            filename (str): the name of the file to save the ids to
+            num_parse_workers (int, optional): the number of parsing processes. Defaults to the number of CPUs.
+            fetcher_kwargs: arguments for AsyncFetcher, e.g. max_concurrency or requests_per_second
+
+        Returns:
+            failed_pages (list): the pages that could not be fetched
+        """
+        urls = [self.base_url + SEARCH_PATH.format(page=page) for page in range(start_page, end_page + 1)]
+        pages = {}
+        failed_pages = []
+        next_index = 0
+
+        def on_result(index, url, doc_ids):
+            nonlocal next_index
+            if doc_ids is None:
+                failed_pages.append(start_page + index)
+            pages[index] = doc_ids or []
+
+            # Write the finished pages that are next in order
+            rows = []
+            while next_index in pages:
+                rows.extend(pages.pop(next_index))
+                next_index += 1
+            if rows:
+                pd.DataFrame({'doc_id': rows}).to_csv(filename, mode='a', header=False, index=False)
+
+        crawl(urls, _parse_doc_ids, on_result, num_parse_workers, **fetcher_kwargs)
+        return sorted(failed_pages)
+
+    def save_book_details_async(self, doc_ids, filename, flush_every=1000, num_parse_workers=None, **fetcher_kwargs):
+        """Saves the details of the books to a csv file like save_book_details, but the pages are fetched
+        concurrently over pooled connections and parsed in worker processes. Rows are written in the
+        order pages finish.
+
+        Args:
+            doc_ids (pd.DataFrame): a dataframe with the ids of the books in a doc_id column
+            filename (str): the name of the file to save the book details to
+            flush_every (int, optional): the number of books written to the file at once. Defaults to 1000.
+            num_parse_workers (int, optional): the number of parsing processes. Defaults to the number of CPUs.
+            fetcher_kwargs: arguments for AsyncFetcher, e.g. max_concurrency or requests_per_second
+
+        Returns:
+            failed_ids (list): the ids of the books that could not be fetched
+        """
+        ids = list(doc_ids['doc_id'])
+        urls = [self.base_url + CATALOG_PATH.format(doc_id=doc_id) for doc_id in ids]
+        records = []
+        failed_ids = []
+
+        def on_result(index, url, record):
+            if record is None:
+                failed_ids.append(ids[index])
+                return
+            records.append(record)
+            if len(records) >= flush_every:
+                _write_records(records, filename)
+                records.clear()
+
+        crawl(urls, _parse_book_details, on_result, num_parse_workers, **fetcher_kwargs)
+        if records:
+            _write_records(records, filename)
+        return failed_ids
+
+##### Helper Functions #####
+def _write_records(records, filename):
+    """Appends book records to a csv file. The records are turned into one list per column first,
+    which is much cheaper than building the dataframe row by row.
+
+    Args:
+        records (list): dicts with the value of every column in BOOK_COLUMNS
+        filename (str): the name of the csv file
+    """
+    columns = {column: [record[column] for record in records] for column in BOOK_COLUMNS}
+    pd.DataFrame(columns, columns=BOOK_COLUMNS).to_csv(filename, mode='a', header=False, index=False)
+
+def _parse_doc_ids(content):
+    """Parses the ids of the books on a search result page.
+
+    Args:
+        content (bytes): the html of the page
+
+    Returns:
+        list: the ids of the books on the page
+    """
+    root = parse_html(content)
+    return [] if root is None else [id_value.split('-')[0] for id_value in DOC_ID_XPATH(root)]
+
+def _parse_book_details(content):
+    """Parses the details of a book from its catalog page by evaluating the compiled BOOK_FIELD_XPATHS
+    on a single lxml tree.
+
+    Args:
+        content (bytes): the html of the page
+
+    Returns:
+        dict: the value of every column in BOOK_COLUMNS
+    """
+    root = parse_html(content)
+    if root is None:
+        return dict.fromkeys(BOOK_COLUMNS, '')
+    return {column: str(xpath(root)).strip() for column, xpath in BOOK_FIELD_XPATHS.items()}
+
+def _parse_book_details_bs4(content):
+    """Parses the details of a book from its catalog page with BeautifulSoup. This is the original
+    parser, it is kept as the reference for benchmark_parsers.
+
+    Args:
+        content (bytes): the html of the page
+
+    Returns:
+        dict: the value of every column in BOOK_COLUMNS
+    """
+    soup = BeautifulSoup(content, "html.parser")
+
+    title = soup.find('title').text.strip() if soup.find('title') else ''
+    location = soup.find('span', {'class': 'loc_b__DOCS'})
+    location_text = location.text.strip() if location else ''
+    authors_section = soup.find('div', {'id': 'authors'})
+    authors = authors_section.find('a').text.strip() if authors_section and authors_section.find('a') else ''
+    summary_section = soup.find('section', {'id': 'summary'})
+    summary = summary_section.find('p').text.strip() if summary_section and summary_section.find('p') else ''
+    meta_data = soup.find('dl', {'class': 'document-metadata'})
+
+    def meta(css_class):
+        dd = meta_data.find('dd', {'class': css_class}) if meta_data else None
+        return dd.text.strip() if dd else ''
+
+    return {'Title':title, 'Location':location_text, 'Authors':authors,'Summary':summary,
+            'Published':meta('blacklight-imprint_main_a'),'Language':meta('blacklight-language_a'),
+            'System Details':meta('blacklight-note_system_details_a'),'Notes':meta('blacklight-note_general_a'),
+            'Description':meta('blacklight-physical_description_a'),
+            'Description Details':meta('blacklight-physical_description_details_a'),
+            'Genre':meta('blacklight-genre_headings_a'),'OCLC':meta('blacklight-oclc_number'),
+            'Other Identifiers':meta('blacklight-misc_id_a'),'System ID':meta('blacklight-local_id')}
+
+##### Functions #####
+def benchmark_parsers(fixture_dir, num_pages=None):
+    """Compares how many saved catalog pages per second the BeautifulSoup and lxml parsers extract,
+    and checks that both return the same records.
+
+    Args:
+        fixture_dir (str): a folder of saved catalog pages, e.g. one written with save_fixture
+        num_pages (int, optional): the number of pages to parse. Defaults to all of them.
+
+    Returns:
+        pd.DataFrame: the seconds and pages per second of each parser
+    """
+    pages = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, '*.html')))[:num_pages]:
+        with open(path, 'rb') as f:
+            pages.append(f.read())
+
+    results = []
+    records = {}
+    for name, parse_page in [('bs4', _parse_book_details_bs4), ('lxml', _parse_book_details)]:
+        start = time.perf_counter()
+        records[name] = [parse_page(page) for page in pages]
+        seconds = time.perf_counter() - start
+        results.append({'parser': name, 'pages': len(pages), 'seconds': seconds,
+                        'pages_per_sec': len(pages) / seconds if seconds else float('inf')})
+
+    results = pd.DataFrame(results)
+    num_different = sum(a != b for a, b in zip(records['bs4'], records['lxml']))
+    print(results.to_string(index=False))
+    print(f"{num_different} of {len(pages)} pages parsed differently")
+    return results
+
 # create main
 if __name__ == "__main__":
-    # initialize TPU
-    resolver = tf.distribute.cluster_resolver.TPUClusterResolver(tpu='')
-    tf.config.experimental_connect_to_cluster(resolver)
-    tf.tpu.experimental.initialize_tpu_system(resolver)
-    strategy = tf.distribute.TPUStrategy(resolver)
-
-    with strategy.scope():
-      # run the scraper to get doc IDs and save to a CSV file
-      scraper = DukeLibrariesScraper()
-      #scraper.save_doc_ids(65702,'data/duke_doc_ids.csv')
-      
-      doc_ids = pd.read_csv('data/duke_doc_ids.csv')
-      scraper.save_book_details(doc_ids[96001:],'data/duke_books.csv')
+    # run the scraper to get doc IDs and save to a CSV file
+    scraper = DukeLibrariesScraper()
+    #scraper.save_doc_ids_async(1, 65702, 'data/duke_doc_ids.csv')
+
+    doc_ids = pd.read_csv('data/duke_doc_ids.csv')
+    scraper.save_book_details_async(doc_ids[96001:],'data/duke_books.csv')
@@ -0,0 +1,344 @@
+# Imports
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import torch
+from transformers import BertConfig, BertTokenizer, BertModel
+
+# create a class for storing the BERT embeddings of the book summaries
+class EmbeddingStore:
+
+    def __init__(self, store_dir, model_name='bert-base-uncased', dtype='float32', batch_size=32, max_length=512,
+                 max_shards=16):
+        """Constructor for the EmbeddingStore class. The CLS embedding of every summary is computed once and
+        kept in memory-mapped .npy shards, keyed by a hash of the summary text. Every update writes its new
+        rows to a new shard, and a manifest lists the complete shards. The vectors are L2 normalized
+        so the cosine similarity is a dot product.
+
+        Args:
+            store_dir (str): the folder where the embeddings are stored
+            model_name (str, optional): the BERT model to use. Defaults to 'bert-base-uncased'.
+            dtype (str, optional): 'float32' or 'float16' storage for the embeddings. Defaults to 'float32'.
+            batch_size (int, optional): number of summaries per forward pass. Defaults to 32.
+            max_length (int, optional): maximum number of tokens per summary. Defaults to 512.
+            max_shards (int, optional): the shards are merged into one once there are more. Defaults to 16.
+        """
+        self.store_dir = store_dir
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.max_shards = max_shards
+        self._tokenizer = None
+        self._model = None
+
+        # Load the existing embeddings
+        self.keys = []
+        self.shards = []
+        self.shard_starts = np.zeros(1, dtype=np.int64)
+        self.row_of = {}
+        self.reload()
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.store_dir, "manifest.json")
+
+    @property
+    def embeddings(self):
+        """All the stored embeddings as one array. A single shard is returned memory-mapped, several
+        shards are copied into memory, use vectors to read only some rows.
+        """
+        if not self.shards:
+            return None
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return np.concatenate(self.shards)
+
+    @property
+    def dim(self):
+        """The length of an embedding. It is read from the model config while nothing is stored.
+        """
+        if self.shards:
+            return self.shards[0].shape[1]
+        if self._model is not None:
+            return self._model.config.hidden_size
+        return BertConfig.from_pretrained(self.model_name).hidden_size
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = BertTokenizer.from_pretrained(self.model_name)
+        return self._tokenizer
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = BertModel.from_pretrained(self.model_name)
+            self._model.eval()
+        return self._model
+
+    def load_model(self):
+        """Loads the tokenizer and the model now instead of on the first encode.
+        """
+        self.tokenizer
+        self.model
+
+    @staticmethod
+    def content_hash(text):
+        """Returns the key of a summary in the store.
+
+        Args:
+            text (str): any summary
+
+        Returns:
+            str: the sha1 hex digest of the text
+        """
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def encode(self, texts):
+        """Calculates the normalized CLS embeddings of the texts. The texts are sorted by length and
+        each batch is only padded to its longest text.
+
+        Args:
+            texts (list): a list of strings
+
+        Returns:
+            np.ndarray: one embedding per text, in the same order as the texts
+        """
+        embeddings = np.zeros((len(texts), self.model.config.hidden_size), dtype=np.float32)
+        order = np.argsort([len(text) for text in texts], kind='stable')
+
+        with torch.inference_mode():
+            for start in range(0, len(texts), self.batch_size):
+                batch_idx = order[start:start + self.batch_size]
+                tokens = self.tokenizer([texts[i] for i in batch_idx], truncation=True, padding=True,
+                                        max_length=self.max_length, return_tensors='pt')
+                cls_embeddings = self.model(tokens['input_ids'], tokens['attention_mask'])[0][:, 0, :]
+                embeddings[batch_idx] = cls_embeddings.numpy()
+
+        embeddings /= np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+    def update(self, texts):
+        """Adds the embeddings of any texts that are not in the store yet and returns the row of every text.
+        The new rows are written to a new shard, the existing shards are never rewritten, so an interrupted
+        update never corrupts the store. Processes sharing the store take turns through a lock file.
+
+        Args:
+            texts (list): a list of summaries, values that are not strings are skipped
+
+        Returns:
+            np.ndarray: the row of each text in the embeddings, -1 for values that are not strings
+        """
+        keys = [self.content_hash(text) if isinstance(text, str) else None for text in texts]
+
+        # Find the summaries that have never been embedded
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key is not None and key not in self.row_of and key not in missing:
+                missing[key] = text
+
+        if missing:
+            # Another process may have added some of them since the store was loaded
+            self.reload()
+            missing = {key: text for key, text in missing.items() if key not in self.row_of}
+        if missing:
+            new_embeddings = self.encode(list(missing.values()))
+            self._append(list(missing.keys()), new_embeddings)
+
+        return np.array([self.row_of[key] if key is not None else -1 for key in keys], dtype=np.int64)
+
+    def rows(self, texts):
+        """Looks up the row of every text without embedding anything.
+
+        Args:
+            texts (list): a list of summaries
+
+        Returns:
+            np.ndarray: the row of each text in the embeddings, -1 for texts that are not in the store
+        """
+        return np.array([self.row_of.get(self.content_hash(text), -1) if isinstance(text, str) else -1
+                         for text in texts], dtype=np.int64)
+
+    def reload(self):
+        """Reloads the store from disk, picking up the shards added by other processes.
+        """
+        if os.path.isdir(self.store_dir):
+            with self._lock(fcntl.LOCK_SH):
+                self._load(self._read_manifest())
+
+    def vectors(self, rows):
+        """Returns the embeddings of some rows, reading only the shards that contain them.
+
+        Args:
+            rows (np.ndarray): rows of the store
+
+        Returns:
+            np.ndarray: one embedding per row, in the same order as the rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(self.shards) == 1:
+            return self.shards[0][rows]
+        # an empty store has no rows to read, so this is also the (0, dim) result
+        vectors = np.empty((len(rows), self.dim), dtype=self.dtype)
+        shard_ids = np.searchsorted(self.shard_starts, rows, side='right') - 1
+        for shard_id in np.unique(shard_ids):
+            found = shard_ids == shard_id
+            vectors[found] = self.shards[shard_id][rows[found] - self.shard_starts[shard_id]]
+        return vectors
+
+    def _append(self, new_keys, new_embeddings):
+        """Appends embeddings to the store on disk as a new shard. The lock is held from reading the
+        manifest until the new manifest replaces it, so concurrent updates never lose each other's shards.
+
+        Args:
+            new_keys (list): the content hash of each new embedding
+            new_embeddings (np.ndarray): the new embeddings
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        with self._lock(fcntl.LOCK_EX):
+            manifest = self._read_manifest()
+            self._load(manifest)
+            keep = [i for i, key in enumerate(new_keys) if key not in self.row_of]
+            if not keep:
+                return
+
+            shard_id = max([shard['id'] for shard in manifest['shards']], default=-1) + 1
+            shard = {'id': shard_id, 'embeddings': f"embeddings_{shard_id:06d}.npy", 'keys': f"keys_{shard_id:06d}.json"}
+            self._write_shard(shard, [new_keys[i] for i in keep], new_embeddings[keep].astype(self.dtype))
+            manifest['shards'].append(shard)
+            self._load(manifest)
+
+            old_files = []
+            if len(manifest['shards']) > self.max_shards:
+                old_files = [os.path.join(self.store_dir, old[name]) for old in manifest['shards']
+                             for name in ('embeddings', 'keys')]
+                manifest['shards'] = [self._merge_shards(manifest['shards'], shard_id + 1)]
+
+            # Save the manifest last, it marks which shards are complete
+            self._atomic_write(self._manifest_path, lambda f: f.write(json.dumps(manifest).encode('utf-8')))
+            for path in old_files:
+                os.remove(path)
+            self._load(manifest)
+
+    def _read_manifest(self):
+        """Reads the list of complete shards. A store saved before sharding is read as a single shard.
+
+        Returns:
+            dict: the shards, each with its id, embeddings file and keys file
+        """
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, "r") as f:
+                return json.load(f)
+        if os.path.exists(os.path.join(self.store_dir, "keys.json")):
+            return {'shards': [{'id': -1, 'embeddings': "embeddings.npy", 'keys': "keys.json"}]}
+        return {'shards': []}
+
+    def _load(self, manifest):
+        """Memory-maps the shards of a manifest.
+
+        Args:
+            manifest (dict): the shards, as read by _read_manifest
+        """
+        keys, shards = [], []
+        for shard in manifest['shards']:
+            with open(os.path.join(self.store_dir, shard['keys']), "r") as f:
+                shard_keys = json.load(f)
+            # Rows after the last saved key belong to an interrupted update
+            shards.append(np.load(os.path.join(self.store_dir, shard['embeddings']), mmap_mode='r')[:len(shard_keys)])
+            keys.extend(shard_keys)
+        self.keys = keys
+        self.shards = shards
+        self.shard_starts = np.cumsum([0] + [len(shard) for shard in shards], dtype=np.int64)
+        self.row_of = {key: i for i, key in enumerate(keys)}
+
+    def _write_shard(self, shard, keys, embeddings):
+        """Writes the files of a shard.
+
+        Args:
+            shard (dict): the id, embeddings file and keys file of the shard
+            keys (list): the content hash of each embedding
+            embeddings (np.ndarray): the embeddings
+        """
+        self._atomic_write(os.path.join(self.store_dir, shard['embeddings']), lambda f: np.save(f, embeddings))
+        self._atomic_write(os.path.join(self.store_dir, shard['keys']), lambda f: f.write(json.dumps(keys).encode('utf-8')))
+
+    def _merge_shards(self, shards, shard_id):
+        """Merges shards into one. The rows are copied in chunks so the whole store never has to fit in memory.
+
+        Args:
+            shards (list): the shards to merge, in row order
+            shard_id (int): the id of the merged shard
+
+        Returns:
+            dict: the merged shard
+        """
+        merged = {'id': shard_id, 'embeddings': f"embeddings_{shard_id:06d}.npy", 'keys': f"keys_{shard_id:06d}.json"}
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+        os.close(fd)
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype,
+                                        shape=(len(self.keys), self.shards[0].shape[1]))
+        for shard, start in zip(self.shards, self.shard_starts):
+            for offset in range(0, len(shard), 65536):
+                chunk = shard[offset:offset + 65536]
+                out[start + offset:start + offset + len(chunk)] = chunk
+        out.flush()
+        del out
+        os.replace(tmp_path, os.path.join(self.store_dir, merged['embeddings']))
+        self._atomic_write(os.path.join(self.store_dir, merged['keys']),
+                           lambda f: f.write(json.dumps(self.keys).encode('utf-8')))
+        return merged
+
+    def _atomic_write(self, path, write):
+        """Writes a file through a uniquely named temporary file in the same folder.
+
+        Args:
+            path (str): the path of the file
+            write (function): takes the open binary file and writes the content
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    @contextmanager
+    def _lock(self, operation):
+        """Holds the lock file of the store.
+
+        Args:
+            operation (int): fcntl.LOCK_SH to read the store, fcntl.LOCK_EX to change it
+        """
+        with open(os.path.join(self.store_dir, ".lock"), "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def scores(self, prompt, rows):
+        """Calculates the cosine similarity between the prompt and the stored summaries.
+
+        Args:
+            prompt (str): a prompt to match to books
+            rows (np.ndarray): the store row of each book, as returned by update
+
+        Returns:
+            np.ndarray: one score per book, NaN for books without an embedding
+        """
+        scores = np.full(len(rows), np.nan, dtype=np.float32)
+        if not self.shards:
+            return scores
+
+        prompt_embedding = self.encode([prompt])[0].astype(self.dtype)
+        store_scores = np.concatenate([shard @ prompt_embedding for shard in self.shards]).astype(np.float32)
+
+        scores[rows >= 0] = store_scores[rows[rows >= 0]]
+        return scores
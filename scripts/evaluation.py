@@ -0,0 +1,307 @@
+# Imports
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import torch
+from catalog_store import read_catalog, SUMMARY_COLUMNS
+from prompt_matching import PromptMatching, DATA_FOLDER_PATH, INDEX_FOLDER_PATH
+from ann_index import recall_report
+
+BOOKS_PATH = os.path.join(DATA_FOLDER_PATH, 'books_with_summaries.csv')
+PROMPTS_PATH = os.path.join(DATA_FOLDER_PATH, 'validation_prompts.csv')
+# every search that is evaluated, as (name, mode, column)
+SEARCHES = ([('keyword', 'keyword', 'Summary')] + [(f'cosine_{col}', 'cosine', col) for col in SUMMARY_COLUMNS]
+            + [('bm25', 'bm25', 'Summary'), ('bert', 'bert', 'Summary'), ('hybrid', 'hybrid', 'Summary')])
+
+# the books and prompt matcher of a worker process
+_worker = {}
+
+##### Functions #####
+def run_evaluation(prompts, books_path=BOOKS_PATH, index_dir=INDEX_FOLDER_PATH, searches=SEARCHES, k=10,
+                   num_workers=None, chunk_size=64):
+    """Runs every search over every prompt in a pool of worker processes. The indexes are built once
+    before the workers start, the workers memory-map them. A search whose index cannot be built, e.g.
+    because the BERT model is not available, is reported with its error instead of stopping the run.
+    The searches run one after another, each one spread over all the workers, so the latency and the
+    throughput of a search are not measured while another search competes for the CPUs. The workers are
+    spawned rather than forked from this process, which has already started torch, run torch on one thread
+    each and load their indexes and the BERT model before the first search is timed.
+
+    Every result is also judged with the same ruler, the TF-IDF cosine similarity between the prompt and
+    the Summary of the top book, so the relevance of searches with different scores can be compared.
+
+    Args:
+        prompts (list): the prompts to search for
+        books_path (str, optional): the path of the book catalog. Defaults to ../data/books_with_summaries.csv.
+        index_dir (str, optional): the folder where the search indexes are stored. Defaults to ../data/indexes.
+        searches (list, optional): (name, mode, column) of every search. Defaults to SEARCHES.
+        k (int, optional): the number of books returned per prompt. Defaults to 10.
+        num_workers (int, optional): the number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int, optional): the number of prompts per task. Defaults to 64.
+
+    Returns:
+        results (pd.DataFrame): one row per prompt and search with its scores and latency
+        summary (pd.DataFrame): one row per search, see summarize
+    """
+    books = read_catalog(books_path, columns=SUMMARY_COLUMNS)
+    pm = PromptMatching(index_dir=index_dir)
+    pm.get_tfidf_index(books, 'Summary')
+    index_bytes, errors = {}, {}
+    for name, mode, col in searches:
+        try:
+            index_bytes[name] = index_nbytes(pm, books, mode, col)
+        except Exception as e:
+            errors[name] = f"{type(e).__name__}: {e}"
+
+    start = time.perf_counter()
+    rows = []
+    wall_seconds = {}
+    runnable = [(name, mode, col) for name, mode, col in searches if name not in errors]
+    num_workers = num_workers or os.cpu_count() or 1
+    context = multiprocessing.get_context('spawn')
+    ready = context.Value('i', 0)
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=context, initializer=_init_worker,
+                             initargs=(books_path, index_dir, runnable, ready)) as executor:
+        # start every worker and wait until all of them have loaded, so no search is timed with the startup
+        list(executor.map(_wait_ready, [num_workers] * num_workers))
+        for name, mode, col in runnable:
+            tasks = [(name, mode, col, first, prompts[first:first + chunk_size])
+                     for first in range(0, len(prompts), chunk_size)]
+            search_start = time.perf_counter()
+            for task_rows in executor.map(_run_task, tasks, [k] * len(tasks)):
+                rows.extend(task_rows)
+            wall_seconds[name] = time.perf_counter() - search_start
+    total_seconds = time.perf_counter() - start
+
+    results = pd.DataFrame(rows, columns=['prompt_id', 'prompt', 'search', 'mode', 'column', 'num_results',
+                                          'score_at_1', 'mean_score_at_k', 'summary_cs_at_1', 'latency_ms', 'error'])
+    summary = summarize(results, index_bytes, errors, searches, wall_seconds)
+    if any(mode == 'bert' for name, mode, col in searches if name not in errors):
+        try:
+            report = ann_recall(pm, books, prompts, k)
+            print(report.to_string(index=False))
+            recall = report.loc[report['nprobe'] == pm.get_ann_index(books).nprobe, f'recall@{k}']
+            summary.loc[summary['mode'] == 'bert', 'ann_recall_at_k'] = recall.iloc[0] if len(recall) else np.nan
+        except Exception as e:
+            print(f"ANN recall check failed: {type(e).__name__}: {e}")
+    print(f"Evaluated {len(prompts)} prompts with {len(searches)} searches in {total_seconds:.1f}s")
+    print(summary.to_string(index=False))
+    return results, summary
+
+def summarize(results, index_bytes=None, errors=None, searches=SEARCHES, wall_seconds=None):
+    """Summarizes the results of run_evaluation, one row per search.
+
+    Args:
+        results (pd.DataFrame): the results of run_evaluation
+        index_bytes (dict, optional): the size of the indexes of every search in bytes. Defaults to None.
+        errors (dict, optional): the error of every search that could not run. Defaults to None.
+        searches (list, optional): (name, mode, column) of every search, sets the order of the rows. Defaults to SEARCHES.
+        wall_seconds (dict, optional): the wall clock time every search took over all the workers. Defaults to None.
+
+    Returns:
+        pd.DataFrame: the distribution of the top score, the mean top k score, the mean Summary cosine
+            similarity of the top book, the share of prompts without results, the latency percentiles,
+            the throughput over all the workers (wall clock) and of one worker (from the latencies) and the
+            size of the indexes. run_evaluation adds the recall@k of the approximate nearest neighbour index
+            of the bert search.
+    """
+    index_bytes = index_bytes or {}
+    errors = errors or {}
+    wall_seconds = wall_seconds or {}
+    summary = []
+    for name, mode, col in searches:
+        rows = results[results['search'] == name]
+        row = {'search': name, 'mode': mode, 'column': col, 'prompts': len(rows)}
+        if len(rows):
+            top = rows['score_at_1'].dropna()
+            latency = rows['latency_ms'].values
+            row.update({'no_results': float((rows['num_results'] == 0).mean()),
+                        'score_at_1_mean': top.mean(), 'score_at_1_p10': top.quantile(0.1),
+                        'score_at_1_p50': top.quantile(0.5), 'score_at_1_p90': top.quantile(0.9),
+                        'mean_score_at_k': rows['mean_score_at_k'].mean(),
+                        'summary_cs_at_1': rows['summary_cs_at_1'].mean(),
+                        'latency_p50_ms': np.percentile(latency, 50), 'latency_p95_ms': np.percentile(latency, 95),
+                        'latency_p99_ms': np.percentile(latency, 99),
+                        'prompts_per_sec': len(rows) / wall_seconds[name] if name in wall_seconds else np.nan,
+                        'prompts_per_sec_per_worker': 1000 * len(latency) / max(np.nansum(latency), 1e-9)})
+        row['index_mb'] = index_bytes[name] / 1e6 if name in index_bytes else np.nan
+        row['error'] = errors.get(name, rows['error'].dropna().iloc[0] if rows['error'].notna().any() else None)
+        summary.append(row)
+    return pd.DataFrame(summary)
+
+def ann_recall(pm, books, prompts, k=10, num_prompts=200, seed=0):
+    """Checks the approximate nearest neighbour index of the bert search against exact search over
+    the stored embeddings, using a sample of the prompts as queries.
+
+    Args:
+        pm (PromptMatching): the prompt matcher
+        books (pd.DataFrame): a dataframe consiting of the book data
+        prompts (list): the prompts to sample the queries from
+        k (int, optional): the number of neighbours compared. Defaults to 10.
+        num_prompts (int, optional): the number of sampled prompts. Defaults to 200.
+        seed (int, optional): random seed of the sample. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: recall@k and latency for each nprobe, see ann_index.recall_report
+    """
+    index = pm.get_ann_index(books)
+    rows = pm.get_embedding_rows(books, index.version)
+    book_ids = np.flatnonzero(rows >= 0)
+    store = pm.get_embedding_store()
+
+    sample = np.random.default_rng(seed).choice(len(prompts), min(num_prompts, len(prompts)), replace=False)
+    queries = store.encode([prompts[i] for i in sample])
+    return recall_report(index, store.vectors(rows[book_ids]), queries, k, ids=book_ids)
+
+def index_nbytes(pm, books, mode, col):
+    """Loads (or builds) the indexes a search runs on and returns their size.
+
+    Args:
+        pm (PromptMatching): the prompt matcher
+        books (pd.DataFrame): a dataframe consiting of the book data
+        mode (str): the search mode
+        col (str): the column searched by cosine
+
+    Returns:
+        int: the number of bytes of the index arrays, memory-mapped arrays count whole
+    """
+    if mode == 'keyword':
+        indexes = [pm.get_keyword_index(books)]
+    elif mode == 'cosine':
+        indexes = [pm.get_tfidf_index(books, col)]
+    elif mode == 'bm25':
+        indexes = [pm.get_bm25_index(books)]
+    elif mode == 'bert':
+        indexes = [pm.get_ann_index(books)]
+    else:
+        # the rerank reads the stored embeddings of the candidates
+        indexes = [pm.get_bm25_index(books), pm.get_ann_index(books), pm.get_embedding_store()]
+    return sum(_nbytes(value) for index in indexes for value in vars(index).values())
+
+##### Helper Functions #####
+def _init_worker(books_path, index_dir, searches, ready):
+    """Loads the books, the prompt matcher, the indexes of the searches and the BERT model once per
+    worker process and limits torch to one thread.
+
+    Args:
+        books_path (str): the path of the book catalog
+        index_dir (str): the folder where the search indexes are stored
+        searches (list): (name, mode, column) of every search the worker runs
+        ready (multiprocessing.Value): the number of workers done loading, incremented at the end
+    """
+    # every worker runs one search at a time, more torch threads per worker would oversubscribe the CPUs
+    torch.set_num_threads(1)
+    books = _worker['books'] = read_catalog(books_path, columns=SUMMARY_COLUMNS)
+    pm = _worker['pm'] = PromptMatching(index_dir=index_dir)
+    pm.get_tfidf_index(books, 'Summary')
+    for name, mode, col in searches:
+        # a search that fails to load also reports its error in the results when it runs
+        try:
+            index_nbytes(pm, books, mode, col)
+            if mode in ('bert', 'hybrid'):
+                pm.load_dense_indexes(books)
+        except Exception as e:
+            print(f"Worker {os.getpid()} could not load the indexes of {name}: {type(e).__name__}: {e}")
+    _worker['ready'] = ready
+    with ready.get_lock():
+        ready.value += 1
+
+def _wait_ready(num_workers):
+    """Blocks a worker until every worker has loaded. Each waiting task holds its own worker, so
+    num_workers of them make the pool start all its workers.
+
+    Args:
+        num_workers (int): the number of worker processes
+    """
+    while _worker['ready'].value < num_workers:
+        time.sleep(0.01)
+
+def _run_task(task, k):
+    """Runs one search over a chunk of prompts. Cosine searches score the whole chunk at once with
+    batch_cosine_similarity, the other searches run one prompt at a time.
+
+    Args:
+        task (tuple): the name, mode and column of the search, the id of the first prompt and the prompts
+        k (int): the number of books returned per prompt
+
+    Returns:
+        list: one result row per prompt
+    """
+    name, mode, col, first_id, prompts = task
+    books, pm = _worker['books'], _worker['pm']
+    tfidf = pm.get_tfidf_index(books, 'Summary')
+
+    # the first search of a chunk warms the caches, it is not timed
+    try:
+        pm.search(prompts[0], books, mode, col, k)
+    except Exception as e:
+        print(f"Warm-up search of {name} failed, its prompts record the error: {type(e).__name__}: {e}")
+
+    outcomes = []
+    if mode == 'cosine':
+        # the whole chunk is scored with one sparse matrix product, each prompt is charged an equal share of its time
+        try:
+            start = time.perf_counter()
+            batch = pm.batch_cosine_similarity(prompts, books, col, k)
+            latency_ms = (time.perf_counter() - start) * 1000 / len(prompts)
+            outcomes = [(result, latency_ms, None) for result in batch]
+        except Exception as e:
+            outcomes = [(None, np.nan, f"{type(e).__name__}: {e}")] * len(prompts)
+    else:
+        for prompt in prompts:
+            try:
+                start = time.perf_counter()
+                result = pm.search(prompt, books, mode, col, k)
+                outcomes.append((result, (time.perf_counter() - start) * 1000, None))
+            except Exception as e:
+                outcomes.append((None, np.nan, f"{type(e).__name__}: {e}"))
+
+    # judge the top book of every prompt, only the Summary of that book is scored
+    judged = [i for i, (result, _, _) in enumerate(outcomes) if result is not None and len(result.indices)]
+    summary_cs = dict(zip(judged, tfidf.pair_scores([prompts[i] for i in judged],
+                                                    [outcomes[i][0].indices[0] for i in judged])))
+
+    rows = []
+    for i, (result, latency_ms, error) in enumerate(outcomes):
+        row = {'prompt_id': first_id + i, 'prompt': prompts[i], 'search': name, 'mode': mode, 'column': col,
+               'latency_ms': latency_ms}
+        if result is None:
+            row.update({'num_results': 0, 'error': error})
+        else:
+            row['num_results'] = len(result.indices)
+            if len(result.indices):
+                row['score_at_1'] = float(result.scores[0])
+                row['mean_score_at_k'] = float(result.scores.mean())
+                row['summary_cs_at_1'] = float(summary_cs[i])
+        rows.append(row)
+    return rows
+
+def _nbytes(value):
+    """Returns the size of an index attribute.
+
+    Args:
+        value: a numpy array, a sparse matrix, a list of arrays or any other attribute
+
+    Returns:
+        int: the number of bytes of its arrays, 0 for other attributes
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sp.issparse(value):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    if isinstance(value, list) and value and isinstance(value[0], np.ndarray):
+        # the shards of the embedding store
+        return sum(shard.nbytes for shard in value)
+    return 0
+
+
+# create main
+if __name__ == "__main__":
+    prompts = read_catalog(PROMPTS_PATH, columns=['prompt'])['prompt'].tolist()
+    results, summary = run_evaluation(prompts)
+    results.to_csv(os.path.join(DATA_FOLDER_PATH, 'evaluation_results.csv'), index=False)
+    summary.to_csv(os.path.join(DATA_FOLDER_PATH, 'evaluation_summary.csv'), index=False)
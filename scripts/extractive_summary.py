@@ -1,35 +1,116 @@
 #load imports 
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from nltk import sent_tokenize
 from nltk.corpus import stopwords
-from nltk.cluster.util import cosine_distance
 import numpy as np
-import networkx as nx
 from sklearn.feature_extraction.text import TfidfVectorizer
 import nltk
-from nltk.corpus import stopwords
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 import matplotlib.pyplot as plt
 import pandas as pd
+from summary_cache import SummaryCache
+from summary_merge import KEY_COLUMNS
+
+#name and parameters of the summarization method, they are part of the cache key
+SUMMARY_METHOD = 'tfidf-pagerank'
+SUMMARY_PARAMS = {'top_n': 5, 'alpha': 0.85, 'max_iter': 100, 'tol': 1.0e-6}
+
+def ensure_nltk_resource(resource_path, package):
+    '''
+    Downloads an nltk resource the first time it is needed instead of on every import
+
+    Returns: None
+    '''
+    try:
+        nltk.data.find(resource_path)
+    except LookupError:
+        nltk.download(package, quiet=True)
+
+
+class TextPreprocessor:
+    '''
+    Normalizes sentences before they are vectorized
+    - the stopword list is loaded once and kept as a frozenset for constant time lookups
+    - lowercases, strips non alpha numeric characters and drops stopwords in one pass over the words
+    '''
+    NON_WORD_PATTERN = re.compile(r'[^a-z0-9_]')
+
+    def __init__(self, language='english'):
+        ensure_nltk_resource('corpora/stopwords', 'stopwords')
+        words = stopwords.words(language)
+        #also drop the stripped form of stopwords such as "don't"
+        self.stop_words = frozenset(words) | frozenset(self.NON_WORD_PATTERN.sub('', word) for word in words)
+
+    def process(self, sentence):
+        '''
+        Lowercases the sentence, strips non alpha numeric characters from each word and drops stopwords
+
+        Returns: Processed sentence (str)
+        '''
+        words = (self.NON_WORD_PATTERN.sub('', word) for word in sentence.lower().split())
+        return ' '.join(word for word in words if word and word not in self.stop_words)
+
+
+class PowerIterationFailedConvergence(Exception):
+    '''
+    Raised when PageRank does not converge within the maximum number of iterations
+    '''
+
+
+def pagerank(adjacency_matrix, alpha=0.85, max_iter=100, tol=1.0e-6):
+    '''
+    Runs weighted PageRank by power iteration directly on an adjacency matrix
+    - follows networkx.pagerank: edges are weighted, nodes without edges link to every node
+    - stops once the L1 change between iterations is below number of nodes * tol
+
+    Returns: PageRank score of each node (np.ndarray)
+    '''
+    N = adjacency_matrix.shape[0]
+    if N == 0:
+        return np.zeros(0)
+
+    #normalize the rows into transition probabilities
+    out_weights = adjacency_matrix.sum(axis=1)
+    dangling = out_weights == 0
+    transition = adjacency_matrix / np.where(dangling, 1, out_weights)[:, None]
+
+    x = np.full(N, 1.0 / N)
+    personalization = np.full(N, 1.0 / N)
+    for _ in range(max_iter):
+        xlast = x
+        x = alpha * (x @ transition + x[dangling].sum() * personalization) + (1 - alpha) * personalization
+        if np.abs(x - xlast).sum() < N * tol:
+            return x
+    raise PowerIterationFailedConvergence(max_iter)
 
-#download necessary library from nltk 
-nltk.download('stopwords')
-nltk.download('punkt')
 
 class ExtractiveSummaryGenerator: 
 
-    def __init__(self, filename):
+    def __init__(self, filename=None, cache=None):
         '''Initializes the class for extractive summaries
-        - reads book data in from CSV file
+        - reads book data in from CSV file (if a filename is given)
         - drops books with summary NA
+        - optionally uses a SummaryCache so summaries of unchanged books are not recomputed
         
         Returns: Book pandas data frame with the summry dropped if value is NA
         '''
+        ensure_nltk_resource('tokenizers/punkt', 'punkt')
+        self.preprocessor = TextPreprocessor()
+        self.cache = cache
+
+        self.books = None
+        if filename is None:
+            return
 
         #reads in the books data file 
-        self.books = pd.read_csv(filename)
+        self.books = pd.read_csv(filename, dtype={col: str for col in KEY_COLUMNS})
 
         #drop NA values for now
-        self.books = self.book_data.dropna(subset = ['Summary']).reset_index(drop = True)
+        self.books = self.books.dropna(subset = ['Summary']).reset_index(drop = True)
     
     def word_count(self, text):
         '''
@@ -43,97 +124,221 @@ class ExtractiveSummaryGenerator:
         '''
         Creates extractive summaries from the input text
         - tockenizes input text 
-        - strips alpha numeric characters and stopwords from input text 
+        - strips non alpha numeric characters and stopwords from input text 
         - instantiates TF-IDF feature vectorizer, fit/transforms stripped sentences 
-        - creates adjacency matrix and populates it with the sentence vectors 
-        - populates the adjacency matrix using cosine distance as similarity metric
-        - creates a corresponding document graph
-        - applies PageRank algorithim to the document graph to rank sentences
+        - creates adjacency matrix from the cosine similarity of every pair of sentence vectors
+        - applies PageRank algorithim to the adjacency matrix to rank sentences
         - outputs the ranked sentence - either 5 or the maximum number of sentences in the summary
         - stores count failures of the Page Rank algorithim
 
         Returns: Extracted Summary (str), Count failure, 0 or 1 (int)
         
         '''
+        #use the cached summary if this exact text was already summarized
+        if self.cache is not None:
+            cache_key = self.cache.make_key(SUMMARY_METHOD, SUMMARY_PARAMS, input_text)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached[0], cached[1]
+
         #tokenize sentences
         sentences = sent_tokenize(input_text)
 
-        #strip alpha numeric characters and stopwords 
-        sentences_processed = []
-        for sentence in sentences:
-            sentence_reduced = sentence.replace("[^a-zA-Z0-9_]", '')
-            sentence_reduced = [word.lower() for word in sentence_reduced.split(' ') if word.lower() not in stopwords.words('english')]
-            sentences_processed.append(' '.join(word for word in sentence_reduced))
+        #strip non alpha numeric characters and stopwords 
+        sentences_processed = [self.preprocessor.process(sentence) for sentence in sentences]
 
-        #create TFIDF feature vecs
+        #create TFIDF feature vecs, the rows are L2 normalized so their dot products are cosine similarities
         vectorizer = TfidfVectorizer()
         feature_vecs = vectorizer.fit_transform(sentences_processed)
-        feature_vecs = feature_vecs.todense().tolist()
-
-        # Create empty adjacency matrix
-        adjacency_matrix = np.zeros((len(feature_vecs), len(feature_vecs)))
- 
-        # Populate the adjacency matrix using the similarity of all pairs of sentences
-        for i in range(len(feature_vecs)):
-            for j in range(len(feature_vecs)):
-                if i == j: #ignore if both are the same sentence
-                    continue 
-                adjacency_matrix[i][j] = 1 - cosine_distance(feature_vecs[1], feature_vecs[j])
 
-        # Create the graph representing the document
-        document_graph = nx.from_numpy_array(adjacency_matrix)
+        # Create the adjacency matrix from the similarity of all pairs of sentences in one sparse product
+        adjacency_matrix = (feature_vecs @ feature_vecs.T).toarray()
+        np.fill_diagonal(adjacency_matrix, 0) #ignore if both are the same sentence
 
         #initialize count failures so we can keep track of them 
         count_failures = 0
     
         # Apply PageRank algorithm to get centrality scores for each node/sentence
         try:
-            scores = nx.pagerank(document_graph)
-            scores_list = list(scores.values())
+            scores_list = pagerank(adjacency_matrix, SUMMARY_PARAMS['alpha'], SUMMARY_PARAMS['max_iter'], SUMMARY_PARAMS['tol'])
 
             # Sort and pick top sentences
             ranking_idx = np.argsort(scores_list)[::-1]
             ranked_sentences = [sentences[i] for i in ranking_idx]   
 
             summary = []
-            top_n = min(len(ranked_sentences), 5)
+            top_n = min(len(ranked_sentences), SUMMARY_PARAMS['top_n'])
             for i in range(top_n):
                 summary.append(ranked_sentences[i])
 
             summary = " ".join(summary)
-        except nx.PowerIterationFailedConvergence:
+        except PowerIterationFailedConvergence:
             count_failures += 1
             summary = input_text
 
+        if self.cache is not None:
+            self.cache.put(cache_key, [summary, count_failures])
+
         return summary, count_failures
     
 
-    def extractive_summary(self,books):
+    def select_long_books(self, books):
         '''
-        Applies the extractive summary function to the data frame
+        Selects the books whose summary is long enough to be summarized
         - generates word count column to ID longer summaries 
         - filters data frame for only books where the summary is longer than 100 words
         - drops everything from data frame besides title and summary and creates full title column 
-        - applies generate summary function to full summary column and creates column to track count failures 
-        - returns data frame extracted summary as a column 
 
-        Returns: Data frame with the extracted summary as a column 
+        Returns: Data frame with the title, summary and full text of the long books
         '''
         books['word_count'] = books['Summary'].apply(self.word_count)
         #filter for books with longer summaries
         book_long = books[books['word_count'] >= 100] 
         
-        #drop everything but title and summary 
-        book_long = book_long.loc[:, ['Title', 'Summary']]
+        #drop everything but the book identifiers, title and summary 
+        book_long = book_long.loc[:, [col for col in KEY_COLUMNS if col in book_long.columns] + ['Title', 'Summary']]
 
         #generate full text by concatenating Title and Summary columns
         book_long['full_text'] = book_long['Title'] + ' ' + book_long['Summary']
 
+        return book_long
+
+    def extractive_summary(self,books):
+        '''
+        Applies the extractive summary function to the data frame
+        - selects the books with a summary longer than 100 words (see select_long_books)
+        - applies generate summary function to full summary column and creates column to track count failures 
+        - returns data frame extracted summary as a column 
+
+        Returns: Data frame with the extracted summary as a column 
+        '''
+        book_long = self.select_long_books(books)
+
         #generate extractive summary and count failure (see how many times page rank failed to converge and we just filled with original)
         book_long['extractive_summary'], book_long['count_failures'] = zip(*book_long['full_text'].apply(self.generate_summary))
 
         return book_long
+
+
+def run_extractive_pipeline(input_path, output_path, checkpoint_path=None, chunksize=1000, num_workers=None, cache_path=None):
+    '''
+    Generates the extractive summaries of a large book file in parallel
+    - reads the input csv in chunks so the whole file never has to fit in memory
+    - fans generate_summary out over a pool of worker processes
+    - appends the summaries of each chunk to the output csv as soon as they are done
+    - records the completed chunks in a checkpoint file so a killed run resumes where it stopped
+    - if a cache path is given, the workers share a SummaryCache so unchanged books are not recomputed
+
+    Returns: Number of summaries written by this run (int)
+    '''
+    if checkpoint_path is None:
+        checkpoint_path = output_path + '.checkpoint.json'
+
+    #resume from the checkpoint, dropping any partial chunk written after it
+    checkpoint = {'chunks_done': 0, 'output_bytes': 0, 'rows_written': 0}
+    if os.path.exists(checkpoint_path) and os.path.exists(output_path):
+        with open(checkpoint_path, 'r') as f:
+            checkpoint = json.load(f)
+        with open(output_path, 'r+') as f:
+            f.truncate(checkpoint['output_bytes'])
+    elif os.path.exists(output_path):
+        os.remove(output_path)
+
+    generator = ExtractiveSummaryGenerator()
+    num_workers = num_workers or os.cpu_count()
+    rows_written = 0
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(cache_path,)) as executor:
+        for chunk_idx, chunk in enumerate(pd.read_csv(input_path, chunksize=chunksize, dtype={col: str for col in KEY_COLUMNS})):
+            if chunk_idx < checkpoint['chunks_done']:
+                continue
+
+            #summarize the long books of the chunk in parallel
+            book_long = generator.select_long_books(chunk.dropna(subset = ['Summary']))
+            texts = book_long['full_text'].tolist()
+            task_chunksize = max(1, len(texts) // (4 * num_workers))
+            results = list(executor.map(_generate_summary_worker, texts, chunksize=task_chunksize))
+            if results:
+                book_long['extractive_summary'], book_long['count_failures'] = zip(*results)
+            else:
+                book_long['extractive_summary'], book_long['count_failures'] = [], []
+
+            #append the chunk, then record it as done
+            with open(output_path, 'a') as f:
+                book_long.to_csv(f, header=(checkpoint['output_bytes'] == 0), index=False)
+                f.flush()
+                os.fsync(f.fileno())
+                output_bytes = f.tell()
+
+            rows_written += len(book_long)
+            checkpoint = {'chunks_done': chunk_idx + 1, 'output_bytes': output_bytes,
+                          'rows_written': checkpoint['rows_written'] + len(book_long)}
+            _save_checkpoint(checkpoint, checkpoint_path)
+            print(f"Summarized {checkpoint['chunks_done']} chunks ({checkpoint['rows_written']} books)")
+
+    return rows_written
+
+def benchmark_preprocessing(filename, num_docs=500):
+    '''
+    Compares the sentence preprocessing of generate_summary before and after TextPreprocessor on real summaries
+    - the old version looked up stopwords.words('english') for every word and scanned the list
+    - sentence tokenization is done up front so only the preprocessing is timed
+
+    Returns: Data frame with the time per document of each version and the speedup
+    '''
+    books = pd.read_csv(filename).dropna(subset = ['Summary'])
+    ensure_nltk_resource('tokenizers/punkt', 'punkt')
+    documents = [sent_tokenize(summary) for summary in books['Summary'].head(num_docs)]
+
+    def old_process(sentence):
+        sentence_reduced = sentence.replace("[^a-zA-Z0-9_]", '')
+        sentence_reduced = [word.lower() for word in sentence_reduced.split(' ') if word.lower() not in stopwords.words('english')]
+        return ' '.join(word for word in sentence_reduced)
+
+    preprocessor = TextPreprocessor()
+    timings = {}
+    for name, process in [('old', old_process), ('new', preprocessor.process)]:
+        start = time.perf_counter()
+        for sentences in documents:
+            [process(sentence) for sentence in sentences]
+        timings[name] = 1000 * (time.perf_counter() - start) / len(documents)
+
+    results = pd.DataFrame([{'num_docs': len(documents), 'old_ms_per_doc': timings['old'],
+                             'new_ms_per_doc': timings['new'], 'speedup': timings['old'] / timings['new']}])
+    print(results.to_string(index=False))
+    return results
+
+# worker process state, created once per process by _init_worker
+_worker_generator = None
+
+def _init_worker(cache_path=None):
+    '''
+    Creates the summary generator used by a worker process, each worker opens its own connection to the cache
+    '''
+    global _worker_generator
+    cache = SummaryCache(cache_path) if cache_path is not None else None
+    _worker_generator = ExtractiveSummaryGenerator(cache=cache)
+
+def _generate_summary_worker(input_text):
+    '''
+    Runs generate_summary in a worker process
+
+    Returns: Extracted Summary (str), Count failure, 0 or 1 (int)
+    '''
+    return _worker_generator.generate_summary(input_text)
+
+def _save_checkpoint(checkpoint, checkpoint_path):
+    '''
+    Saves the checkpoint by writing a temporary file and renaming it, so the checkpoint is never half written
+    '''
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
     
 if __name__ == "__main__":
-    summary_generator = ExtractiveSummaryGenerator('data/duke_books.csv')
+    #benchmark_preprocessing('data/duke_books.csv')
+    run_extractive_pipeline('data/duke_books.csv', 'data/extractive_summary_df.csv', num_workers=os.cpu_count(),
+                            cache_path='data/summary_cache.sqlite')
 
@@ -0,0 +1,146 @@
+# Imports
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+META_FILENAME = "meta.json"
+
+##### Functions #####
+def top_k(scores, k):
+    """Returns the positions and values of the k highest scores, best first.
+    Uses argpartition so only the k selected scores get sorted. Scores of -inf
+    (used for books without a summary) are never returned.
+
+    Args:
+        scores (np.ndarray): a 1D array containing one score per book
+        k (int): the number of results to return
+
+    Returns:
+        indices (np.ndarray): the positions of the top k scores
+        top_scores (np.ndarray): the top k scores, in descending order
+    """
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=scores.dtype)
+
+    # Select the top k without sorting everything, then sort only those k
+    indices = np.argpartition(-scores, k - 1)[:k]
+    indices = indices[np.lexsort((indices, -scores[indices]))]
+    top_scores = scores[indices]
+
+    # Drop any books that were masked out
+    keep = np.isfinite(top_scores)
+    return indices[keep], top_scores[keep]
+
+def fuse_scores(score_lists, method='rrf', weights=None, rrf_k=60):
+    """Combines several scores of the same candidates into one score per candidate.
+    Non finite scores mean the candidate was not found by that search and add nothing.
+
+    Args:
+        score_lists (list): one 1D array per search, each with one score per candidate
+        method (str, optional): 'rrf' adds weight / (rrf_k + rank) for the rank of the candidate in each search,
+            'weighted' adds the weighted scores after scaling each search to [0, 1]. Defaults to 'rrf'.
+        weights (list, optional): the weight of each search. Defaults to equal weights.
+        rrf_k (int, optional): damps the influence of the first few ranks in 'rrf'. Defaults to 60.
+
+    Returns:
+        np.ndarray: the fused score of every candidate, higher is better
+    """
+    weights = weights if weights is not None else [1.0] * len(score_lists)
+    fused = np.zeros(len(score_lists[0]), dtype=np.float32)
+    for scores, weight in zip(score_lists, weights):
+        scores = np.asarray(scores, dtype=np.float32)
+        found = np.isfinite(scores)
+        if not found.any():
+            continue
+        if method == 'rrf':
+            ranks = np.empty(len(scores), dtype=np.float32)
+            ranks[np.argsort(-np.where(found, scores, -np.inf), kind='stable')] = np.arange(1, len(scores) + 1)
+            fused[found] += weight / (rrf_k + ranks[found])
+        elif method == 'weighted':
+            low, high = scores[found].min(), scores[found].max()
+            fused[found] += weight * ((scores[found] - low) / (high - low) if high > low else 1.0)
+        else:
+            raise ValueError(f"Unknown fusion method {method}, choose 'rrf' or 'weighted'")
+    return fused
+
+def fingerprint(texts):
+    """Creates a short fingerprint of a column of text (or of a whole dataframe).
+    It is used to detect whether an index or a saved result was built from the same data.
+
+    Args:
+        texts (pd.Series): the column of text used to build an index, a dataframe also works
+
+    Returns:
+        str: a hex digest identifying the content of the column
+    """
+    hashes = pd.util.hash_pandas_object(texts.reset_index(drop=True), index=False).values
+    return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+def save_meta(index_dir, meta):
+    """Saves the metadata of an index as json.
+
+    Args:
+        index_dir (str): the folder containing the index files
+        meta (dict): the metadata to save
+    """
+    with open(os.path.join(index_dir, META_FILENAME), "w") as f:
+        json.dump(meta, f)
+
+def load_meta(index_dir):
+    """Loads the metadata of an index.
+
+    Args:
+        index_dir (str): the folder containing the index files
+
+    Returns:
+        dict: the metadata of the index, or None if the index does not exist
+    """
+    path = os.path.join(index_dir, META_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+@contextmanager
+def index_writer(index_dir):
+    """Writes an index into a fresh folder and swaps it in whole once it is complete. index_dir is a
+    symbolic link to the folder of the current version and replacing the link is atomic, so readers
+    see either the old or the new index, never a mix of both. The files of the old version are never
+    overwritten, so processes that memory-mapped them keep reading them. The previous version is kept
+    for readers that are still loading it, older versions are deleted.
+
+    Args:
+        index_dir (str): the folder the index is saved to
+
+    Yields:
+        str: the fresh folder to write the index files to
+    """
+    parent, name = os.path.split(os.path.abspath(index_dir))
+    os.makedirs(parent, exist_ok=True)
+    version_dir = tempfile.mkdtemp(dir=parent, prefix=f".{name}.")
+    try:
+        yield version_dir
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    previous = os.path.realpath(index_dir)
+    if os.path.isdir(index_dir) and not os.path.islink(index_dir):
+        # a folder saved before the versions were kept is moved aside, it can not be replaced by a link
+        previous = tempfile.mkdtemp(dir=parent, prefix=f".{name}.")
+        os.rmdir(previous)
+        os.rename(index_dir, previous)
+    link_path = version_dir + ".link"
+    os.symlink(os.path.basename(version_dir), link_path)
+    os.replace(link_path, index_dir)
+
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if entry.startswith(f".{name}.") and path not in (version_dir, previous) and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,117 @@
+# Imports
+import os
+import torch
+from transformers import AutoModelForSeq2SeqLM
+
+# create classes for the different ways of running the summarization model on CPU
+class TorchBackend:
+    """Runs the full precision PyTorch model."""
+    name = 'torch'
+
+    def __init__(self, model_name):
+        """Constructor for the TorchBackend class
+
+        Args:
+            model_name (str): the name of the pretrained seq2seq model
+        """
+        self.model_name = model_name
+        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        self.model.eval()
+
+    @property
+    def cache_name(self):
+        """The name used in summary cache keys. Backends that change the output get their own name."""
+        return self.model_name
+
+    def generate(self, input_ids, attention_mask, **params):
+        """Generates the output token ids.
+
+        Args:
+            input_ids (torch.Tensor): the padded input ids
+            attention_mask (torch.Tensor): the attention mask of the inputs
+            params: generation parameters passed to generate
+
+        Returns:
+            torch.Tensor: the generated token ids
+        """
+        return self.model.generate(input_ids, attention_mask=attention_mask, **params)
+
+
+class QuantizedTorchBackend(TorchBackend):
+    """Runs the PyTorch model with its linear layers dynamically quantized to int8."""
+    name = 'int8'
+
+    def __init__(self, model_name):
+        """Constructor for the QuantizedTorchBackend class
+
+        Args:
+            model_name (str): the name of the pretrained seq2seq model
+        """
+        super().__init__(model_name)
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    @property
+    def cache_name(self):
+        return f"{self.model_name}#int8"
+
+
+class OnnxBackend:
+    """Runs the model with ONNX Runtime. The model is exported once and the exported encoder and
+    decoder are loaded from disk afterwards, the sessions are kept for the life of the backend."""
+    name = 'onnx'
+
+    def __init__(self, model_name, export_dir=None):
+        """Constructor for the OnnxBackend class
+
+        Args:
+            model_name (str): the name of the pretrained seq2seq model
+            export_dir (str, optional): where the exported model is cached. Defaults to data/onnx/<model name>.
+        """
+        try:
+            from optimum.onnxruntime import ORTModelForSeq2SeqLM
+        except ImportError as e:
+            raise ImportError("The onnx backend needs optimum and onnxruntime: pip install optimum[onnxruntime]") from e
+
+        self.model_name = model_name
+        self.export_dir = export_dir or os.path.join('data', 'onnx', model_name.replace('/', '--'))
+        if os.path.exists(os.path.join(self.export_dir, 'config.json')):
+            self.model = ORTModelForSeq2SeqLM.from_pretrained(self.export_dir)
+        else:
+            self.model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True)
+            self.model.save_pretrained(self.export_dir)
+
+    @property
+    def cache_name(self):
+        return f"{self.model_name}#onnx"
+
+    def generate(self, input_ids, attention_mask, **params):
+        """Generates the output token ids.
+
+        Args:
+            input_ids (torch.Tensor): the padded input ids
+            attention_mask (torch.Tensor): the attention mask of the inputs
+            params: generation parameters passed to generate
+
+        Returns:
+            torch.Tensor: the generated token ids
+        """
+        return self.model.generate(input_ids, attention_mask=attention_mask, **params)
+
+
+BACKENDS = {backend.name: backend for backend in [TorchBackend, QuantizedTorchBackend, OnnxBackend]}
+
+##### Functions #####
+def load_backend(name, model_name, **kwargs):
+    """Creates an inference backend by name.
+
+    Args:
+        name (str): one of 'torch', 'int8' or 'onnx'
+        model_name (str): the name of the pretrained seq2seq model
+        kwargs: extra arguments for the backend
+
+    Returns:
+        the inference backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, choose one of {list(BACKENDS)}")
+    return BACKENDS[name](model_name, **kwargs)
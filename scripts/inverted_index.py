@@ -0,0 +1,135 @@
+# Imports
+import json
+import os
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import CountVectorizer
+from index_utils import fingerprint, save_meta, load_meta, index_writer
+
+# create a class for the keyword inverted index
+class InvertedIndex:
+
+    def __init__(self, col, vocabulary, postings, version):
+        """Constructor for the InvertedIndex class. Use build or load to create one.
+
+        Args:
+            col (str): the summary column the index was built from
+            vocabulary (dict): maps each term to its row in the postings matrix
+            postings (sp.csr_matrix): term counts stored term-major (terms x books). Row t holds the
+                sorted ids of the books containing term t and how many times it appears in each.
+            version (str): fingerprint of the column the index was built from
+        """
+        self.col = col
+        self.vocabulary = vocabulary
+        self.postings = postings
+        self.version = version
+
+    @property
+    def num_books(self):
+        return self.postings.shape[1]
+
+    @classmethod
+    def build(cls, books, col='Summary'):
+        """Counts every term of every summary once and stores the posting list of each term.
+        The same tokenizer as the CountVectorizer fit on the prompt is used, so the terms line up.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+            col (str, optional): The column containing the summary of interest. Defaults to 'Summary'.
+
+        Returns:
+            InvertedIndex: the index for the column
+        """
+        summaries = books[col]
+        valid = summaries.apply(lambda x: isinstance(x, str)).values
+
+        # Books without a summary get no postings, so they never match
+        vectorizer = CountVectorizer(dtype=np.int32)
+        counts = vectorizer.fit_transform(summaries.where(valid, ''))
+        postings = counts.T.tocsr()
+        postings.sort_indices()
+
+        vocabulary = {term: int(i) for term, i in vectorizer.vocabulary_.items()}
+        return cls(col, vocabulary, postings, fingerprint(summaries))
+
+    def save(self, index_dir):
+        """Saves the index to a folder. The arrays are stored as .npy files so they can be memory-mapped.
+        A saved index is replaced whole, see index_writer.
+
+        Args:
+            index_dir (str): the folder to save the index to
+        """
+        with index_writer(index_dir) as version_dir:
+            with open(os.path.join(version_dir, "vocabulary.json"), "w") as f:
+                json.dump(self.vocabulary, f)
+            np.save(os.path.join(version_dir, "data.npy"), self.postings.data)
+            np.save(os.path.join(version_dir, "indices.npy"), self.postings.indices)
+            np.save(os.path.join(version_dir, "indptr.npy"), self.postings.indptr)
+            save_meta(version_dir, {'column': self.col, 'num_books': int(self.num_books),
+                                    'num_terms': int(self.postings.shape[0]), 'version': self.version})
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """Loads an index saved with save.
+
+        Args:
+            index_dir (str): the folder containing the index
+            mmap (bool, optional): memory-map the arrays instead of reading them. Defaults to True.
+
+        Returns:
+            InvertedIndex: the loaded index
+        """
+        # every file is read from the same version even if a new one is swapped in meanwhile
+        index_dir = os.path.realpath(index_dir)
+        meta = load_meta(index_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No index found in {index_dir}")
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(index_dir, "vocabulary.json"), "r") as f:
+            vocabulary = json.load(f)
+        data = np.load(os.path.join(index_dir, "data.npy"), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(index_dir, "indices.npy"), mmap_mode=mmap_mode)
+        indptr = np.load(os.path.join(index_dir, "indptr.npy"), mmap_mode=mmap_mode)
+        postings = sp.csr_matrix((data, indices, indptr), shape=(meta['num_terms'], meta['num_books']), copy=False)
+        return cls(meta['column'], vocabulary, postings, meta['version'])
+
+    def query(self, prompt):
+        """Finds the books whose summary contains every keyword of the prompt at least as many
+        times as the prompt does. Posting lists are intersected starting from the rarest term.
+
+        Args:
+            prompt (str): a prompt to match to books
+
+        Returns:
+            np.ndarray: the sorted positions of the matching books
+        """
+        # Prompt and relevant keywords
+        vectorizer = CountVectorizer()
+        keywords = vectorizer.fit_transform([prompt]).toarray()[0]
+
+        # A keyword that no summary contains means nothing can match
+        required = []
+        for term, i in vectorizer.vocabulary_.items():
+            if term not in self.vocabulary:
+                return np.empty(0, dtype=np.int32)
+            required.append((self.vocabulary[term], keywords[i]))
+
+        # Start from the shortest posting list so the candidate set is as small as possible
+        indptr = self.postings.indptr
+        required.sort(key=lambda x: indptr[x[0] + 1] - indptr[x[0]])
+
+        matched = None
+        for term_id, min_count in required:
+            book_ids = self.postings.indices[indptr[term_id]:indptr[term_id + 1]]
+            counts = self.postings.data[indptr[term_id]:indptr[term_id + 1]]
+            if matched is None:
+                matched = book_ids[counts >= min_count]
+            else:
+                # Look the remaining candidates up in the (sorted) posting list
+                pos = np.minimum(np.searchsorted(book_ids, matched), len(book_ids) - 1)
+                found = (book_ids[pos] == matched) & (counts[pos] >= min_count)
+                matched = matched[found]
+            if len(matched) == 0:
+                break
+
+        return np.asarray(matched)
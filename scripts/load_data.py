@@ -1,6 +1,6 @@
 # Imports and Constants
 import os
-import pandas as pd
+from catalog_store import read_catalog
 
 DATA_FOLDER_PATH = os.path.join("..", "data")
 
@@ -11,7 +11,7 @@ def load_duke_library_data():
     Returns:
         duke_book_data (pd.DataFrame): A dataframe containing the Duke book data
     """
-    duke_book_data = pd.read_csv(os.path.join(DATA_FOLDER_PATH, "duke_books.csv")).drop_duplicates()
+    duke_book_data = read_catalog(os.path.join(DATA_FOLDER_PATH, "duke_books.csv")).drop_duplicates()
     return duke_book_data
 
 def load_dpl_data():
@@ -20,5 +20,5 @@ def load_dpl_data():
     Returns:
         dpl_book_data (pd.DataFrame): A dataframe containing the DPL book data
     """
-    dpl_book_data = pd.read_csv(os.path.join(DATA_FOLDER_PATH, "dpl_book_data.tsv"), sep='\t').drop_duplicates()
+    dpl_book_data = read_catalog(os.path.join(DATA_FOLDER_PATH, "dpl_book_data.tsv")).drop_duplicates()
     return dpl_book_data
\ No newline at end of file
@@ -1,18 +1,81 @@
 # create a class for matching prompt to book
+import os
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BertTokenizer, BertModel
-import torch
 import warnings
+from typing import NamedTuple
+from tfidf_index import TfidfIndex
+from inverted_index import InvertedIndex
+from embedding_store import EmbeddingStore
+from ann_index import IVFIndex
+from bm25_index import BM25Index
+from index_utils import top_k, fingerprint, fuse_scores
+from catalog_store import read_catalog, SUMMARY_COLUMNS
+from summary_merge import SummaryMerger
+from query_cache import query_key
 warnings.filterwarnings('ignore')
 
+DATA_FOLDER_PATH = os.path.join("..", "data")
+INDEX_FOLDER_PATH = os.path.join(DATA_FOLDER_PATH, "indexes")
+SEARCH_MODES = ('keyword', 'cosine', 'bm25', 'bert', 'hybrid')
+
+
+class MatchResult(NamedTuple):
+    """The books matched by a search. Only the positions and scores of the matched books are kept,
+    so a result never copies or modifies the books dataframe. The arrays are read-only.
+    """
+    indices: np.ndarray
+    scores: np.ndarray
+
+    @classmethod
+    def create(cls, indices, scores):
+        """Creates a result from the positions and scores of the matched books.
+
+        Args:
+            indices (np.ndarray): the positions of the matched books in the dataframe
+            scores (np.ndarray): the score of each matched book
+
+        Returns:
+            MatchResult: the read-only result
+        """
+        indices = np.array(indices, dtype=np.int64)
+        scores = np.array(scores, dtype=np.float32)
+        indices.flags.writeable = False
+        scores.flags.writeable = False
+        return cls(indices, scores)
+
+    def rows(self, books, score_col=None):
+        """Materializes the matched books.
+
+        Args:
+            books (pd.DataFrame): the dataframe that was searched
+            score_col (str, optional): add the scores to the rows under this column name. Defaults to None.
+
+        Returns:
+            pd.DataFrame: a new dataframe containing only the matched books, in result order
+        """
+        matched = books.iloc[self.indices].copy()
+        if score_col is not None:
+            matched[score_col] = self.scores
+        return matched
+
 
 class PromptMatching:
 
+    def __init__(self, index_dir=INDEX_FOLDER_PATH, query_cache=None):
+        """Constructor for PromptMatching class
+
+        Args:
+            index_dir (str, optional): the folder where the search indexes are stored. Defaults to ../data/indexes.
+            query_cache (QueryCache, optional): a cache for the results of search. Defaults to None (no caching).
+        """
+        self.index_dir = index_dir
+        self.indexes = {}
+        # the version folder every index was loaded from
+        self.index_paths = {}
+        self.query_cache = query_cache
+
     def keyword_matching(self,prompt,books):
         """Takes a prompt and compares the keywords in the prompt to each book summary in the data. 
         If all keywords in the prompt are present in the summary, the book is considered a match.
@@ -21,102 +84,375 @@ class PromptMatching:
         Args:
             prompt (str): a prompt to match to books
             books (pd.DataFrame): a dataframe consiting of the book data
+
+        Returns:
+            MatchResult: every matching book, in catalog order, each with a score of 1
         """
-        # Prompt and relevant keywords
-        vectorizer = CountVectorizer()
-        keywords = vectorizer.fit_transform([prompt]).toarray()[0]
+        # Intersect the posting lists of the keywords instead of counting every summary
+        matches = self.get_keyword_index(books).query(prompt)
+        return MatchResult.create(matches, np.ones(len(matches), dtype=np.float32))
+        
+    def cosine_similarity(self,prompt,books,col,num_books=3):
+        """Calculates the cosine similarity between the prompt and each book summary in the data
+        and keeps the books with the highest scores. Only those books get sorted.
 
-        # Loop through each book summary
-        keywords_match = []
-        for summary in books['Summary']:
-            if isinstance(summary, str):
-                # Check if summary contains all relevant keywords
-                book_keywords = vectorizer.transform([summary]).toarray()[0]
-                match = all(book_keywords[i] >= keywords[i] for i in range(len(keywords)))
-            else:
-                # If summary is NaN, set match to False
-                match = False
-            keywords_match.append(match)
+        Args:
+            prompt (str): a prompt to match to books
+            books (pd.DataFrame): a dataframe consiting of the book data
+            col (str): The column containing the summary of interest
+            num_books (int, optional): The number of books to return. Defaults to 3.
 
-        # Add keywords_match column to books dataframe
-        books['keywords_match'] = keywords_match
-        
-    def cosine_similarity(self,prompt,books,col):
-        """Calculates the cosine similarity between the prompt and each book summary in the data.
+        Returns:
+            MatchResult: the best books, best first
+        """
+        indices, scores = self.get_tfidf_index(books, col).query(prompt, num_books)
+        return MatchResult.create(indices, scores)
+
+    def batch_cosine_similarity(self,prompts,books,col,num_books=1):
+        """Runs cosine_similarity for many prompts at once. All the prompts are scored with
+        one sparse matrix product instead of one search per prompt.
+
+        Args:
+            prompts (list): the prompts to match to books
+            books (pd.DataFrame): a dataframe consiting of the book data
+            col (str): The column containing the summary of interest
+            num_books (int, optional): The number of books to return per prompt. Defaults to 1.
+
+        Returns:
+            list: one MatchResult per prompt, in the same order as the prompts
+        """
+        results = self.get_tfidf_index(books, col).query_batch(list(prompts), num_books)
+        return [MatchResult.create(indices, scores) for indices, scores in results]
+
+    def bm25_matching(self,prompt,books,num_books=3):
+        """Ranks the books by the BM25 score of the prompt over all their summary columns. Unlike
+        cosine_similarity only the books that can still make the top num_books are scored in full.
+
+        Args:
+            prompt (str): a prompt to match to books
+            books (pd.DataFrame): a dataframe consiting of the book data
+            num_books (int, optional): The number of books to return. Defaults to 3.
+
+        Returns:
+            MatchResult: the best books, best first
+        """
+        indices, scores = self.get_bm25_index(books).query(prompt, num_books)
+        return MatchResult.create(indices, scores)
+
+    def search(self,prompt,books,mode,col='Summary',num_books=3):
+        """Runs any of the searches, so callers can pick the search by name. When the matcher has a
+        query cache, repeated prompts are answered from it until the index changes.
 
         Args:
             prompt (str): a prompt to match to books
+            books (pd.DataFrame): a dataframe consiting of the book data
+            mode (str): one of SEARCH_MODES, 'keyword', 'cosine' (TF-IDF on col), 'bm25' (BM25 on every summary
+                column), 'bert' (embeddings of Summary) or 'hybrid' (BM25 fused with the embeddings of Summary)
+            col (str, optional): The column containing the summary of interest for cosine. Defaults to 'Summary'.
+            num_books (int, optional): The number of books to return, None returns every keyword match. Defaults to 3.
+
+        Returns:
+            MatchResult: the best books, best first (catalog order for keyword)
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode {mode}, choose one of {SEARCH_MODES}")
+        if mode != 'keyword':
+            num_books = num_books or 3
+        if self.query_cache is None:
+            return self._search(prompt, books, mode, col, num_books)
+        return self.query_cache.get_or_compute(query_key(prompt, mode, col, num_books),
+                                               self.index_version(books, mode, col),
+                                               lambda: self._search(prompt, books, mode, col, num_books))
+
+    def index_version(self,books,mode,col='Summary'):
+        """Returns the version of the index a search runs on, it changes whenever the index is rebuilt
+        from different data.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+            mode (str): one of SEARCH_MODES
+            col (str, optional): The column containing the summary of interest for cosine. Defaults to 'Summary'.
+
+        Returns:
+            str: the fingerprint of the data the index was built from
+        """
+        if mode == 'keyword':
+            return self.get_keyword_index(books).version
+        if mode == 'cosine':
+            return self.get_tfidf_index(books, col).version
+        if mode == 'bm25':
+            return self.get_bm25_index(books).version
+        if mode == 'bert':
+            return self.get_ann_index(books).version
+        if mode == 'hybrid':
+            return self.get_bm25_index(books).version + ':' + self.get_ann_index(books).version
+        raise ValueError(f"Unknown search mode {mode}, choose one of {SEARCH_MODES}")
+
+    def _search(self,prompt,books,mode,col,num_books):
+        if mode == 'keyword':
+            result = self.keyword_matching(prompt, books)
+            if num_books is None:
+                return result
+            return MatchResult.create(result.indices[:num_books], result.scores[:num_books])
+        if mode == 'cosine':
+            return self.cosine_similarity(prompt, books, col, num_books)
+        if mode == 'bm25':
+            return self.bm25_matching(prompt, books, num_books)
+        if mode == 'hybrid':
+            return self.hybrid_matching(prompt, books, num_books)
+        return self.bert_matching(prompt, books, num_books)
+
+    def get_tfidf_index(self,books,col):
+        """Returns the TF-IDF index for a summary column.
+
+        Args:
             books (pd.DataFrame): a dataframe consiting of the book data
             col (str): The column containing the summary of interest
+
+        Returns:
+            TfidfIndex: the index for the column
         """
-        vectorizer = TfidfVectorizer()
-        prompt_vector = vectorizer.fit_transform([prompt])
+        return self._load_or_build_index(TfidfIndex, f"tfidf_{col}", books, col)
 
-        # Loop through each book summary
-        cosine_similarity_scores = []
-        for summary in books[col]:
-            if isinstance(summary, str):
-                # Calculate cosine similarity between summary and prompt
-                book_vector = vectorizer.transform([summary])
-                similarity = cosine_similarity(prompt_vector, book_vector)[0][0]
-            else:
-                # If summary is NaN, set similarity score to NaN
-                similarity = np.nan
-            cosine_similarity_scores.append(similarity)
+    def get_keyword_index(self,books):
+        """Returns the inverted index of the keywords in the Summary column.
 
-        # Add cosine_similarity column to books dataframe
-        books['cosine_similarity'] = cosine_similarity_scores
-        
-    def bert_matching(self,prompt, books):
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+
+        Returns:
+            InvertedIndex: the index for the Summary column
+        """
+        return self._load_or_build_index(InvertedIndex, "keywords_Summary", books, 'Summary')
+
+    def get_bm25_index(self,books):
+        """Returns the BM25 index of all the summary columns together, it is loaded from the index
+        folder if it was built from the same data.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+
+        Returns:
+            BM25Index: the index of the summary columns
+        """
+        return self._load_or_build_index(BM25Index, "bm25", books, SUMMARY_COLUMNS)
+
+    def _load_or_build_index(self,index_class,name,books,col,build=None,allow_build=True):
+        """Loads an index from the index folder if it was built from the same data.
+        Otherwise it is built once and saved for next time, or a FileNotFoundError is raised if building is not allowed.
+        An index rebuilt by another process is loaded again on the next call.
+
+        Args:
+            index_class (type): the index class, it must provide build, save and load
+            name (str): the name of the index folder
+            books (pd.DataFrame): a dataframe consiting of the book data
+            col (str): The column the index is built from, or a list of columns
+            build (function, optional): builds the index from the books and column. Defaults to index_class.build.
+            allow_build (bool, optional): build the index if it is missing or out of date. Defaults to True.
+
+        Returns:
+            the index for the column
+        """
+        index_path = os.path.join(self.index_dir, name)
+        # a saved index is swapped in as a new version folder, see index_utils.index_writer
+        loaded_path = os.path.realpath(index_path)
+        if name in self.indexes and self.index_paths[name] == loaded_path:
+            return self.indexes[name]
+
+        try:
+            index = index_class.load(loaded_path)
+            if index.version != fingerprint(books[col]):
+                index = None
+        except FileNotFoundError:
+            index = None
+
+        if index is None and not allow_build:
+            raise FileNotFoundError(f"No index of the current books in {index_path}, run build_indexes first")
+        if index is None:
+            index = (build or index_class.build)(books, col)
+            index.save(index_path)
+            loaded_path = os.path.realpath(index_path)
+
+        self.indexes[name] = index
+        self.index_paths[name] = loaded_path
+        return index
+
+    def build_indexes(self):
+        """Builds the keyword index, the BM25 index, the TF-IDF index of every summary column and the
+        approximate nearest neighbour index of the BERT summary embeddings and saves them to the index folder.
+        """
+        books = read_catalog(os.path.join(DATA_FOLDER_PATH, 'books_with_summaries.csv'), columns=SUMMARY_COLUMNS)
+        self.get_keyword_index(books)
+        self.get_bm25_index(books)
+        for col in SUMMARY_COLUMNS:
+            self.get_tfidf_index(books, col)
+        self.get_ann_index(books)
+
+    def bert_matching(self,prompt,books,num_books=3,use_ann=True,nprobe=None,prompt_embedding=None):
         """Calculates the cosine similarity between the prompt and each book summary in the data using
-        BERT embeddings instead of TF-IDF vectors.
+        BERT embeddings instead of TF-IDF vectors, and keeps the books with the highest scores.
 
         Args:
             prompt (str): a prompt to match to books
             books (pd.DataFrame): a dataframe consiting of the book data
+            num_books (int, optional): The number of books to return. Defaults to 3.
+            use_ann (bool, optional): search the approximate nearest neighbour index instead of
+                scoring every book. Defaults to True.
+            nprobe (int, optional): number of index lists to scan, higher is slower but more accurate.
+                Defaults to the nprobe of the index.
+            prompt_embedding (np.ndarray, optional): the embedding of the prompt if it was already encoded,
+                e.g. together with other prompts. Defaults to None (the prompt is encoded here).
+
+        Returns:
+            MatchResult: the best books, best first
         """
-        model_name = 'bert-base-uncased'
-        tokenizer = BertTokenizer.from_pretrained(model_name)
-        model = BertModel.from_pretrained(model_name)
+        if use_ann:
+            if prompt_embedding is None:
+                prompt_embedding = self.get_embedding_store().encode([prompt])[0]
+            indices, scores = self.get_ann_index(books).search(prompt_embedding, num_books, nprobe)
+        else:
+            # Only summaries that were never embedded go through the model
+            rows = self.get_embedding_rows(books)
+            scores = self.get_embedding_store().scores(prompt, rows)
+            indices, scores = top_k(np.nan_to_num(scores, nan=-np.inf), num_books)
+        return MatchResult.create(indices, scores)
 
-        book_summaries = books['Summary'].tolist()
-        book_ids = books.index.tolist()
+    def hybrid_matching(self,prompt,books,num_books=3,num_candidates=200,fusion='rrf',lexical_weight=0.5,nprobe=None,
+                        prompt_embedding=None):
+        """Finds books with one lexical and one dense search. BM25 over all the summary columns and the
+        approximate nearest neighbour index of the BERT embeddings each return their best candidates. Only
+        those candidates get both exact scores, which are fused into one ranking.
 
-        book_embeddings = []
-        for summary in book_summaries:
-            summary_tokens = tokenizer(summary, truncation=True, padding='max_length', max_length=512, return_tensors='pt')
-            with torch.no_grad():
-                summary_embedding = model(summary_tokens['input_ids'], summary_tokens['attention_mask'])[0][:, 0, :]
-                book_embeddings.append(summary_embedding)
+        Args:
+            prompt (str): a prompt to match to books
+            books (pd.DataFrame): a dataframe consiting of the book data
+            num_books (int, optional): The number of books to return. Defaults to 3.
+            num_candidates (int, optional): The number of candidates from each search. Defaults to 200.
+            fusion (str, optional): 'rrf' (reciprocal rank fusion) or 'weighted' (scaled score fusion). Defaults to 'rrf'.
+            lexical_weight (float, optional): the weight of BM25, the embeddings get the rest. Defaults to 0.5.
+            nprobe (int, optional): number of index lists to scan. Defaults to the nprobe of the index.
+            prompt_embedding (np.ndarray, optional): the embedding of the prompt if it was already encoded,
+                e.g. together with other prompts. Defaults to None (the prompt is encoded here).
 
-        book_embeddings = torch.cat(book_embeddings, dim=0)
-        book_embeddings = book_embeddings.reshape(len(book_summaries), -1)
-        print(book_embeddings)
-        prompt_tokens = tokenizer(prompt, truncation=True, padding='max_length', max_length=512, return_tensors='pt')
+        Returns:
+            MatchResult: the best books with their fused score, best first
+        """
+        bm25 = self.get_bm25_index(books)
+        lexical_ids, _ = bm25.query(prompt, num_candidates)
+        if prompt_embedding is None:
+            prompt_embedding = self.get_embedding_store().encode([prompt])[0]
+        ann = self.get_ann_index(books)
+        dense_ids, _ = ann.search(prompt_embedding, num_candidates, nprobe)
+        candidates = np.union1d(lexical_ids, dense_ids)
 
-        with torch.no_grad():
-            prompt_embedding = model(prompt_tokens['input_ids'], prompt_tokens['attention_mask'])[0][:, 0, :]
+        # Rerank the candidates with the exact score of both searches
+        lexical_scores = bm25.score_books(prompt, candidates)
+        rows = self.get_embedding_rows(books, ann.version)[candidates]
+        dense_scores = np.full(len(candidates), -np.inf, dtype=np.float32)
+        store = self.get_embedding_store()
+        dense_scores[rows >= 0] = store.vectors(rows[rows >= 0]) @ prompt_embedding.astype(store.dtype)
 
-        similarities = cosine_similarity(prompt_embedding.reshape(1, -1), book_embeddings).squeeze().tolist()
-        books['bert_cosine_similarity'] = similarities
-        
-    def combine_summaries(self):
-        """Combines the summaries from the different models into one dataframe.
+        fused = fuse_scores([lexical_scores, dense_scores], fusion, [lexical_weight, 1 - lexical_weight])
+        best, best_scores = top_k(fused, num_books)
+        return MatchResult.create(candidates[best], best_scores)
+
+    def get_ann_index(self,books,allow_build=True):
+        """Returns the approximate nearest neighbour index of the BERT summary embeddings.
+        The index is loaded from the index folder if it was built from the same data, otherwise
+        it is built once and saved for next time.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+            allow_build (bool, optional): embed the summaries and build the index if it is missing or
+                out of date, otherwise a FileNotFoundError is raised. Defaults to True.
+
+        Returns:
+            IVFIndex: the index of the Summary embeddings, its ids are positions in the dataframe
         """
-        books_df = pd.read_csv('../data/duke_books.csv')
-        abs_df = pd.read_csv('../data/duke_books_abstractive.csv')
-        ext_df = pd.read_csv('../data/extractive_summary_df.csv')
+        return self._load_or_build_index(IVFIndex, 'ann_Summary', books, 'Summary', self._build_ann_index, allow_build)
+
+    def load_dense_indexes(self,books):
+        """Loads everything the bert and hybrid searches need without building or embedding anything: the
+        approximate nearest neighbour index, the store row of every book and the BERT model. Servers call it
+        before answering requests (and before forking workers), so the first bert or hybrid query never
+        embeds the catalog. A FileNotFoundError means build_indexes has to run first, an OSError that the
+        model could not be loaded.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+
+        Returns:
+            IVFIndex: the index of the Summary embeddings
+        """
+        index = self.get_ann_index(books, allow_build=False)
+        self.get_embedding_rows(books, index.version, allow_build=False)
+        store = self.get_embedding_store()
+        store.load_model()
+        return index
+
+    def _build_ann_index(self,books,col):
+        rows = self.get_embedding_rows(books)
+        book_ids = np.flatnonzero(rows >= 0)
+        embeddings = self.get_embedding_store().vectors(rows[book_ids])
+        return IVFIndex.build(embeddings, ids=book_ids, version=fingerprint(books[col]))
+
+    def get_embedding_store(self):
+        """Returns the store of BERT summary embeddings, loading the model only once.
+
+        Returns:
+            EmbeddingStore: the embedding store in the index folder
+        """
+        if 'bert_embeddings' not in self.indexes:
+            self.indexes['bert_embeddings'] = EmbeddingStore(os.path.join(self.index_dir, 'bert_embeddings'))
+        return self.indexes['bert_embeddings']
+
+    def get_embedding_rows(self,books,version=None,allow_build=True):
+        """Returns the row of each book summary in the embedding store, embedding any new books first.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+            version (str, optional): the fingerprint of the Summary column if it is already known. Defaults to None.
+            allow_build (bool, optional): embed the summaries that are not in the store, otherwise a
+                FileNotFoundError is raised for them. Defaults to True.
+
+        Returns:
+            np.ndarray: the store row of each book, -1 for books without a summary
+        """
+        name = 'bert_rows_' + (version or fingerprint(books['Summary']))
+        if name not in self.indexes:
+            store = self.get_embedding_store()
+            summaries = books['Summary'].tolist()
+            if allow_build:
+                rows = store.update(summaries)
+            else:
+                rows = store.rows(summaries)
+                missing = sum(isinstance(summary, str) and row < 0 for summary, row in zip(summaries, rows))
+                if missing:
+                    raise FileNotFoundError(f"{missing} summaries are not in {store.store_dir}, run build_indexes first")
+            self.indexes[name] = rows
+        return self.indexes[name]
         
-        merged_data = books_df.copy()
-        merged_data = pd.merge(merged_data, abs_df[['Title','abbreviated_summary']], how='inner', on='Title')
-        merged_data = pd.merge(merged_data, ext_df[['Title','extractive_summary']], how='inner', on='Title')
+    def combine_summaries(self, merge_dir=None, num_partitions=32):
+        """Combines the summaries from the different models into one catalog. The books and both summary
+        files are joined on a stable book key (System ID, else OCLC, else a hash of the title and summary)
+        partition by partition, and the partitions of a source are only rebuilt when its file changes.
+
+        Args:
+            merge_dir (str, optional): the folder for the partitions. Defaults to the merge folder in the data folder.
+            num_partitions (int, optional): the number of partitions per source. Defaults to 32.
 
-        # drop duplicates based on the 'Title' column
-        merged_data.drop_duplicates(subset=['Title'], inplace=True)
-        merged_data.dropna(subset=['Summary'], inplace=True)
+        Returns:
+            pd.DataFrame: the rows each source contributed and lost
+        """
+        merger = SummaryMerger(merge_dir or os.path.join(DATA_FOLDER_PATH, 'merge'), num_partitions)
+        merger.update_source('books', os.path.join(DATA_FOLDER_PATH, 'duke_books.csv'))
+        merger.update_source('abstractive', os.path.join(DATA_FOLDER_PATH, 'duke_books_abstractive.csv'),
+                             columns=['abbreviated_summary'], alias_source='books')
+        merger.update_source('extractive', os.path.join(DATA_FOLDER_PATH, 'extractive_summary_df.csv'),
+                             columns=['extractive_summary'], alias_source='books')
 
-        # save the merged data to a new CSV file
-        merged_data.to_csv('../data/books_with_summaries.csv', index=False)
+        return merger.merge('books', {'abstractive': 'abbreviated_summary', 'extractive': 'extractive_summary'},
+                            os.path.join(DATA_FOLDER_PATH, 'books_with_summaries.parquet'))
         
     def get_matched_prompt_results(self,prompt,books,col):
         """Returns the cosine similarity score for the best matched book summary.
@@ -127,58 +463,78 @@ class PromptMatching:
             col (str): The column containing the summary of interest
             
         Returns:
-            pd.DataFrame: a dataframe containing the book that matches the prompt best
+            float: the cosine similarity of the book that matches the prompt best
 
         """
-        self.cosine_similarity(prompt,books,col)
-        matched = books.sort_values(by='cosine_similarity', ascending=False)
-        return matched.head(1)['cosine_similarity'].values[0]
+        result = self.cosine_similarity(prompt,books,col,num_books=1)
+        return result.scores[0] if len(result.scores) else np.nan
         
-    def run_validation_prompts(self):
-        """Runs the large scale validation using the generated prompts.
-        The results are saved to a CSV file.
+    def run_validation_prompts(self, k=10, num_workers=None):
+        """Runs the large scale validation using the generated prompts. Every search mode is run over
+        every prompt in parallel worker processes (see evaluation.run_evaluation). The result of every
+        prompt and the summary of every search are saved to CSV files, and the best cosine similarity of
+        each summary column and the Summary cosine similarity of the best BM25 book are saved to prompts_with_cs.csv.
+
+        Args:
+            k (int, optional): the number of books returned per prompt. Defaults to 10.
+            num_workers (int, optional): the number of worker processes. Defaults to the number of CPUs.
         """
-        validation_prompts = pd.read_csv('../data/validation_prompts.csv')
+        # imported here because the evaluation module imports this one
+        from evaluation import run_evaluation
+
+        validation_prompts = read_catalog('../data/validation_prompts.csv', columns=['prompt'])
         validation_prompts = validation_prompts['prompt'].tolist()
-        books = pd.read_csv('../data/books_with_summaries.csv')
-        # create empty dataframe to store results
-        results_df = pd.DataFrame(columns=['prompt', 'summary_cs', 'abb_summary_cs', 'ex_summary_cs'])
-    
-        for i, prompt in enumerate(validation_prompts):
-            cs = self.get_matched_prompt_results(prompt,books,'Summary')
-            ab_cs = self.get_matched_prompt_results(prompt,books,'abbreviated_summary')
-            ext_cs = self.get_matched_prompt_results(prompt,books,'extractive_summary')
-            
-            # create a new row for the results dataframe
-            new_row = {'prompt': prompt, 'summary_cs': cs, 'abb_summary_cs': ab_cs, 'ex_summary_cs': ext_cs}
-        
-            # append the row to the results dataframe
-            results_df = results_df.append(new_row, ignore_index=True)
-            
-        results_df.to_csv('../data/prompts_with_cs.csv', index=False) 
-        
+        results, summary = run_evaluation(validation_prompts, index_dir=self.index_dir, k=k, num_workers=num_workers)
+        results.to_csv('../data/evaluation_results.csv', index=False)
+        summary.to_csv('../data/evaluation_summary.csv', index=False)
+
+        # The top score of a cosine search is the best cosine similarity of its column
+        # A cosine search that failed in the workers has no rows, its column is left empty
+        result_cols = {'summary_cs': 'cosine_Summary', 'abb_summary_cs': 'cosine_abbreviated_summary',
+                       'ex_summary_cs': 'cosine_extractive_summary'}
+        top_scores = results.pivot(index='prompt_id', columns='search', values='score_at_1')
+        top_scores = top_scores.reindex(index=range(len(validation_prompts)), columns=list(result_cols.values()))
+        results_df = pd.DataFrame({'prompt': validation_prompts})
+        for result_col, search in result_cols.items():
+            results_df[result_col] = top_scores[search].values
+        bm25 = results[results['search'] == 'bm25'].set_index('prompt_id')['summary_cs_at_1']
+        results_df['bm25_summary_cs'] = bm25.reindex(range(len(validation_prompts))).values
+        results_df.to_csv('../data/prompts_with_cs.csv', index=False)
+
     def calculate_summary_metrics(self):
-        """Calculates the average cosine similarity for each summary type and prints the results.
-        A boxplot is also created for each summary type and saved into the imgs folder. 
+        """Prints the relevance and speed of every search from the last validation run, and the average
+        cosine similarity for each summary type. A boxplot is also created for each summary type, and one
+        of the Summary cosine similarity of the top book of every search, and saved into the imgs folder.
         """
         # Load the data
-        data = pd.read_csv('../data/prompts_with_cs.csv')
-        
+        results = pd.read_csv('../data/evaluation_results.csv')
+        summary = pd.read_csv('../data/evaluation_summary.csv')
+        print(summary.to_string(index=False))
+
         # Calculate the average cosine similarity for each prompt
-        avg_base_cs = data.groupby('prompt')['summary_cs'].mean()
-        avg_abb_cs = data.groupby('prompt')['abb_summary_cs'].mean()
-        avg_extract_cs = data.groupby('prompt')['ex_summary_cs'].mean()
-        
-        # Print the results
-        print(f"Average Cosine Similarity for Base Summary: {np.round(avg_base_cs.mean(), 4)}")
-        print(f"Average Cosine Similarity for Abstractive Summary: {np.round(avg_abb_cs.mean(), 4)}")
-        print(f"Average Cosine Similarity for Extractive Summary: {np.round(avg_extract_cs.mean(), 4)}")
-        
+        cosine = {}
+        for label, col in [('Base Summary', 'Summary'), ('Abstractive Summary', 'abbreviated_summary'),
+                           ('Extractive Summary', 'extractive_summary')]:
+            scores = results[results['search'] == f'cosine_{col}']
+            cosine[label] = scores.groupby('prompt')['score_at_1'].mean().dropna()
+            print(f"Average Cosine Similarity for {label}: {np.round(cosine[label].mean(), 4)}")
+
         # Create a boxplot for each
-        plt.boxplot([avg_base_cs, avg_abb_cs, avg_extract_cs], labels=['Base Summary', 'Abstractive Summary', 'Extractive Summary'])
+        plt.boxplot(list(cosine.values()), labels=list(cosine))
         plt.title("Cosine Similarity for each Summary Type")
         plt.ylabel("Cosine Similarity")
-        plt.savefig('../imgs/summary_boxplot.png') 
+        plt.savefig('../imgs/summary_boxplot.png')
+
+        # Compare every search with the same ruler
+        judged = results.dropna(subset=['summary_cs_at_1'])
+        searches = [search for search in summary['search'] if (judged['search'] == search).any()]
+        plt.figure()
+        plt.boxplot([judged.loc[judged['search'] == search, 'summary_cs_at_1'] for search in searches], labels=searches)
+        plt.title("Summary Cosine Similarity of the top book of each search")
+        plt.ylabel("Cosine Similarity")
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+        plt.savefig('../imgs/search_boxplot.png')
  
 # create main for this class
 
@@ -186,6 +542,7 @@ if __name__ == "__main__":
     # initialize this class
     prompt_matching = PromptMatching()
     #prompt_matching.combine_summaries()
+    #prompt_matching.build_indexes()
     #prompt_matching.run_validation_prompts()
     prompt_matching.calculate_summary_metrics()
     
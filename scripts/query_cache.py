@@ -0,0 +1,155 @@
+# Imports
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# the token pattern of the CountVectorizer and TfidfVectorizer behind the keyword, cosine and bm25 searches
+TOKEN_PATTERN = re.compile(r"(?u)\b\w\w+\b")
+LEXICAL_MODES = ('keyword', 'cosine', 'bm25')
+
+# create a class for caching search results
+class QueryCache:
+
+    def __init__(self, max_entries=1024, max_rows=1_000_000, ttl_seconds=3600):
+        """Constructor for the QueryCache class. A least recently used cache of search results. Every
+        entry remembers the version of the index it was computed from and is dropped once that version
+        changes, so rebuilt indexes never serve old results. The cache is safe to share between threads.
+
+        Args:
+            max_entries (int, optional): the maximum number of cached results. Defaults to 1024.
+            max_rows (int, optional): the maximum number of matched books over all cached results, keyword
+                searches can match a large part of the catalog. Defaults to 1_000_000.
+            ttl_seconds (float, optional): how long a result is kept, None keeps it until it is evicted. Defaults to 3600.
+        """
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.num_rows = 0
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'expired': 0, 'invalidated': 0, 'evicted': 0}
+
+    def get(self, key, version):
+        """Returns the cached result of a query.
+
+        Args:
+            key (tuple): the key of the query, see query_key
+            version (str): the version of the index the query runs on
+
+        Returns:
+            MatchResult: the cached result, or None if it is missing, expired or from another index version
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+
+            result, entry_version, expires = entry
+            if entry_version != version or (expires is not None and time.monotonic() > expires):
+                self.counts['invalidated' if entry_version != version else 'expired'] += 1
+                self.counts['misses'] += 1
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            return result
+
+    def put(self, key, version, result):
+        """Caches the result of a query, evicting the least recently used results when full.
+
+        Args:
+            key (tuple): the key of the query, see query_key
+            version (str): the version of the index the result was computed from
+            result (MatchResult): the result of the query
+        """
+        rows = len(result.indices)
+        if rows > self.max_rows:
+            return
+        expires = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (result, version, expires)
+            self.num_rows += rows
+            while len(self.entries) > self.max_entries or self.num_rows > self.max_rows:
+                self._remove(next(iter(self.entries)))
+                self.counts['evicted'] += 1
+
+    def get_or_compute(self, key, version, compute):
+        """Returns the cached result of a query, running the search on a miss. The search runs outside
+        the lock, so a slow search does not block hits from other threads.
+
+        Args:
+            key (tuple): the key of the query, see query_key
+            version (str): the version of the index the query runs on
+            compute (function): runs the search and returns its MatchResult
+
+        Returns:
+            MatchResult: the result of the query
+        """
+        result = self.get(key, version)
+        if result is None:
+            result = compute()
+            self.put(key, version, result)
+        return result
+
+    def clear(self):
+        """Drops every cached result, the counters are kept.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.num_rows = 0
+
+    def stats(self):
+        """Returns the counters of the cache.
+
+        Returns:
+            dict: the hits, misses, expired, invalidated and evicted results, the hit rate and the
+                number of cached results and matched books
+        """
+        with self.lock:
+            stats = dict(self.counts)
+            stats['entries'] = len(self.entries)
+            stats['rows'] = self.num_rows
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def _remove(self, key):
+        result, _, _ = self.entries.pop(key)
+        self.num_rows -= len(result.indices)
+
+##### Functions #####
+def normalize_prompt(prompt, mode):
+    """Normalizes a prompt so prompts that give the same results share a cache entry. Keyword, cosine
+    and bm25 searches only see the lowercase words of two or more characters, so the prompt is reduced to them.
+    The embedding model is uncased, so for bert only the case and whitespace are normalized.
+
+    Args:
+        prompt (str): a prompt to match to books
+        mode (str): the search mode
+
+    Returns:
+        str: the normalized prompt
+    """
+    prompt = prompt.lower()
+    if mode in LEXICAL_MODES:
+        return ' '.join(TOKEN_PATTERN.findall(prompt))
+    return ' '.join(prompt.split())
+
+def query_key(prompt, mode, col, k):
+    """Creates the cache key of a query.
+
+    Args:
+        prompt (str): a prompt to match to books
+        mode (str): the search mode
+        col (str): the column searched, only cosine searches depend on it
+        k (int): the number of books returned, None for every keyword match
+
+    Returns:
+        tuple: the normalized prompt, mode, column and k
+    """
+    return (normalize_prompt(prompt, mode), mode, col if mode == 'cosine' else None, k)
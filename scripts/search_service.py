@@ -0,0 +1,379 @@
+# Imports
+import argparse
+import json
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import requests
+import torch
+from catalog_store import read_catalog, ensure_catalog, APP_COLUMNS, SUMMARY_COLUMNS
+from prompt_matching import PromptMatching, DATA_FOLDER_PATH, INDEX_FOLDER_PATH, SEARCH_MODES
+from query_cache import QueryCache, query_key
+
+BOOKS_PATH = os.path.join(DATA_FOLDER_PATH, 'books_with_summaries.csv')
+
+# create a class for grouping concurrent requests into batches
+class MicroBatcher:
+
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=5):
+        """Constructor for the MicroBatcher class. Items submitted from many threads are collected by one
+        background thread and processed together, a batch is started once max_batch_size items are waiting
+        or the first item has waited max_wait_ms.
+
+        Args:
+            process_batch (function): takes a list of items and returns a list with one result per item
+            max_batch_size (int, optional): the maximum number of items per batch. Defaults to 32.
+            max_wait_ms (float, optional): how long the first item of a batch waits for more. Defaults to 5.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, item):
+        """Adds an item to the next batch and waits for its result.
+
+        Args:
+            item: the item to process
+
+        Returns:
+            the result of the item
+        """
+        future = Future()
+        self.queue.put((item, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            items, futures = zip(*batch)
+            try:
+                results = self.process_batch(list(items))
+                for future, result in zip(futures, results):
+                    future.set_result(result)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+
+
+# create a class for answering search requests
+class SearchService:
+
+    def __init__(self, books_path=BOOKS_PATH, index_dir=INDEX_FOLDER_PATH, max_batch_size=32, max_wait_ms=5,
+                 cache_entries=1024, cache_ttl_seconds=3600, dense=True):
+        """Constructor for the SearchService class. Loads the books, every lexical index and, unless dense is
+        False, the approximate nearest neighbour index, the embedding rows and the BERT model once. The index
+        arrays are memory-mapped and the model is loaded before any worker is forked, so worker processes
+        share them instead of loading their own. Nothing is built here, missing or outdated embedding indexes
+        raise a FileNotFoundError (run PromptMatching.build_indexes first) and a missing model an OSError.
+        Every worker keeps its own cache of recent results.
+
+        Args:
+            books_path (str, optional): the path of the book catalog. Defaults to ../data/books_with_summaries.csv.
+            index_dir (str, optional): the folder where the search indexes are stored. Defaults to ../data/indexes.
+            max_batch_size (int, optional): the maximum number of bert and hybrid prompts encoded together. Defaults to 32.
+            max_wait_ms (float, optional): how long a bert or hybrid prompt waits for others to batch with. Defaults to 5.
+            cache_entries (int, optional): the number of results cached per worker, 0 disables the cache. Defaults to 1024.
+            cache_ttl_seconds (float, optional): how long a result stays cached. Defaults to 3600.
+            dense (bool, optional): serve the bert and hybrid searches, otherwise they are rejected. Defaults to True.
+        """
+        self.books = read_catalog(ensure_catalog(books_path), columns=APP_COLUMNS)
+        query_cache = QueryCache(cache_entries, ttl_seconds=cache_ttl_seconds) if cache_entries else None
+        self.pm = PromptMatching(index_dir=index_dir, query_cache=query_cache)
+        self.pm.get_keyword_index(self.books)
+        self.pm.get_bm25_index(self.books)
+        for col in SUMMARY_COLUMNS:
+            self.pm.get_tfidf_index(self.books, col)
+        self.dense = dense
+        if dense:
+            self.pm.load_dense_indexes(self.books)
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.batcher = None
+
+    def start_worker(self):
+        """Prepares a worker process, the batching thread does not survive a fork so each worker starts its own.
+        The intra-op thread pool of torch is not safe to use after a fork, so the worker runs the model on
+        one thread, more CPUs are used by running more workers.
+        """
+        torch.set_num_threads(1)
+        self.batcher = MicroBatcher(self._encode_batch, self.max_batch_size, self.max_wait_ms)
+
+    def search(self, request):
+        """Answers one search request.
+
+        Args:
+            request (dict): the prompt, the mode (one of SEARCH_MODES), the column for cosine and k,
+                the number of books (null returns every keyword match)
+
+        Returns:
+            dict: the matched books with their score, and the time the search took
+        """
+        start = time.perf_counter()
+        prompt = request.get('prompt')
+        mode = request.get('mode', 'cosine')
+        col = request.get('column', 'Summary')
+        k = request.get('k', 3)
+        if not isinstance(prompt, str) or not prompt.strip():
+            raise ValueError("prompt must be a non empty string")
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"Unknown search mode {mode}, choose one of {SEARCH_MODES}")
+        if col not in SUMMARY_COLUMNS:
+            raise ValueError(f"Unknown column {col}, choose one of {SUMMARY_COLUMNS}")
+        if k is not None and (isinstance(k, bool) or not isinstance(k, int) or k < 1):
+            raise ValueError("k must be a positive integer or null")
+        if mode in ('bert', 'hybrid') and not self.dense:
+            raise ValueError(f"The {mode} search is not served, the service runs lexical searches only")
+
+        if mode in ('bert', 'hybrid') and self.pm.query_cache is not None:
+            result = self.pm.query_cache.get_or_compute(query_key(prompt, mode, col, k or 3),
+                                                        self.pm.index_version(self.books, mode),
+                                                        lambda: self._dense_search(prompt, mode, k or 3))
+        elif mode in ('bert', 'hybrid'):
+            result = self._dense_search(prompt, mode, k or 3)
+        else:
+            result = self.pm.search(prompt, self.books, mode, col, k)
+
+        # json has no NaN, missing values are sent as null
+        records = [{key: None if isinstance(value, float) and value != value else value for key, value in record.items()}
+                   for record in result.rows(self.books, 'score').to_dict(orient='records')]
+        return {'mode': mode, 'column': col, 'k': k, 'results': records,
+                'took_ms': (time.perf_counter() - start) * 1000}
+
+    def stats(self):
+        """Returns the query cache counters of this worker.
+
+        Returns:
+            dict: the counters of the cache, see QueryCache.stats, or an empty dict without a cache
+        """
+        return self.pm.query_cache.stats() if self.pm.query_cache is not None else {}
+
+    def _dense_search(self, prompt, mode, k):
+        """Runs a bert or hybrid search. The prompt is encoded together with the prompts of the other
+        bert and hybrid requests in flight.
+
+        Args:
+            prompt (str): a prompt to match to books
+            mode (str): 'bert' or 'hybrid'
+            k (int): the number of books
+
+        Returns:
+            MatchResult: the best books, best first
+        """
+        prompt_embedding = self.batcher.submit(prompt)
+        if mode == 'bert':
+            return self.pm.bert_matching(prompt, self.books, k, prompt_embedding=prompt_embedding)
+        return self.pm.hybrid_matching(prompt, self.books, k, prompt_embedding=prompt_embedding)
+
+    def _encode_batch(self, prompts):
+        """Encodes the prompts of a batch of bert and hybrid requests together.
+
+        Args:
+            prompts (list): the prompts
+
+        Returns:
+            list: one embedding per prompt
+        """
+        return list(self.pm.get_embedding_store().encode(prompts))
+
+
+# create a class for calling the search service
+class SearchClient:
+
+    def __init__(self, base_url, timeout=30):
+        """Constructor for the SearchClient class. Keeps one HTTP session so connections are reused.
+
+        Args:
+            base_url (str): the url of the search service, e.g. http://127.0.0.1:8502
+            timeout (float, optional): the timeout of a request in seconds. Defaults to 30.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def search(self, prompt, mode, column='Summary', k=3):
+        """Searches for books.
+
+        Args:
+            prompt (str): any prompt to search for books
+            mode (str): one of SEARCH_MODES
+            column (str, optional): the column containing the summary of interest for cosine. Defaults to 'Summary'.
+            k (int, optional): the number of books to return, None returns every keyword match. Defaults to 3.
+
+        Returns:
+            pd.DataFrame: the matched books with a score column, best first
+        """
+        response = self.session.post(self.base_url + '/search', json={'prompt': prompt, 'mode': mode,
+                                                                       'column': column, 'k': k},
+                                     timeout=self.timeout)
+        if response.status_code != 200:
+            raise RuntimeError(f"Search failed ({response.status_code}): {response.text}")
+        return pd.DataFrame(response.json()['results'], columns=APP_COLUMNS + ['score'])
+
+##### Functions #####
+def serve(service, host='127.0.0.1', port=8502, num_workers=4):
+    """Serves the /search endpoint from several worker processes. The listening socket and the loaded
+    service are created before forking, so every worker accepts from the same port and shares the
+    memory-mapped indexes and the BERT model. Each worker answers requests on threads so the prompts of
+    bert and hybrid requests are encoded in batches, and runs the model on one thread (see start_worker).
+
+    Args:
+        service (SearchService): the loaded search service
+        host (str, optional): the address to listen on. Defaults to '127.0.0.1'.
+        port (int, optional): the port to listen on. Defaults to 8502.
+        num_workers (int, optional): the number of worker processes. Defaults to 4.
+    """
+    sock = socket.create_server((host, port), backlog=1024)
+    children = []
+    for _ in range(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(service, sock)
+            os._exit(0)
+        children.append(pid)
+
+    print(f"Serving on http://{host}:{port} with {num_workers} workers")
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sock.close()
+
+def load_test(base_url, prompts, mode='cosine', column='Summary', k=3, concurrency=8, num_requests=1000):
+    """Sends search requests from several threads and measures their latency.
+
+    Args:
+        base_url (str): the url of the search service
+        prompts (list): the prompts to send, cycled through
+        mode (str, optional): the search mode. Defaults to 'cosine'.
+        column (str, optional): the column for cosine. Defaults to 'Summary'.
+        k (int, optional): the number of books per request. Defaults to 3.
+        concurrency (int, optional): the number of requests in flight. Defaults to 8.
+        num_requests (int, optional): the total number of requests. Defaults to 1000.
+
+    Returns:
+        dict: the throughput and the p50, p95 and p99 latency in milliseconds
+    """
+    clients = threading.local()
+
+    def send(i):
+        if not hasattr(clients, 'client'):
+            clients.client = SearchClient(base_url)
+        start = time.perf_counter()
+        clients.client.search(prompts[i % len(prompts)], mode, column, k)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = np.array(list(executor.map(send, range(num_requests))))
+    seconds = time.perf_counter() - start
+
+    report = {'mode': mode, 'column': column, 'requests': num_requests, 'concurrency': concurrency,
+              'requests_per_sec': num_requests / seconds, 'mean_ms': latencies.mean(),
+              'p50_ms': np.percentile(latencies, 50), 'p95_ms': np.percentile(latencies, 95),
+              'p99_ms': np.percentile(latencies, 99)}
+    print(', '.join(f"{key}: {value:.2f}" if isinstance(value, float) else f"{key}: {value}"
+                    for key, value in report.items()))
+    return report
+
+##### Helper Functions #####
+def _run_worker(service, sock):
+    """Answers requests on the shared socket until the process is terminated.
+
+    Args:
+        service (SearchService): the loaded search service
+        sock (socket.socket): the listening socket created before forking
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    service.start_worker()
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # the headers and body are separate writes, without this each response waits for a delayed ack
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok', 'pid': os.getpid()})
+            elif self.path == '/stats':
+                self._send(200, {'pid': os.getpid(), 'cache': service.stats()})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/search':
+                self._send(404, {'error': 'not found'})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                self._send(200, service.search(request))
+            except (ValueError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+            except Exception as e:
+                self._send(500, {'error': str(e)})
+
+        def _send(self, status, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(sock.getsockname(), SearchHandler, bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.serve_forever()
+
+
+# create main
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the book search over HTTP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--books', default=BOOKS_PATH)
+    parser.add_argument('--index-dir', default=INDEX_FOLDER_PATH)
+    parser.add_argument('--cache-entries', type=int, default=1024)
+    parser.add_argument('--cache-ttl', type=float, default=3600)
+    parser.add_argument('--lexical-only', action='store_true', help="serve without the bert and hybrid searches")
+    args = parser.parse_args()
+
+    try:
+        service = SearchService(args.books, args.index_dir, cache_entries=args.cache_entries,
+                                cache_ttl_seconds=args.cache_ttl, dense=not args.lexical_only)
+    except OSError as e:
+        raise SystemExit(f"Cannot serve the bert and hybrid searches: {e}\n"
+                         "Build the indexes with PromptMatching().build_indexes() or start with --lexical-only")
+    serve(service, args.host, args.port, args.workers)
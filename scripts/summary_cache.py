@@ -0,0 +1,176 @@
+# Imports
+import hashlib
+import json
+import sqlite3
+import time
+
+# number of stored values between two size checks, the size check scans the whole table
+EVICT_INTERVAL = 256
+# seconds before the last access time of an entry is updated again, so most hits only read
+ACCESS_RESOLUTION = 3600
+
+# create a class for caching generated summaries on disk
+class SummaryCache:
+
+    def __init__(self, path, max_bytes=1 << 30):
+        """Constructor for the SummaryCache class. Summaries are stored in a SQLite file keyed by a hash of the
+        model name, its parameters and the input text, so only new or edited inputs are ever recomputed.
+        When the cache grows past max_bytes the least recently used entries are evicted. The size is
+        checked every EVICT_INTERVAL stored values, so it can briefly exceed max_bytes by that many values.
+        Hits do not write to the file. The access times of hit entries are kept in memory and written together
+        with the next stored values, before an eviction or once EVICT_INTERVAL of them are waiting, and only
+        for entries not accessed in the last ACCESS_RESOLUTION seconds, so the least recently used order is
+        kept at that resolution.
+
+        Args:
+            path (str): the path of the SQLite file, it is created if it does not exist
+            max_bytes (int, optional): the maximum total size of the cached values. Defaults to 1 GB.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._puts_since_evict = 0
+        self._access_times = {}
+
+        # WAL lets several worker processes read while one writes
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                          "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS summaries_last_access ON summaries (last_access)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(model_name, params, text):
+        """Creates the cache key of a summary.
+
+        Args:
+            model_name (str): the name of the model or method that generates the summary
+            params (dict): the parameters that change the output of the model
+            text (str): the input text
+
+        Returns:
+            str: the sha256 hex digest of the model name, parameters and text
+        """
+        return hashlib.sha256(json.dumps([model_name, params, text], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Looks up one cached value.
+
+        Args:
+            key (str): a key created with make_key
+
+        Returns:
+            the cached value, or None on a miss
+        """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Looks up many cached values at once and marks them as recently used. The access times are
+        only buffered, see flush_access_times.
+
+        Args:
+            keys (list): keys created with make_key
+
+        Returns:
+            dict: the cached value of every key that was found
+        """
+        found = {}
+        now = time.time()
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            rows = self.conn.execute(f"SELECT key, value, last_access FROM summaries WHERE key IN ({','.join('?' * len(chunk))})",
+                                     chunk).fetchall()
+            for key, value, last_access in rows:
+                found[key] = json.loads(value)
+                if last_access < now - ACCESS_RESOLUTION:
+                    self._access_times[key] = now
+
+        if len(self._access_times) >= EVICT_INTERVAL:
+            self.flush_access_times()
+        self.hits += sum(key in found for key in keys)
+        self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put(self, key, value):
+        """Stores one value.
+
+        Args:
+            key (str): a key created with make_key
+            value: any json serializable value
+        """
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        """Stores many values at once, then evicts the least recently used entries if the cache is too big.
+
+        Args:
+            items (dict): maps keys created with make_key to json serializable values
+        """
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        self.conn.executemany("INSERT OR REPLACE INTO summaries (key, value, size, last_access) VALUES (?, ?, ?, ?)", rows)
+        for key in items:
+            self._access_times.pop(key, None)
+        # the buffered access times go into the same transaction as the new values
+        self._write_access_times()
+        self.conn.commit()
+
+        self._puts_since_evict += len(rows)
+        if self._puts_since_evict >= EVICT_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in max_bytes.
+        """
+        self._puts_since_evict = 0
+        self.flush_access_times()
+        total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+        excess = total_bytes - self.max_bytes
+        if excess <= 0:
+            return
+
+        # Walk the entries from least recently used until enough space is freed
+        to_delete = []
+        freed = 0
+        for key, size in self.conn.execute("SELECT key, size FROM summaries ORDER BY last_access"):
+            to_delete.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM summaries WHERE key = ?", to_delete)
+        self.conn.commit()
+
+    def flush_access_times(self):
+        """Writes the buffered access times of the entries hit since the last write.
+        """
+        if self._access_times:
+            self._write_access_times()
+            self.conn.commit()
+
+    def close(self):
+        """Writes the buffered access times and closes the SQLite file.
+        """
+        self.flush_access_times()
+        self.conn.close()
+
+    def _write_access_times(self):
+        self.conn.executemany("UPDATE summaries SET last_access = ? WHERE key = ?",
+                              [(now, key) for key, now in self._access_times.items()])
+        self._access_times = {}
+
+    def stats(self):
+        """Returns the hit and miss counters of this process and the size of the cache.
+
+        Returns:
+            dict: hits, misses, hit rate, number of entries and total bytes
+        """
+        entries, total_bytes = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM summaries").fetchone()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries, 'bytes': total_bytes}
@@ -9,22 +9,44 @@ from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-import tensorflow as tf
+import resource
+from collections import Counter
+import time
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from checkpointing import ShardedJobRunner
+from summary_cache import SummaryCache
+from inference_backends import load_backend
+from summary_merge import KEY_COLUMNS
+
+MODEL_NAME = "sshleifer/distilbart-cnn-12-6"
+# generation parameters, they are part of the cache key
+GENERATION_PARAMS = {'max_length': 200, 'min_length': 100, 'length_penalty': 1.0, 'num_beams': 4, 'early_stopping': True}
 
 
 class SummaryGenerator:
     
-    def __init__(self, filename):
+    def __init__(self, filename=None, num_threads=None, cache=None, backend='torch'):
         """Constructor for SummaryGenerator class
 
         Args:
-            filename (str): the path to the csv file containing the book data
+            filename (str, optional): the path to the csv file containing the book data. Defaults to None (no data).
+            num_threads (int, optional): number of CPU threads used by torch. Defaults to the torch default.
+            cache (SummaryCache, optional): cache of generated summaries, books whose text did not change
+                are not summarized again. Defaults to None.
+            backend (str, optional): how the model is run, 'torch' (full precision), 'int8' (dynamically
+                quantized linear layers) or 'onnx' (ONNX Runtime). Defaults to 'torch'.
         """
-        self.book_data = pd.read_csv(filename)
-        #drop NA values for now
-        self.book_data = self.book_data.dropna(subset = ['Summary']).reset_index(drop = True)
-        self.model = AutoModelForSeq2SeqLM.from_pretrained("sshleifer/distilbart-cnn-12-6")
-        self.tokenizer = AutoTokenizer.from_pretrained("sshleifer/distilbart-cnn-12-6")
+        self.cache = cache
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.book_data = None
+        if filename is not None:
+            self.book_data = pd.read_csv(filename, dtype={col: str for col in KEY_COLUMNS})
+            #drop NA values for now
+            self.book_data = self.book_data.dropna(subset = ['Summary']).reset_index(drop = True)
+        self.backend = load_backend(backend, MODEL_NAME)
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
         
     def word_count(self, text):
         """Returns the number of words in a string.
@@ -47,17 +69,53 @@ class SummaryGenerator:
         Returns:
             summary (str): the truncated summary
         """
-        inputs = self.tokenizer(input_text, return_tensors="pt", max_length=1024, truncation=True)
-        outputs = self.model.generate(inputs["input_ids"], max_length=200, min_length=100, length_penalty=1.0, num_beams=4, early_stopping=True)
-        summary = self.tokenizer.decode(outputs[0])
-        summary = summary.split('</s>')[-2].split('<s>')[-1].strip()
-        return summary 
+        return self.truncate_summaries([input_text], batch_size=1)[0]
+
+    def truncate_summaries(self,input_texts,batch_size=8):
+        """Truncates many summaries at once. The inputs are sorted by token length so that each
+        batch holds inputs of similar length and is only padded to its longest input.
+
+        Args:
+            input_texts (list): the strings to be used as summaries
+            batch_size (int, optional): the number of summaries generated together. Defaults to 8.
+
+        Returns:
+            summaries (list): the truncated summaries, in the same order as the inputs
+        """
+        input_texts = list(input_texts)
+        summaries = [None] * len(input_texts)
+
+        # Only generate the summaries that are not cached yet
+        if self.cache is not None:
+            cache_keys = [self.cache.make_key(self.backend.cache_name, GENERATION_PARAMS, text) for text in input_texts]
+            cached = self.cache.get_many(cache_keys)
+            for i, key in enumerate(cache_keys):
+                summaries[i] = cached.get(key)
+        to_generate = [i for i, summary in enumerate(summaries) if summary is None]
+        if not to_generate:
+            return summaries
+
+        encoded = self.tokenizer([input_texts[i] for i in to_generate], max_length=1024, truncation=True)['input_ids']
+        order = np.argsort([len(ids) for ids in encoded], kind='stable')
+
+        with torch.inference_mode():
+            for start in range(0, len(order), batch_size):
+                batch_idx = order[start:start + batch_size]
+                inputs = self.tokenizer.pad({'input_ids': [encoded[i] for i in batch_idx]}, return_tensors="pt")
+                outputs = self.backend.generate(inputs["input_ids"], inputs["attention_mask"], **GENERATION_PARAMS)
+                for i, summary in zip(batch_idx, self.tokenizer.batch_decode(outputs, skip_special_tokens=True)):
+                    summaries[to_generate[i]] = summary.strip()
 
-    def abstractive_summary(self,books):
+        if self.cache is not None:
+            self.cache.put_many({cache_keys[i]: summaries[i] for i in to_generate})
+        return summaries
+
+    def abstractive_summary(self,books,batch_size=8):
         """Generates an abstractive summary for each book in the dataframe.
 
         Args:
             books (pd.DataFrame): a dataframe containing the book data
+            batch_size (int, optional): the number of summaries generated together. Defaults to 8.
 
         Returns:
             book_long (pd.DataFrame): a dataframe containing the book data and the new abstractive summaries
@@ -66,37 +124,171 @@ class SummaryGenerator:
         #filter for books with longer summaries
         book_long = books[books['word_count'] >= 100] 
         
-        #drop everything but title and summary 
-        book_long = book_long.loc[:, ['Title', 'Summary']]
+        #drop everything but the book identifiers, title and summary 
+        book_long = book_long.loc[:, [col for col in KEY_COLUMNS if col in book_long.columns] + ['Title', 'Summary']]
 
         # generate full text by concatenating Title and Summary columns
         book_long['full_text'] = book_long['Title'] + ' ' + book_long['Summary']
 
-        book_long['abbreviated_summary'] = book_long['full_text'].apply(self.truncate_summary)
+        book_long['abbreviated_summary'] = self.truncate_summaries(book_long['full_text'].tolist(), batch_size)
         return book_long
     
-    def save_abstractive_summaries(self):
-        """Saves the abstractive summaries to a csv file.
+    def benchmark_batch_sizes(self,num_books=32,batch_sizes=(1,2,4,8,16)):
+        """Measures the generation throughput for different batch sizes on the current host.
+
+        Args:
+            num_books (int, optional): the number of long summaries to generate per batch size. Defaults to 32.
+            batch_sizes (tuple, optional): the batch sizes to test. Defaults to (1,2,4,8,16).
+
+        Returns:
+            pd.DataFrame: the seconds taken and books per second for each batch size
         """
-        # Assuming self.book_data is a pandas dataframe
-        num_records = len(self.book_data)
-        batch_size = 100
+        books = self.book_data[self.book_data['Summary'].apply(self.word_count) >= 100].head(num_books)
+        input_texts = (books['Title'] + ' ' + books['Summary']).tolist()
 
-        for i in range(0, num_records, batch_size):
-            batch = self.book_data.iloc[i:i+batch_size]
-            results = self.abstractive_summary(batch)
-            results.to_csv('data/duke_books_abstractive.csv', mode='a', header=(i==0))
+        # Bypass the cache, otherwise every run after the first would only measure cache hits
+        cache, self.cache = self.cache, None
+        results = []
+        try:
+            for batch_size in batch_sizes:
+                start = time.perf_counter()
+                self.truncate_summaries(input_texts, batch_size)
+                seconds = time.perf_counter() - start
+                results.append({'batch_size': batch_size, 'threads': torch.get_num_threads(), 'books': len(input_texts),
+                                'seconds': seconds, 'books_per_sec': len(input_texts) / seconds})
+        finally:
+            # restore the cache even if a batch size fails, e.g. runs out of memory
+            self.cache = cache
+
+        results = pd.DataFrame(results)
+        print(results.to_string(index=False))
+        return results
+
+    def save_abstractive_summaries(self,output_path='data/duke_books_abstractive.csv',shard_dir=None,batch_size=100):
+        """Saves the abstractive summaries to a csv file. Each batch of books is written to its own shard
+        and recorded in a manifest, so a restarted run skips the books that were already summarized.
+        The shards are merged into the output file at the end.
+
+        Args:
+            output_path (str, optional): the path of the csv file. Defaults to 'data/duke_books_abstractive.csv'.
+            shard_dir (str, optional): the folder for the shards and manifest. Defaults to the output path + '.shards'.
+            batch_size (int, optional): the number of books per shard. Defaults to 100.
+        """
+        runner = ShardedJobRunner(shard_dir or output_path + '.shards', batch_size)
+        runner.run(self.book_data, self.abstractive_summary)
+        runner.merge(output_path)
+
+def benchmark_backends(filename, sample_size=20, backends=('torch', 'int8', 'onnx'), num_threads=None, seed=0):
+    """Compares the inference backends on a fixed random sample of long summaries. Each backend runs in
+    its own process so its peak memory is measured separately. The summaries of every backend are compared
+    to the full precision torch summaries with ROUGE-1 and ROUGE-L F1.
+
+    Args:
+        filename (str): the path to the csv file containing the book data
+        sample_size (int, optional): the number of books to summarize. Defaults to 20.
+        backends (tuple, optional): the backends to compare, the first one is the reference. Defaults to ('torch', 'int8', 'onnx').
+        num_threads (int, optional): number of CPU threads used by torch. Defaults to the torch default.
+        seed (int, optional): the random seed of the sample. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: latency percentiles, throughput, peak RSS and ROUGE drift of each backend
+    """
+    books = pd.read_csv(filename).dropna(subset = ['Summary'])
+    books = books[books['Summary'].apply(lambda x: len(x.split())) >= 100].sample(sample_size, random_state=seed)
+    input_texts = (books['Title'] + ' ' + books['Summary']).tolist()
+
+    results = []
+    reference = None
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            summaries, latencies, peak_rss_mb = executor.submit(_run_backend, backend, input_texts, num_threads).result()
+        if reference is None:
+            reference = summaries
+
+        results.append({'backend': backend, 'books': len(input_texts),
+                        'p50_latency_s': np.percentile(latencies, 50), 'p95_latency_s': np.percentile(latencies, 95),
+                        'books_per_sec': len(latencies) / sum(latencies), 'peak_rss_mb': peak_rss_mb,
+                        'rouge1_f_vs_ref': np.mean([_rouge_n(ref, summary, 1) for ref, summary in zip(reference, summaries)]),
+                        'rougeL_f_vs_ref': np.mean([_rouge_l(ref, summary) for ref, summary in zip(reference, summaries)])})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+    return results
+
+##### Helper Functions #####
+def _run_backend(backend, input_texts, num_threads):
+    """Summarizes the texts one at a time with a backend. Runs in a fresh process for benchmark_backends.
+
+    Args:
+        backend (str): the name of the backend
+        input_texts (list): the texts to summarize
+        num_threads (int): number of CPU threads used by torch
+
+    Returns:
+        summaries (list): the summaries
+        latencies (list): the seconds taken by each summary
+        peak_rss_mb (float): the peak resident memory of the process in MB
+    """
+    summary_generator = SummaryGenerator(num_threads=num_threads, backend=backend)
+    summaries = []
+    latencies = []
+    for text in input_texts:
+        start = time.perf_counter()
+        summaries.append(summary_generator.truncate_summary(text))
+        latencies.append(time.perf_counter() - start)
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return summaries, latencies, peak_rss_mb
+
+def _rouge_n(reference, candidate, n):
+    """Calculates the ROUGE-N F1 score between two texts.
+
+    Args:
+        reference (str): the reference text
+        candidate (str): the text to compare
+        n (int): the n-gram size
+
+    Returns:
+        float: the ROUGE-N F1 score
+    """
+    ngrams = lambda words: Counter(tuple(words[i:i + n]) for i in range(len(words) - n + 1))
+    reference_ngrams = ngrams(reference.lower().split())
+    candidate_ngrams = ngrams(candidate.lower().split())
+    overlap = sum((reference_ngrams & candidate_ngrams).values())
+    if overlap == 0:
+        return 0.0
+    precision = overlap / sum(candidate_ngrams.values())
+    recall = overlap / sum(reference_ngrams.values())
+    return 2 * precision * recall / (precision + recall)
+
+def _rouge_l(reference, candidate):
+    """Calculates the ROUGE-L F1 score (longest common subsequence of words) between two texts.
+
+    Args:
+        reference (str): the reference text
+        candidate (str): the text to compare
+
+    Returns:
+        float: the ROUGE-L F1 score
+    """
+    reference_words = reference.lower().split()
+    candidate_words = candidate.lower().split()
+    lcs = [0] * (len(candidate_words) + 1)
+    for reference_word in reference_words:
+        previous = 0
+        for j, candidate_word in enumerate(candidate_words):
+            current = lcs[j + 1]
+            lcs[j + 1] = previous + 1 if reference_word == candidate_word else max(lcs[j + 1], lcs[j])
+            previous = current
+    if lcs[-1] == 0:
+        return 0.0
+    precision = lcs[-1] / len(candidate_words)
+    recall = lcs[-1] / len(reference_words)
+    return 2 * precision * recall / (precision + recall)
 
 if __name__ == "__main__":
-    # initialize TPU
-    resolver = tf.distribute.cluster_resolver.TPUClusterResolver(tpu='')
-    tf.config.experimental_connect_to_cluster(resolver)
-    tf.tpu.experimental.initialize_tpu_system(resolver)
-    strategy = tf.distribute.TPUStrategy(resolver)
-
-    with strategy.scope():
-        # initialize this class
-        summary_generator = SummaryGenerator('data/duke_books.csv')
-        summary_generator.save_abstractive_summaries()
-        
-            
\ No newline at end of file
+    # compare the CPU backends before picking one for the full run
+    #benchmark_backends('data/duke_books.csv')
+
+    # initialize this class
+    summary_generator = SummaryGenerator('data/duke_books.csv', cache=SummaryCache('data/summary_cache.sqlite'))
+    summary_generator.save_abstractive_summaries()
@@ -0,0 +1,284 @@
+# Imports
+import hashlib
+import json
+import os
+import shutil
+import zlib
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from catalog_store import ensure_catalog, iter_catalog, catalog_schema
+
+# the identifiers that name a book, in order of preference
+KEY_COLUMNS = ['System ID', 'OCLC']
+MANIFEST_FILENAME = "manifest.json"
+
+# create a class for merging the generated summaries into the book catalog
+class SummaryMerger:
+
+    def __init__(self, merge_dir, num_partitions=32, chunksize=50_000):
+        """Constructor for the SummaryMerger class. Every source is read in chunks and split into
+        num_partitions files by the hash of its book key, so matching rows of all sources land in the same
+        partition and only one partition of each source is in memory at a time. The partitions are kept
+        in merge_dir, and a source is only partitioned again when its file changes.
+
+        Args:
+            merge_dir (str): the folder containing the partitions and the manifest
+            num_partitions (int, optional): the number of partitions per source. Defaults to 32.
+            chunksize (int, optional): the number of rows read at once. Defaults to 50_000.
+        """
+        self.merge_dir = merge_dir
+        self.num_partitions = num_partitions
+        self.chunksize = chunksize
+        os.makedirs(merge_dir, exist_ok=True)
+
+        self.manifest = {}
+        manifest_path = os.path.join(merge_dir, MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                self.manifest = json.load(f)
+
+    def update_source(self, name, path, columns=None, alias_source=None):
+        """Partitions a source by book key, unless its partitions are already up to date.
+
+        Args:
+            name (str): the name of the source
+            path (str): the path of the csv, tsv or parquet file of the source
+            columns (list, optional): the columns to keep besides the book key. Defaults to all columns.
+            alias_source (str, optional): a partitioned source whose content keys resolve the books of this
+                source if it has none of the KEY_COLUMNS, e.g. summaries written before the generators
+                carried the identifiers. Defaults to None.
+
+        Returns:
+            bool: True if the source was partitioned again
+        """
+        parquet_path = ensure_catalog(path)
+        stat = os.stat(parquet_path)
+        has_keys = any(col in KEY_COLUMNS for col in pq.read_schema(parquet_path).names)
+        alias_source = None if has_keys else alias_source
+        version = {'path': os.path.abspath(parquet_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                   'columns': columns, 'num_partitions': self.num_partitions,
+                   'aliases': self.manifest.get(alias_source) if alias_source else None}
+        if self.manifest.get(name) == version and os.path.isdir(self._source_dir(name)):
+            return False
+
+        aliases = self.aliases(alias_source) if alias_source else None
+        source_dir = self._source_dir(name)
+        shutil.rmtree(source_dir, ignore_errors=True)
+        os.makedirs(source_dir)
+
+        writers = {}
+        num_rows = 0
+        try:
+            for chunk in iter_catalog(parquet_path, chunksize=self.chunksize):
+                keys = book_keys(chunk, aliases)
+                content_keys = content_key(chunk)
+                if columns is not None:
+                    chunk = chunk[[col for col in columns if col in chunk.columns]]
+                chunk = chunk.assign(book_key=keys.values, content_key=content_keys.values,
+                                     row_number=np.arange(num_rows, num_rows + len(chunk)))
+                num_rows += len(chunk)
+
+                partitions = _partition_of(chunk['book_key'], self.num_partitions)
+                for partition, rows in chunk.groupby(partitions, sort=False):
+                    table = pa.Table.from_pandas(rows, schema=_partition_schema(rows.columns), preserve_index=False)
+                    if partition not in writers:
+                        writers[partition] = pq.ParquetWriter(self._partition_path(name, partition), table.schema)
+                    writers[partition].write_table(table)
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        self.manifest[name] = version
+        self._save_manifest()
+        return True
+
+    def aliases(self, name):
+        """Maps the content key of every book of a partitioned source to its book key. Sources written
+        before the generators carried the identifier columns are matched to the books through it.
+
+        Args:
+            name (str): the name of a partitioned source
+
+        Returns:
+            dict: content key to book key, for the books whose book key is an identifier
+        """
+        aliases = {}
+        for partition in range(self.num_partitions):
+            rows = self._read_partition(name, partition, ['book_key', 'content_key'])
+            if rows is None:
+                continue
+            rows = rows[rows['book_key'] != rows['content_key']]
+            aliases.update(zip(rows['content_key'], rows['book_key']))
+        return aliases
+
+    def merge(self, base, sources, output_path):
+        """Joins every partitioned source to the base catalog on the book key, one partition at a time, and
+        writes the books that have a value from every source. Within a source the last row of a book
+        wins, so appending a regenerated summary updates it. In the base the first row of a book is kept.
+
+        Args:
+            base (str): the name of the partitioned base catalog
+            sources (dict): maps each source name to the column it contributes
+            output_path (str): the path of the merged parquet file
+
+        Returns:
+            pd.DataFrame: for every source, the rows read, the duplicate rows dropped, the rows matched to a book,
+                the rows without a matching book and the books dropped because the source had no value for them.
+                The matched rows of the base are the books written.
+        """
+        report = {name: {'source': name, 'rows': 0, 'duplicates': 0, 'matched': 0, 'unmatched': 0, 'books_missing': 0}
+                  for name in [base] + list(sources)}
+        tmp_path = output_path + '.tmp'
+        writer = None
+        try:
+            for partition in range(self.num_partitions):
+                books = self._read_partition(base, partition)
+                if books is None:
+                    books = pd.DataFrame({'book_key': [], 'Summary': [], 'row_number': []})
+                books = _dedupe(books, 'first', report[base])
+
+                # books without a summary are dropped, like in the original merge
+                has_summary = books['Summary'].notna()
+                report[base]['books_missing'] += int((~has_summary).sum())
+                books = books[has_summary]
+                base_keys = books['book_key']
+
+                for name, col in sources.items():
+                    rows = self._read_partition(name, partition, ['book_key', col, 'row_number'])
+                    if rows is None:
+                        rows = pd.DataFrame({'book_key': [], col: [], 'row_number': []})
+                    rows = _dedupe(rows, 'last', report[name])
+                    matched = rows['book_key'].isin(base_keys)
+                    report[name]['matched'] += int(matched.sum())
+                    report[name]['unmatched'] += int((~matched).sum())
+                    report[name]['books_missing'] += int((~base_keys.isin(rows['book_key'])).sum())
+                    books = books.merge(rows[['book_key', col]], on='book_key', how='inner')
+
+                if books.empty:
+                    continue
+
+                books = books.sort_values('row_number').drop(columns=['content_key', 'row_number'])
+                report[base]['matched'] += len(books)
+                table = pa.Table.from_pandas(books, schema=catalog_schema(books.columns), preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(tmp_path, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if writer is not None:
+            os.replace(tmp_path, output_path)
+
+        report = pd.DataFrame(list(report.values()))
+        print(report.to_string(index=False))
+        return report
+
+    def _source_dir(self, name):
+        return os.path.join(self.merge_dir, name)
+
+    def _partition_path(self, name, partition):
+        return os.path.join(self._source_dir(name), f"part_{partition:04d}.parquet")
+
+    def _read_partition(self, name, partition, columns=None):
+        """Reads one partition of a source.
+
+        Args:
+            name (str): the name of the source
+            partition (int): the partition number
+            columns (list, optional): the columns to read. Defaults to all columns.
+
+        Returns:
+            pd.DataFrame: the rows of the partition, or None if no row of the source falls in it
+        """
+        path = self._partition_path(name, partition)
+        if not os.path.exists(path):
+            return None
+        return pq.read_table(path, columns=columns).to_pandas()
+
+    def _save_manifest(self):
+        manifest_path = os.path.join(self.merge_dir, MANIFEST_FILENAME)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+
+##### Functions #####
+def content_key(books):
+    """Creates a key from the title and summary of every book.
+
+    Args:
+        books (pd.DataFrame): a dataframe with Title and Summary columns
+
+    Returns:
+        pd.Series: 'sha1:' followed by the sha1 of the title and summary
+    """
+    titles = books['Title'].fillna('').astype(str)
+    summaries = books['Summary'].fillna('').astype(str)
+    return pd.Series(['sha1:' + hashlib.sha1(f"{title}\x1f{summary}".encode('utf-8')).hexdigest()
+                      for title, summary in zip(titles, summaries)], index=books.index, dtype=object)
+
+def book_keys(books, aliases=None):
+    """Creates a stable key for every book: its System ID, else its OCLC number, else a hash of its
+    title and summary. Unlike the title, the identifiers do not repeat across different books.
+
+    Args:
+        books (pd.DataFrame): a dataframe of books, with any of the KEY_COLUMNS
+        aliases (dict, optional): maps content keys to book keys, for books without identifiers. Defaults to None.
+
+    Returns:
+        pd.Series: the key of every book
+    """
+    keys = content_key(books)
+    if aliases:
+        keys = keys.map(lambda key: aliases.get(key, key))
+    for col in reversed(KEY_COLUMNS):
+        if col in books.columns:
+            ids = books[col].astype(object).where(books[col].notna(), None)
+            ids = ids.map(lambda value: str(value).strip() if value is not None else '')
+            keys = keys.where(ids == '', col + ':' + ids)
+    return keys
+
+##### Helper Functions #####
+def _partition_of(keys, num_partitions):
+    """Assigns every key to a partition with crc32, which is the same in every process and version.
+
+    Args:
+        keys (pd.Series): the book keys
+        num_partitions (int): the number of partitions
+
+    Returns:
+        np.ndarray: the partition of every key
+    """
+    return np.array([zlib.crc32(key.encode('utf-8')) % num_partitions for key in keys], dtype=np.int64)
+
+def _partition_schema(columns):
+    """Creates the arrow schema of a partition, the row numbers are integers and every other column a string.
+
+    Args:
+        columns (list): the column names
+
+    Returns:
+        pa.Schema: the schema of the partition
+    """
+    schema = catalog_schema([col for col in columns if col != 'row_number'])
+    return schema.append(pa.field('row_number', pa.int64())) if 'row_number' in columns else schema
+
+def _dedupe(rows, keep, report):
+    """Keeps one row per book key and counts the rows read and dropped.
+
+    Args:
+        rows (pd.DataFrame): the rows of one partition, in file order by row_number
+        keep (str): 'first' or 'last'
+        report (dict): the counters of the source
+
+    Returns:
+        pd.DataFrame: the rows with unique book keys
+    """
+    rows = rows.sort_values('row_number')
+    report['rows'] += len(rows)
+    deduped = rows.drop_duplicates(subset=['book_key'], keep=keep)
+    report['duplicates'] += len(rows) - len(deduped)
+    return deduped
@@ -0,0 +1,168 @@
+# Imports
+import os
+import pickle
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+from index_utils import top_k, fingerprint, save_meta, load_meta, index_writer
+
+# create a class for the prebuilt tf-idf index
+class TfidfIndex:
+
+    def __init__(self, col, vectorizer, postings, valid, version):
+        """Constructor for the TfidfIndex class. Use build or load to create one.
+
+        Args:
+            col (str): the summary column the index was built from
+            vectorizer (TfidfVectorizer): the vectorizer fit on the whole column
+            postings (sp.csr_matrix): the L2 normalized tf-idf matrix stored term-major (terms x books)
+            valid (np.ndarray): boolean mask of the books that have a summary
+            version (str): fingerprint of the column the index was built from
+        """
+        self.col = col
+        self.vectorizer = vectorizer
+        self.postings = postings
+        self.valid = valid
+        self.version = version
+
+    @property
+    def num_books(self):
+        return self.postings.shape[1]
+
+    @classmethod
+    def build(cls, books, col):
+        """Fits a TF-IDF vectorizer once on every summary in the column.
+
+        Args:
+            books (pd.DataFrame): a dataframe consiting of the book data
+            col (str): The column containing the summary of interest
+
+        Returns:
+            TfidfIndex: the index for the column
+        """
+        summaries = books[col]
+        valid = summaries.apply(lambda x: isinstance(x, str)).values
+
+        # Rows are L2 normalized by the vectorizer, so a dot product is the cosine similarity
+        vectorizer = TfidfVectorizer(dtype=np.float32)
+        matrix = vectorizer.fit_transform(summaries.where(valid, ''))
+
+        # Store the matrix term-major so a query only touches the posting lists of its own terms
+        postings = matrix.T.tocsr()
+        postings.sort_indices()
+        return cls(col, vectorizer, postings, valid, fingerprint(summaries))
+
+    def save(self, index_dir):
+        """Saves the index to a folder. The arrays are stored as .npy files so they can be memory-mapped.
+        A saved index is replaced whole, see index_writer.
+
+        Args:
+            index_dir (str): the folder to save the index to
+        """
+        with index_writer(index_dir) as version_dir:
+            with open(os.path.join(version_dir, "vectorizer.pkl"), "wb") as f:
+                pickle.dump(self.vectorizer, f)
+            np.save(os.path.join(version_dir, "data.npy"), self.postings.data)
+            np.save(os.path.join(version_dir, "indices.npy"), self.postings.indices)
+            np.save(os.path.join(version_dir, "indptr.npy"), self.postings.indptr)
+            np.save(os.path.join(version_dir, "valid.npy"), self.valid)
+            save_meta(version_dir, {'column': self.col, 'num_books': int(self.num_books),
+                                    'num_terms': int(self.postings.shape[0]), 'version': self.version})
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """Loads an index saved with save.
+
+        Args:
+            index_dir (str): the folder containing the index
+            mmap (bool, optional): memory-map the arrays instead of reading them. Defaults to True.
+
+        Returns:
+            TfidfIndex: the loaded index
+        """
+        # every file is read from the same version even if a new one is swapped in meanwhile
+        index_dir = os.path.realpath(index_dir)
+        meta = load_meta(index_dir)
+        if meta is None:
+            raise FileNotFoundError(f"No index found in {index_dir}")
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(index_dir, "vectorizer.pkl"), "rb") as f:
+            vectorizer = pickle.load(f)
+        data = np.load(os.path.join(index_dir, "data.npy"), mmap_mode=mmap_mode)
+        indices = np.load(os.path.join(index_dir, "indices.npy"), mmap_mode=mmap_mode)
+        indptr = np.load(os.path.join(index_dir, "indptr.npy"), mmap_mode=mmap_mode)
+        valid = np.load(os.path.join(index_dir, "valid.npy"))
+        postings = sp.csr_matrix((data, indices, indptr), shape=(meta['num_terms'], meta['num_books']), copy=False)
+        return cls(meta['column'], vectorizer, postings, valid, meta['version'])
+
+    def scores(self, prompt):
+        """Calculates the cosine similarity between the prompt and every book in the index.
+
+        Args:
+            prompt (str): a prompt to match to books
+
+        Returns:
+            np.ndarray: one score per book, -inf for books without a summary
+        """
+        prompt_vector = self.vectorizer.transform([prompt])
+        scores = (prompt_vector @ self.postings).toarray().ravel()
+        scores[~self.valid] = -np.inf
+        return scores
+
+    def query(self, prompt, k):
+        """Finds the k books most similar to the prompt.
+
+        Args:
+            prompt (str): a prompt to match to books
+            k (int): the number of books to return
+
+        Returns:
+            indices (np.ndarray): the positions of the best books, best first
+            scores (np.ndarray): the cosine similarity of each of those books
+        """
+        return top_k(self.scores(prompt), k)
+
+    def query_batch(self, prompts, k, chunk_size=256):
+        """Finds the k books most similar to each prompt. The prompts are scored together with one
+        sparse (prompts x terms) by (terms x books) product per chunk of prompts.
+
+        Args:
+            prompts (list): the prompts to match to books
+            k (int): the number of books to return per prompt
+            chunk_size (int, optional): number of prompts scored at once, bounds the memory used
+                by the dense score matrix. Defaults to 256.
+
+        Returns:
+            list: one (indices, scores) tuple per prompt, as returned by query
+        """
+        results = []
+        for start in range(0, len(prompts), chunk_size):
+            prompt_vectors = self.vectorizer.transform(prompts[start:start + chunk_size])
+            scores = (prompt_vectors @ self.postings).toarray()
+            scores[:, ~self.valid] = -np.inf
+            results.extend(top_k(row, k) for row in scores)
+        return results
+
+    def pair_scores(self, prompts, indices):
+        """Calculates the cosine similarity between each prompt and one book. Only the posting lists
+        of the prompt terms are read, the other books are not scored.
+
+        Args:
+            prompts (list): the prompts to match to books
+            indices (list): the position of the book of each prompt
+
+        Returns:
+            np.ndarray: one score per prompt, -inf for books without a summary
+        """
+        prompt_vectors = self.vectorizer.transform(list(prompts)).tocsr()
+        scores = np.zeros(len(indices), dtype=np.float32)
+        for i, book in enumerate(indices):
+            for j in range(prompt_vectors.indptr[i], prompt_vectors.indptr[i + 1]):
+                term = prompt_vectors.indices[j]
+                start, end = self.postings.indptr[term], self.postings.indptr[term + 1]
+                # the books of a posting list are sorted
+                position = start + np.searchsorted(self.postings.indices[start:end], book)
+                if position < end and self.postings.indices[position] == book:
+                    scores[i] += prompt_vectors.data[j] * self.postings.data[position]
+        scores[~self.valid[np.asarray(indices, dtype=np.int64)]] = -np.inf
+        return scores
@@ -0,0 +1,62 @@
+# Imports
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import numpy as np
+import pandas as pd
+from bm25_index import BM25Index, BLOCK_SIZE, encode_varints, decode_varints
+from index_utils import top_k
+
+PROMPTS = ["term0", "term0 term1 term2", "term3 term40 term41", "term7 term7 term12 term99",
+           "term45 term46 term47 term48 term49", "nothing matches this", "term2 unknownword"]
+
+
+def make_books(num_books=3000, num_terms=50, seed=0):
+    # word frequencies follow a power law, so common terms span many blocks and rare terms only a few
+    rng = np.random.default_rng(seed)
+    probabilities = 1.0 / np.arange(1, num_terms + 1)
+    probabilities /= probabilities.sum()
+    summaries = [" ".join(f"term{t}" for t in rng.choice(num_terms, size=rng.integers(5, 60), p=probabilities))
+                 for _ in range(num_books)]
+    summaries[::97] = [None] * len(summaries[::97])
+    titles = [f"title{i} term{i % num_terms}" for i in range(num_books)]
+    return pd.DataFrame({'Title': titles, 'Summary': summaries})
+
+def assert_same_top_k(index, prompt, k):
+    exhaustive = index.scores(prompt)
+    indices, scores = index.query(prompt, k)
+    expected_indices, expected_scores = top_k(exhaustive, k)
+
+    # ties can be broken differently, so the scores are compared and the books must score the same exhaustively
+    assert len(indices) == len(expected_indices), (prompt, k)
+    np.testing.assert_allclose(scores, expected_scores, rtol=1e-5, err_msg=f"{prompt} {k}")
+    np.testing.assert_allclose(exhaustive[indices], scores, rtol=1e-5, err_msg=f"{prompt} {k}")
+
+def test_varints_round_trip():
+    values = np.array([0, 1, 127, 128, 300, 16383, 16384, 2**31 - 1], dtype=np.int64)
+    data, lengths = encode_varints(values)
+
+    assert list(lengths) == [1, 1, 1, 2, 2, 2, 3, 5]
+    assert np.array_equal(decode_varints(data), values)
+
+def test_query_returns_the_exhaustive_top_k():
+    books = make_books()
+    index = BM25Index.build(books, ['Title', 'Summary'])
+    # the common terms span several blocks, so skipping blocks is exercised
+    term_id = index.vocabulary['term0']
+    assert index.term_blocks[term_id + 1] - index.term_blocks[term_id] > len(books) // (2 * BLOCK_SIZE)
+
+    for prompt in PROMPTS:
+        for k in (1, 5, 10, 100, len(books) + 1):
+            assert_same_top_k(index, prompt, k)
+
+def test_score_books_matches_scores(tmp_path):
+    books = make_books(num_books=600, seed=1)
+    index_dir = str(tmp_path / "bm25")
+    BM25Index.build(books, ['Summary']).save(index_dir)
+    index = BM25Index.load(index_dir)
+
+    book_ids = np.array([0, 5, 97, 250, 599])
+    for prompt in PROMPTS:
+        np.testing.assert_allclose(index.score_books(prompt, book_ids), index.scores(prompt)[book_ids], rtol=1e-5)
+        assert_same_top_k(index, prompt, 10)
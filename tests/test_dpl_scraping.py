@@ -0,0 +1,62 @@
+# Imports
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import pandas as pd
+from async_fetcher import FixtureServer
+from dpl_scrape_data import get_urls_to_scrape_http, scrape_from_urls_http, URL_PREFIX
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "dpl")
+BOOK_URLS = [URL_PREFIX + f"/v2/record/S75C170000{i}" for i in (1, 2, 3)]
+
+
+def test_get_urls_to_scrape_http_parses_search_page(tmp_path):
+    filename = tmp_path / "dpl_book_urls.txt"
+    with FixtureServer(FIXTURE_DIR) as server:
+        # page 1 was not saved, the fixture server answers 404
+        failed_pages = get_urls_to_scrape_http(0, 2, filename=filename, base_url=server.base_url, max_retries=0)
+
+    assert failed_pages == [1]
+    with open(filename, "r") as f:
+        assert f.read().split() == BOOK_URLS
+
+def test_scrape_from_urls_http_parses_bib_pages(tmp_path):
+    urls_path = tmp_path / "dpl_book_urls.txt"
+    urls_path.write_text("\n".join(BOOK_URLS) + "\n")
+    save_file_path = str(tmp_path / "dpl_book_data.tsv")
+    with FixtureServer(FIXTURE_DIR) as server:
+        failed_urls = scrape_from_urls_http(urls_path, save_file_path, base_url=server.base_url,
+                                            use_selenium_fallback=False, max_retries=0)
+        # a restart finds every scraped book in the progress and only retries the missing one
+        failed_again = scrape_from_urls_http(urls_path, save_file_path, base_url=server.base_url,
+                                             use_selenium_fallback=False, max_retries=0)
+
+    assert failed_urls == failed_again == [BOOK_URLS[2]]
+    books = pd.read_csv(save_file_path, sep="\t").set_index('url')
+    assert sorted(books.index) == BOOK_URLS[:2]
+    river = books.loc[BOOK_URLS[0]]
+    assert river['title'] == 'The River at Night'
+    assert river['author'] == 'Ferencik, Erica'
+    assert (river['rating'], river['num_ratings']) == (3.7, 1204)
+    assert river['description'] == ('Four friends set out on a whitewater rafting trip in the Maine wilderness. '
+                                    'When the trip goes wrong they must fight to survive.')
+    # accents are stripped from the rows
+    assert books.loc[BOOK_URLS[1], 'title'] == 'Cafe Society in Vienna'
+    assert books.loc[BOOK_URLS[1], 'author'] == 'Schon, Margarete'
+
+def test_scrape_from_urls_http_resumes_from_rows_without_newlines(tmp_path):
+    urls_path = tmp_path / "dpl_book_urls.txt"
+    urls_path.write_text("\n".join(BOOK_URLS) + "\n")
+    save_file_path = tmp_path / "dpl_book_data.tsv"
+    # the first scraper wrote the header and then every row without a newline between them
+    old_rows = [f"Old title {i}\tOld author\t4.0\t10\tOld description\t{url}" for i, url in enumerate(BOOK_URLS[:2])]
+    save_file_path.write_text("title\tauthor\trating\tnum_ratings\tdescription\turl\n" + "".join(old_rows))
+    with FixtureServer(FIXTURE_DIR) as server:
+        failed_urls = scrape_from_urls_http(urls_path, str(save_file_path), base_url=server.base_url,
+                                            use_selenium_fallback=False, max_retries=0)
+
+    # the old rows are kept and not scraped again
+    assert failed_urls == [BOOK_URLS[2]]
+    books = pd.read_csv(save_file_path, sep="\t").set_index('url')
+    assert books.index.tolist() == BOOK_URLS[:2]
+    assert books['title'].tolist() == ['Old title 0', 'Old title 1']
@@ -0,0 +1,47 @@
+# Imports
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import pandas as pd
+from async_fetcher import FixtureServer
+from duke_libraries_scraping import DukeLibrariesScraper, BOOK_COLUMNS, _parse_book_details, _parse_book_details_bs4
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "duke")
+DOC_IDS = ['DUKE004123456', 'DUKE004987654']
+
+
+def test_save_doc_ids_async_parses_search_page(tmp_path):
+    filename = tmp_path / "doc_ids.csv"
+    with FixtureServer(FIXTURE_DIR) as server:
+        scraper = DukeLibrariesScraper(base_url=server.base_url)
+        # page 2 was not saved, the fixture server answers 404
+        failed_pages = scraper.save_doc_ids_async(1, 2, filename, num_parse_workers=1, max_retries=0)
+
+    assert failed_pages == [2]
+    assert pd.read_csv(filename, header=None)[0].tolist() == DOC_IDS
+
+def test_save_book_details_async_parses_catalog_pages(tmp_path):
+    filename = tmp_path / "books.csv"
+    with FixtureServer(FIXTURE_DIR) as server:
+        scraper = DukeLibrariesScraper(base_url=server.base_url)
+        failed_ids = scraper.save_book_details_async(pd.DataFrame({'doc_id': DOC_IDS + ['DUKE000000000']}), filename,
+                                                     num_parse_workers=1, max_retries=0)
+
+    assert failed_ids == ['DUKE000000000']
+    books = pd.read_csv(filename, header=None, names=BOOK_COLUMNS, keep_default_na=False).set_index('System ID')
+    assert sorted(books.index) == DOC_IDS
+    river = books.loc['DUKE004123456']
+    assert river['Title'] == 'The river at night : a novel'
+    assert river['Location'] == 'Perkins/Bostock Library Stacks'
+    assert river['Authors'] == 'Urquhart, Erica Ferencik'
+    assert river['Summary'].startswith('Four friends set out')
+    assert str(river['OCLC']) == '960835218'
+    assert river['Notes'] == ''
+    # accented titles must survive the decoding of the page
+    assert books.loc['DUKE004987654', 'Title'] == 'Café society in Vienna'
+
+def test_lxml_parser_matches_bs4_parser():
+    for doc_id in DOC_IDS:
+        with open(os.path.join(FIXTURE_DIR, f"%2Fcatalog%2F{doc_id}.html"), "rb") as f:
+            content = f.read()
+        assert _parse_book_details(content) == _parse_book_details_bs4(content)
@@ -0,0 +1,39 @@
+# Imports
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import numpy as np
+import pytest
+from extractive_summary import pagerank, PowerIterationFailedConvergence
+
+# networkx is only the reference here, the pipeline no longer depends on it
+nx = pytest.importorskip("networkx")
+
+
+def networkx_pagerank(adjacency_matrix):
+    scores = nx.pagerank(nx.from_numpy_array(adjacency_matrix))
+    return np.array([scores[i] for i in range(len(adjacency_matrix))])
+
+def test_pagerank_matches_networkx():
+    rng = np.random.default_rng(0)
+    for num_sentences in (1, 2, 5, 30):
+        # sentence similarity matrices are symmetric with an empty diagonal
+        similarity = rng.random((num_sentences, num_sentences))
+        similarity = np.triu(similarity, 1)
+        similarity = similarity + similarity.T
+        np.testing.assert_allclose(pagerank(similarity), networkx_pagerank(similarity), atol=1e-6)
+
+def test_pagerank_matches_networkx_with_unconnected_sentences():
+    rng = np.random.default_rng(1)
+    similarity = np.triu(rng.random((8, 8)), 1)
+    similarity = similarity + similarity.T
+    # sentences sharing no words with any other sentence have no edges
+    similarity[[2, 5], :] = 0
+    similarity[:, [2, 5]] = 0
+    np.testing.assert_allclose(pagerank(similarity), networkx_pagerank(similarity), atol=1e-6)
+
+def test_pagerank_raises_without_convergence():
+    similarity = np.ones((3, 3)) - np.eye(3)
+    similarity[0, 1] = similarity[1, 0] = 50
+    with pytest.raises(PowerIterationFailedConvergence):
+        pagerank(similarity, max_iter=1)
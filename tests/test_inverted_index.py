@@ -0,0 +1,49 @@
+# Imports
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+from inverted_index import InvertedIndex
+
+BOOKS = pd.DataFrame({'Summary': [
+    "A young wizard goes to a school of magic and fights a dark wizard.",
+    "The dog and the cat go on a trip to the sea.",
+    "A cat, a cat and another cat: the cat story.",
+    None,
+    "Magic school stories for young readers, with a dog.",
+    float('nan'),
+    "The sea, the sea: a story of the sea and a young sailor.",
+]})
+PROMPTS = ["young wizard", "cat", "cat cat cat", "the sea the sea", "dog", "magic school young",
+           "dragon", "Dog AND Cat"]
+
+
+def baseline_matches(prompt, books):
+    # the per-summary CountVectorizer loop the inverted index replaced
+    vectorizer = CountVectorizer()
+    keywords = vectorizer.fit_transform([prompt]).toarray()[0]
+    matches = []
+    for i, summary in enumerate(books['Summary']):
+        if isinstance(summary, str):
+            book_keywords = vectorizer.transform([summary]).toarray()[0]
+            if all(book_keywords[j] >= keywords[j] for j in range(len(keywords))):
+                matches.append(i)
+    return matches
+
+def test_query_matches_the_count_vectorizer_baseline():
+    index = InvertedIndex.build(BOOKS)
+    for prompt in PROMPTS:
+        assert list(index.query(prompt)) == baseline_matches(prompt, BOOKS), prompt
+
+def test_saved_index_matches_the_built_one(tmp_path):
+    index_dir = str(tmp_path / "inverted_index")
+    InvertedIndex.build(BOOKS).save(index_dir)
+    # a rebuild replaces the saved index instead of writing over it
+    InvertedIndex.build(BOOKS).save(index_dir)
+    loaded = InvertedIndex.load(index_dir)
+
+    assert loaded.num_books == len(BOOKS)
+    for prompt in PROMPTS:
+        assert np.array_equal(loaded.query(prompt), baseline_matches(prompt, BOOKS)), prompt
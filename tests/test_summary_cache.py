@@ -0,0 +1,78 @@
+# Imports
+import os
+import sqlite3
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import summary_cache
+from summary_cache import SummaryCache, ACCESS_RESOLUTION
+
+VALUE = "x" * 98  # 100 bytes once json encoded
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def last_access(path, key):
+    # read through a second connection, so only what was written to the file is seen
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT last_access FROM summaries WHERE key = ?", (key,)).fetchone()[0]
+    finally:
+        conn.close()
+
+def test_make_key_changes_with_model_params_and_text():
+    key = SummaryCache.make_key("textrank", {'ratio': 0.2, 'top_n': 3}, "some text")
+
+    assert key == SummaryCache.make_key("textrank", {'top_n': 3, 'ratio': 0.2}, "some text")
+    assert len({key,
+                SummaryCache.make_key("bart", {'ratio': 0.2, 'top_n': 3}, "some text"),
+                SummaryCache.make_key("textrank", {'ratio': 0.3, 'top_n': 3}, "some text"),
+                SummaryCache.make_key("textrank", {'ratio': 0.2, 'top_n': 3}, "some text.")}) == 4
+
+def test_get_many_counts_hits_and_misses(tmp_path):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many({'a': ["one"], 'b': {'summary': "two"}})
+
+    assert cache.get_many(['a', 'b', 'c']) == {'a': ["one"], 'b': {'summary': "two"}}
+    assert cache.get('c') is None
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+    assert cache.stats()['entries'] == 2
+    cache.close()
+
+def test_evict_removes_least_recently_used_entries(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(summary_cache.time, 'time', clock)
+    path = str(tmp_path / "cache.sqlite")
+    cache = SummaryCache(path, max_bytes=300)
+    for key in ('a', 'b', 'c', 'd'):
+        cache.put(key, VALUE)
+        clock.now += 1
+
+    # a hit only updates the access time once it is older than ACCESS_RESOLUTION, and only in memory
+    clock.now += ACCESS_RESOLUTION
+    stored = last_access(path, 'a')
+    assert cache.get('a') == VALUE
+    assert last_access(path, 'a') == stored
+
+    cache.evict()
+
+    assert last_access(path, 'a') == clock.now
+    assert cache.get_many(['a', 'b', 'c', 'd']).keys() == {'a', 'c', 'd'}
+    assert cache.stats()['bytes'] == 300
+    cache.close()
+
+def test_put_many_evicts_every_evict_interval(tmp_path, monkeypatch):
+    monkeypatch.setattr(summary_cache, 'EVICT_INTERVAL', 4)
+    cache = SummaryCache(str(tmp_path / "cache.sqlite"), max_bytes=250)
+    cache.put_many({'a': VALUE, 'b': VALUE, 'c': VALUE})
+    assert cache.stats()['entries'] == 3
+
+    cache.put('d', VALUE)
+    assert cache.stats()['entries'] == 2
+    cache.close()
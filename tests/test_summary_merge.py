@@ -0,0 +1,76 @@
+# Imports
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import pandas as pd
+from summary_merge import SummaryMerger, book_keys, _partition_of
+
+BOOKS = pd.DataFrame({
+    'System ID': ['S1', 'S2', None, 'S4', None, 'S6', 'S7', 'S8'],
+    'OCLC': ['101', None, '0303', '104', None, None, '107', '108'],
+    'Title': ['Dune', 'Emma', 'Dune', 'Persuasion', 'Untitled', 'Ulysses', 'Beloved', 'Dracula'],
+    'Summary': ['Sand and spice.', 'A matchmaker.', 'Another sand book.', 'A second chance.',
+                'No identifiers at all.', None, 'A haunted house.', 'A count in a castle.'],
+})
+
+
+def write_csv(df, path):
+    df.to_csv(path, index=False)
+    return str(path)
+
+def merged_summaries(output_path, col):
+    merged = pd.read_parquet(output_path)
+    return dict(zip(merged['Title'] + '|' + merged['Summary'], merged[col]))
+
+def test_book_keys_prefer_system_id_then_oclc_then_content():
+    keys = book_keys(BOOKS)
+
+    assert list(keys[:4]) == ['System ID:S1', 'System ID:S2', 'OCLC:0303', 'System ID:S4']
+    assert keys[4].startswith('sha1:')
+
+def test_merge_joins_rows_from_any_position_and_chunk(tmp_path):
+    books_path = write_csv(BOOKS, tmp_path / "books.csv")
+    # the summaries come in another order, so the rows of a book sit in different chunks of each file
+    extractive = BOOKS.iloc[::-1].assign(extractive_summary=lambda df: 'extractive ' + df['Title'])
+    extractive = extractive[['System ID', 'OCLC', 'Title', 'Summary', 'extractive_summary']]
+    extractive_path = write_csv(extractive, tmp_path / "extractive.csv")
+
+    merger = SummaryMerger(str(tmp_path / "merge"), num_partitions=3, chunksize=2)
+    merger.update_source('books', books_path)
+    merger.update_source('extractive', extractive_path, columns=['extractive_summary'])
+    report = merger.merge('books', {'extractive': 'extractive_summary'}, str(tmp_path / "merged.parquet"))
+
+    merged = pd.read_parquet(tmp_path / "merged.parquet")
+    # the book without a summary is dropped, every other book keeps its own summary
+    assert sorted(merged['Title']) == ['Beloved', 'Dracula', 'Dune', 'Dune', 'Emma', 'Persuasion', 'Untitled']
+    assert list(merged['extractive_summary']) == ['extractive ' + title for title in merged['Title']]
+    assert report.set_index('source').loc['extractive', 'unmatched'] == 1
+
+def test_merge_keeps_books_whose_rows_moved_to_another_partition(tmp_path):
+    books_path = write_csv(BOOKS, tmp_path / "books.csv")
+    # summaries written before the generators carried the identifiers are keyed by their content
+    abstractive = BOOKS[['Title', 'Summary']].assign(abbreviated_summary=lambda df: 'old ' + df['Title'])
+    abstractive_path = write_csv(abstractive, tmp_path / "abstractive.csv")
+    merger = SummaryMerger(str(tmp_path / "merge"), num_partitions=4, chunksize=3)
+    merger.update_source('books', books_path)
+    merger.update_source('abstractive', abstractive_path, columns=['abbreviated_summary'], alias_source='books')
+    merger.merge('books', {'abstractive': 'abbreviated_summary'}, str(tmp_path / "merged.parquet"))
+    assert merged_summaries(tmp_path / "merged.parquet", 'abbreviated_summary')['Emma|A matchmaker.'] == 'old Emma'
+
+    # regenerated with identifiers and appended, the rows of most books now hash to another partition
+    regenerated = BOOKS.assign(abbreviated_summary=lambda df: 'new ' + BOOKS['Title'])
+    moved = _partition_of(book_keys(regenerated), 4) != _partition_of(book_keys(abstractive), 4)
+    assert moved.any()
+    regenerated = regenerated[~(regenerated['System ID'].isna() & regenerated['OCLC'].isna())]
+    abstractive_path = write_csv(pd.concat([abstractive, regenerated]), tmp_path / "abstractive.csv")
+    os.utime(abstractive_path, ns=(0, os.stat(tmp_path / "abstractive.parquet").st_mtime_ns + 10**9))
+
+    assert merger.update_source('abstractive', abstractive_path, columns=['abbreviated_summary'], alias_source='books')
+    merger.merge('books', {'abstractive': 'abbreviated_summary'}, str(tmp_path / "merged.parquet"))
+
+    summaries = merged_summaries(tmp_path / "merged.parquet", 'abbreviated_summary')
+    assert len(summaries) == 7
+    # the last row of a book wins, the book without identifiers only has its old summary
+    assert summaries['Emma|A matchmaker.'] == 'new Emma'
+    assert summaries['Dune|Another sand book.'] == 'new Dune'
+    assert summaries['Untitled|No identifiers at all.'] == 'old Untitled'